@@ -0,0 +1,107 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""The checksums clients can choose to verify transferred data with.
+
+crc16 is the default, as clients that don't choose expect it. crc32 and
+adler32 are computed by zlib, and are much faster to compute in python.
+
+"""
+
+__all__ = ['DEFAULT_CHECKSUM', 'Checksum', 'checksumNames', 'getChecksum',
+           'crc32', 'adler32']
+
+import zlib
+
+from jsonrpc import InvalidParametersError
+from crc16 import crc16
+
+DEFAULT_CHECKSUM = 'crc16'
+
+def crc32(string, value=0):
+    """The CRC-32 of string as an unsigned number, like crc16."""
+
+    return zlib.crc32(string, value) & 0xffffffff
+
+def adler32(string, value=1):
+    """The Adler-32 of string as an unsigned number, like crc16."""
+
+    return zlib.adler32(string, value) & 0xffffffff
+
+# name -> (function, the value of no data)
+_checksums = {'crc16': (crc16, 0),
+              'crc32': (crc32, 0),
+              'adler32': (adler32, 1)}
+
+def checksumNames():
+    """Return the names of the supported checksums, the default first."""
+
+    names = sorted(_checksums)
+    names.remove(DEFAULT_CHECKSUM)
+    return [DEFAULT_CHECKSUM] + names
+
+def getChecksum(name):
+    """Return the function of the checksum name, called as function(string[, value]).
+
+    @raise InvalidParametersError: if there is no checksum name.
+    """
+
+    if name == None:
+        name = DEFAULT_CHECKSUM
+    try:
+        return _checksums[name][0]
+    except KeyError:
+        raise InvalidParametersError('Unknown checksum %s, expected one of %s' % (name, ', '.join(checksumNames())))
+
+class Checksum(object):
+    """The checksum name of data given in parts, like CRC16."""
+
+    def __init__(self, name=DEFAULT_CHECKSUM, string=''):
+        self.function = getChecksum(name)
+        self.name = name
+        self.val = _checksums[name][1]
+        if string:
+            self.update(string)
+
+    def update(self, string):
+        self.val = self.function(string, self.val)
+
+if __name__ == '__main__':
+    # compare the speed of the checksums, and the byte at a time crc16 they
+    # replace, across file sizes
+    import os
+    import time
+    from crc16 import table
+
+    def bytecrc16(string, value=0):
+        for ch in string:
+            value = table[ord(ch) ^ (value & 0xff)] ^ (value >> 8)
+        return value
+
+    functions = [('crc16 (bytes)', bytecrc16)] + [(name, getChecksum(name)) for name in checksumNames()]
+    print '%-10s' % 'size' + ''.join(['%16s' % name for name, fn in functions])
+    for size in [1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024]:
+        data = os.urandom(size)
+        row = '%-10s' % ('%dKB' % (size / 1024))
+        for name, fn in functions:
+            if size > 1024 * 1024 and fn is bytecrc16:
+                row += '%16s' % '-'
+                continue
+            loops = max(1, 1024 * 1024 / size)
+            start = time.time()
+            for i in xrange(loops):
+                fn(data)
+            elapsed = (time.time() - start) / loops
+            row += '%11.1f MB/s' % (size / elapsed / 1e6)
+        print row
@@ -1,12 +1,24 @@
 __all__ = ['crc16', 'CRC16']
 
+import sys
 from array import array
 
 def crc16(string, value=0):
     """ Single-function interface, like gzip module's crc32
+
+    The string is read as 16 bit words, each updating the crc with one
+    lookup in wordtable, which is several times faster than a byte at a time.
     """
-    for ch in string:
-        value = table[ord(ch) ^ (value & 0xff)] ^ (value >> 8)
+    n = len(string) & ~1
+    # a block at a time, so a large string isn't copied into one large array
+    for start in xrange(0, n, _BLOCK_SIZE):
+        words = array('H', string[start:min(start + _BLOCK_SIZE, n)])
+        if _bigendian:
+            words.byteswap()
+        for word in words:
+            value = wordtable[value ^ word]
+    if n != len(string):
+        value = table[ord(string[-1]) ^ (value & 0xff)] ^ (value >> 8)
     return value
 
 class CRC16(object):
@@ -48,3 +60,12 @@ for byte in range(256):
             crc >>= 1
         byte >>= 1
     table.append(crc)
+
+# the crc of each 16 bit word, least significant byte first, for crc16. The
+# crc is 16 bits wide, so after it is xored with the next word the result
+# only depends on the table.
+table = list(table)
+wordtable = [table[(table[w & 0xff] ^ (w >> 8)) & 0xff] ^ (table[w & 0xff] >> 8)
+             for w in xrange(65536)]
+_bigendian = sys.byteorder == 'big'
+_BLOCK_SIZE = 64 * 1024
@@ -63,10 +63,13 @@ class Environment(PluginManager):
     """Centralized environment for ndsdevelserver."""
     
     def __init__(self):
+        PluginManager.__init__(self)
         # TODO: handle invalid config
         self.config = Config('ndsds.cfg')
         self.setup_log()
         
+        self.result_cache_handlers = []
+        
         load_components(self, auto_enable=False)
         self.load_default_plugins()
     
@@ -97,8 +100,27 @@ class Environment(PluginManager):
         if self.config.get('plugins', {}).has_key(component_name):
             return self.config.get('plugins', {})[component_name] == True
 
-        # By default, all components in the ndsdevelserver package are enabled
-        return component_name.startswith('ndsdevelserver.')
+        # By default, all components in the ndsdevelserver package are enabled,
+        # along with the default plugins, which load_default_plugins loads as
+        # top level modules
+        return component_name.startswith('ndsdevelserver.') or \
+               component_name.split('.')[0] in _DEFAULT_PLUGINS
+    
+    def add_result_cache_handler(self, handler):
+        """Register a service handler whose cached results are removed by
+        `invalidate_results`."""
+        
+        self.result_cache_handlers.append(handler)
+    
+    def invalidate_results(self, name=None, params=None):
+        """Remove cached results of idempotent procedures.
+        
+        Plugins call this when the data behind a procedure changes. `name` is
+        a method or service name, if it is None every result is removed; if
+        `params` is given only the result for those parameters is removed."""
+        
+        for handler in self.result_cache_handlers:
+            handler.invalidateResults(name, params)
     
     def setup_log(self):
         cfg = self.config.get('log', {})
@@ -127,7 +149,7 @@ class Environment(PluginManager):
 def _enable_plugin(env, module):
     """Enable the given plugin module by adding an entry to the enabled dict.
     """
-    env.enabled[module] = True
+    env.set_enabled(module, True)
 
 def load_eggs(entry_point_name):
     """Loader that loads any eggs on the search path and `sys.path`."""
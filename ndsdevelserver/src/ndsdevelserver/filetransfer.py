@@ -16,14 +16,26 @@ __all__ = ['FileTransfer', 'IDownloadManipulator', 'IUploadManipulator'
            'IListDir', 'makeDirectoryEntry']
 
 import os
-import stat
 import zlib
 import base64
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
-from jsonrpc import serviceProcedure, String, Number, Boolean, Object, Array, ApplicationError, JSONRPCAssertionError
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+from jsonrpc import serviceProcedure, String, Number, Boolean, Object, Array, ApplicationError, JSONRPCAssertionError, InvalidParametersError, defaultCodec, EncodedObject
+from jsonrpc.prefork import isWorkerProcess
+from jsonrpc.binarychannel import BinaryChannel, BinaryChannelServer
 from plugin import Plugin, ExtensionPoint, Interface, implements
-from crc16 import crc16
+from checksum import DEFAULT_CHECKSUM, Checksum, checksumNames, getChecksum
 from servicepluginhandler import IRPCService
+from precompress import Precompressor, PRECOMPRESS_DIR, PRECOMPRESS_INTERVAL, PRECOMPRESS_LEVEL, PRECOMPRESS_MIN_SIZE
 
 class IDownloadManipulator(Interface):
     """Extension point interface for plugins that need to do custom handling for file downloads."""
@@ -95,6 +107,454 @@ def makeDirectoryEntry(name, size, isdir = False, readonly = False):
     
     return out
 
+# the chunk size suggested to clients by file.stat, small enough for the DS
+# to buffer
+CHUNK_SIZE = 32 * 1024
+# the largest chunk file.downloadChunk returns
+MAX_CHUNK_SIZE = 1024 * 1024
+# how much of a file is read at once, so the chunks that follow come from memory
+READ_AHEAD = 256 * 1024
+# the most files kept open for chunked downloads
+MAX_SOURCES = 8
+# seconds the data a download plugin returned is reused for chunks
+SOURCE_TTL = 60.0
+# the directory, in the rootpath of the target, uploads are staged in
+STAGING_DIR = '.uploads'
+# seconds an upload session is kept after its last chunk
+UPLOAD_TTL = 24 * 60 * 60
+# the length of the frames binary downloads are sent in
+BINARY_FRAME_SIZE = 64 * 1024
+# the default memory budget, in bytes, of the encoded downloads kept by
+# PayloadCache
+PAYLOAD_CACHE_SIZE = 64 * 1024 * 1024
+
+def _posixFallocate():
+    """Return posix_fallocate from the C library, or None if it is not available."""
+    
+    if ctypes == None or os.name != 'posix':
+        return None
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library('c'))
+        fn = lib.posix_fallocate64
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return fn
+
+_posix_fallocate = _posixFallocate()
+
+def preallocate(f, size):
+    """Make the open file f size bytes long, reserving the disk space if possible."""
+    
+    if _posix_fallocate != None and size > 0 and _posix_fallocate(f.fileno(), 0, size) == 0:
+        return
+    f.truncate(size)
+
+class FileSource(object):
+    """A file being downloaded in chunks.
+    
+    The file is kept open and read READ_AHEAD bytes at a time, so sequential
+    chunks, or chunks fetched in parallel that are close together, are served
+    from memory.
+    
+    """
+    
+    def __init__(self, path, st):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.lock = threading.Lock()
+        self.file = None
+        self.buf = ''
+        self.bufStart = 0
+        self.checksums = {}     # checksum name -> value of the whole file
+        self.lastUsed = time.time()
+    
+    def current(self, path, st):
+        """Return True if this is still the file at path with the stat st."""
+        
+        return path == self.path and st.st_size == self.size and st.st_mtime == self.mtime
+    
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        self.lock.acquire()
+        try:
+            if offset < self.bufStart or end > self.bufStart + len(self.buf):
+                if self.file == None:
+                    self.file = open(self.path, 'rb')
+                self.file.seek(offset)
+                self.buf = self.file.read(max(end - offset, READ_AHEAD))
+                self.bufStart = offset
+            return self.buf[offset - self.bufStart:end - self.bufStart]
+        finally:
+            self.lock.release()
+    
+    def crc(self, checksum = DEFAULT_CHECKSUM):
+        """Return the checksum, by default the CRC16, of the whole file."""
+        
+        if not self.checksums.has_key(checksum):
+            # read separately, so the read ahead buffer is left for the chunks
+            crc = Checksum(checksum)
+            f = open(self.path, 'rb')
+            try:
+                while 1:
+                    data = f.read(READ_AHEAD)
+                    if not data:
+                        break
+                    crc.update(data)
+            finally:
+                f.close()
+            self.checksums[checksum] = crc.val
+        return self.checksums[checksum]
+    
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.file != None:
+                self.file.close()
+                self.file = None
+            self.buf = ''
+        finally:
+            self.lock.release()
+
+class DataSource(object):
+    """The data a download plugin returned, being downloaded in chunks."""
+    
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.mtime = time.time()
+        self.expires = self.mtime + SOURCE_TTL
+        self.checksums = {}
+        self.lastUsed = self.mtime
+    
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+    
+    def crc(self, checksum = DEFAULT_CHECKSUM):
+        if not self.checksums.has_key(checksum):
+            self.checksums[checksum] = getChecksum(checksum)(self.data)
+        return self.checksums[checksum]
+    
+    def close(self):
+        pass
+
+class PayloadCache(object):
+    """A least recently used cache of encoded download results.
+    
+    Results are kept as EncodedObjects, so a download served from the cache
+    is spliced into the response without being read, checksummed, compressed
+    or encoded again. They are keyed on the local path, size and modification
+    time of the file, and the options of the download, so a changed file is
+    never served from the cache. The results, counting both their data and
+    its encoding, take at most maxBytes.
+    
+    """
+    
+    def __init__(self, maxBytes = PAYLOAD_CACHE_SIZE):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key -> EncodedObject, least recently used first
+        self.paths = {}                 # local path -> set of keys
+        self.loading = {}               # key -> threading.Event set once it is loaded
+        self.bytes = 0
+        self.resetStats()
+    
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.uncacheable = 0
+    
+    def fetch(self, key, load):
+        """Return the payload for key, calling load() to make it if it is not cached.
+        
+        Other threads asking for key while it is loaded wait for it, so a
+        file downloaded by many clients at once is only encoded once.
+        
+        """
+        
+        while 1:
+            self.lock.acquire()
+            try:
+                payload = self.entries.pop(key, None)
+                if payload != None:
+                    self.entries[key] = payload
+                    self.hits += 1
+                    return payload
+                loading = self.loading.get(key)
+                if loading == None:
+                    self.misses += 1
+                    loading = self.loading[key] = threading.Event()
+                    break
+            finally:
+                self.lock.release()
+            loading.wait()
+            if key not in self.entries:
+                # too large to cache, or the load failed
+                self.lock.acquire()
+                try:
+                    self.misses += 1
+                finally:
+                    self.lock.release()
+                return load()
+        
+        try:
+            payload = load()
+            self.put(key, payload)
+            return payload
+        finally:
+            self.lock.acquire()
+            try:
+                del self.loading[key]
+            finally:
+                self.lock.release()
+            loading.set()
+    
+    def size(self, payload):
+        # the data is held both as a string and in the encoding
+        return len(payload.json) + len(payload['data'])
+    
+    def put(self, key, payload):
+        size = self.size(payload)
+        path = key[0]
+        self.lock.acquire()
+        try:
+            if size > self.maxBytes:
+                self.uncacheable += 1
+                return
+            # the entries of other versions of the file can't be used again
+            for old in [k for k in self.paths.get(path, ()) if k[1:3] != key[1:3]]:
+                self._remove(old)
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = payload
+            self.paths.setdefault(path, set()).add(key)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                self._remove(self.entries.iterkeys().next())
+                self.evictions += 1
+        finally:
+            self.lock.release()
+    
+    def _remove(self, key):
+        # the caller holds the lock
+        payload = self.entries.pop(key)
+        self.bytes -= self.size(payload)
+        keys = self.paths[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.paths[key[0]]
+    
+    def invalidate(self, path = None):
+        """Remove the payloads of the local file path, or of every file, returning the number removed."""
+        
+        self.lock.acquire()
+        try:
+            if path == None:
+                keys = self.entries.keys()
+            else:
+                keys = list(self.paths.get(path, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+        finally:
+            self.lock.release()
+    
+    def stats(self):
+        """Return the hit and miss counts and size of the cache as a dictionary."""
+        
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRatio': lookups and float(self.hits) / lookups or 0.0,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'uncacheable': self.uncacheable,
+                    'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'maxBytes': self.maxBytes}
+        finally:
+            self.lock.release()
+
+def readJournal(path):
+    """Return the lines of the upload journal at path, or None if there is none."""
+    
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        return f.read().splitlines()
+    finally:
+        f.close()
+
+class UploadSession(object):
+    """A file being uploaded in chunks.
+    
+    The chunks are written to a preallocated part file in the staging
+    directory, and each one is recorded in a journal next to it, so the
+    session can be picked up again by id after the client reconnects, even
+    by another server process. The file only replaces its target when the
+    upload is committed.
+    
+    """
+    
+    def __init__(self, id, staging, file, size, crc = None, checksum = DEFAULT_CHECKSUM):
+        self.id = id
+        self.file = file
+        self.size = size
+        self.crc = crc
+        self.checksum = checksum    # the name of the checksum of crc and the chunks
+        self.partPath = os.path.join(staging, id + '.part')
+        self.journalPath = os.path.join(staging, id + '.journal')
+        self.received = []      # sorted, non overlapping [start, end] ranges
+        self.lock = threading.Lock()
+    
+    def create(cls, staging, file, size, crc = None, checksum = DEFAULT_CHECKSUM):
+        """Start a new session for file, staged in the directory staging."""
+        
+        if not os.path.isdir(staging):
+            os.makedirs(staging)
+        session = cls(uuid.uuid4().hex, staging, file, size, crc, checksum)
+        f = open(session.partPath, 'wb')
+        try:
+            preallocate(f, size)
+        finally:
+            f.close()
+        f = open(session.journalPath, 'w')
+        try:
+            f.write(defaultCodec().encode({'file': file, 'size': size, 'crc': crc, 'checksum': checksum}) + '\n')
+        finally:
+            f.close()
+        return session
+    create = classmethod(create)
+    
+    def load(cls, id, staging):
+        """Return the session id from its journal in staging, or None if there is none."""
+        
+        lines = readJournal(os.path.join(staging, id + '.journal'))
+        if lines == None:
+            return None
+        header = defaultCodec().decode(lines[0])
+        session = cls(id, staging, header['file'], header['size'], header.get('crc'),
+                      header.get('checksum', DEFAULT_CHECKSUM))
+        session.addRanges(lines[1:])
+        return session
+    load = classmethod(load)
+    
+    def reload(self):
+        """Read the ranges received again from the journal, returning False if it is gone.
+        
+        Other server processes write chunks of the same session, so the
+        ranges this process has seen can be out of date. The caller holds
+        the lock.
+        
+        """
+        
+        lines = readJournal(self.journalPath)
+        if lines == None:
+            return False
+        self.received = []
+        self.addRanges(lines[1:])
+        return True
+    
+    def write(self, offset, data):
+        """Write the chunk data at offset, returning the number of bytes received so far.
+        
+        Only the chunks this process has seen are counted, the journal is
+        read again by status and commitUpload.
+        
+        """
+        
+        self.lock.acquire()
+        try:
+            f = open(self.partPath, 'r+b')
+            try:
+                f.seek(offset)
+                f.write(data)
+            finally:
+                f.close()
+            f = open(self.journalPath, 'a')
+            try:
+                f.write('%d %d\n' % (offset, offset + len(data)))
+            finally:
+                f.close()
+            self.addRange(offset, offset + len(data))
+            return self.receivedBytes()
+        finally:
+            self.lock.release()
+    
+    def addRanges(self, lines):
+        for line in lines:
+            # a line cut short by a crash is ignored, the chunk is sent again
+            parts = line.split()
+            if len(parts) == 2:
+                self.addRange(int(parts[0]), int(parts[1]))
+    
+    def addRange(self, start, end):
+        if start >= end:
+            return
+        ranges = []
+        for r in self.received:
+            if r[1] < start or r[0] > end:
+                ranges.append(r)
+            else:
+                start = min(start, r[0])
+                end = max(end, r[1])
+        ranges.append([start, end])
+        ranges.sort()
+        self.received = ranges
+    
+    def receivedBytes(self):
+        return sum([end - start for start, end in self.received])
+    
+    def complete(self):
+        return self.received == [[0, self.size]] or self.size == 0
+    
+    def lastUsed(self):
+        try:
+            return os.path.getmtime(self.journalPath)
+        except OSError:
+            return 0
+    
+    def status(self):
+        self.lock.acquire()
+        try:
+            if not self.reload():
+                return None
+            return {'session': self.id,
+                    'file': self.file,
+                    'size': self.size,
+                    'checksum': self.checksum,
+                    'received': self.receivedBytes(),
+                    'ranges': [list(r) for r in self.received],
+                    'complete': self.complete()}
+        finally:
+            self.lock.release()
+    
+    def partCRC(self):
+        crc = Checksum(self.checksum)
+        f = open(self.partPath, 'rb')
+        try:
+            while 1:
+                data = f.read(READ_AHEAD)
+                if not data:
+                    break
+                crc.update(data)
+        finally:
+            f.close()
+        return crc.val
+    
+    def remove(self):
+        for path in (self.partPath, self.journalPath):
+            if os.path.exists(path):
+                os.remove(path)
+
 class FileTransfer(Plugin):
     """This is a JSON-RPC service that provides download and uploading capabilities."""
     
@@ -106,39 +566,101 @@ class FileTransfer(Plugin):
     upload_plugins = ExtensionPoint(IUploadManipulator)
     listdir_plugins = ExtensionPoint(IListDir)
     
+    def __init__(self):
+        self.sources = {}   # requested file name -> FileSource or DataSource
+        self.sourcesLock = threading.Lock()
+        self.uploads = {}   # session id -> UploadSession
+        self.uploadsLock = threading.Lock()
+        self.binaryServer = None
+        self.binaryLock = threading.Lock()
+        # the encoded results of downloads, configured by file.cache.size,
+        # in bytes, which is 0 to disable it
+        size = self.config.get('file', {}).get('cache', {}).get('size', PAYLOAD_CACHE_SIZE)
+        if size:
+            self.payloads = PayloadCache(int(size))
+        else:
+            self.payloads = None
+        self.codec = defaultCodec()
+        # compressed copies of the served files, made in the background if
+        # file.precompress is configured
+        cfg = self.config.get('file', {}).get('precompress')
+        if cfg and cfg.get('enabled', True):
+            self.precompressor = Precompressor(self.rootPaths(), self.log,
+                                               cfg.get('interval', PRECOMPRESS_INTERVAL),
+                                               cfg.get('level', PRECOMPRESS_LEVEL),
+                                               cfg.get('minSize', PRECOMPRESS_MIN_SIZE),
+                                               [STAGING_DIR])
+            self.precompressor.start()
+        else:
+            self.precompressor = None
+    
     @serviceProcedure(summary="This method is used to request a file from the server.",
-                      params=[String('file'), Boolean('compress')],
+                      params=[String('file'), Boolean('compress'), String('checksum')],
                       ret=Object())
-    def download(self, file, compress = False):
+    def download(self, file, compress = False, checksum = None):
         """This method is used to request a file from the server.
         
         @param file: path of the file to download.
         @param compress: if True the contents of the file will be compressed
             with zlib before sending.
+        @param checksum: the name of the checksum crc is, one of those
+            returned by checksums. By default crc16.
         @return: a JSON-RPC Object with keys data, crc, and compressed.
         
         """
         
-        cfg = getConfig(file)
-        dl_plugins = dict([[x.__class__.__name__, x] for x in self.download_plugins])
-        for plugin in cfg['plugins']:
-            if dl_plugins.has_key(plugin):
-                plugin = dl_plugins[plugin]
-                if plugin.handles(cfg['head'], cfg['tail']):
-                    data = plugin.download(cfg['head'], cfg['tail'], cfg['rootpath'])
-                    break
-            else:
-                self.log.debug("FileTransfer.download: Skipping plugin %s, not found" % plugin)
-        else:   # default download handling, just send the file
-            path = os.path.normpath(os.path.join(cfg['rootpath'], cfg['tail']))
-            if not os.path.exists(path):
-                raise ApplicationError('IOError: No such file or directory: %s' % file)
-            if not os.isfile(path):
-                raise ApplicationError('IOError: %s is a directory' % file)
-            data = open(path, 'rb').read()
+        computeCRC = getChecksum(checksum)
+        cfg = self.getConfig(file)
+        plugin = self.getDownloadPlugin(cfg)
+        if plugin != None:
+            data = plugin.download(cfg['head'], cfg['tail'], cfg['rootpath'])
+            return self.encodeDownload(data, compress, computeCRC)
+        
+        # default download handling, just send the file
+        path = self.getLocalFile(cfg, file)
+        st = os.stat(path)
+        checksum = checksum or DEFAULT_CHECKSUM
+        if self.payloads == None:
+            return self.loadDownload(path, st, compress, checksum)
+        
+        key = (path, st.st_size, st.st_mtime, bool(compress), checksum)
+        payload = self.payloads.fetch(key, lambda: self.encodePayload(
+            self.loadDownload(path, st, compress, checksum)))
+        # a copy, so a caller changing it can't change the cached one
+        return EncodedObject(payload, payload.json)
+    
+    def encodePayload(self, result):
+        """Return the result of download as an EncodedObject, to be cached."""
+        
+        return EncodedObject(result, self.codec.encode(result))
+    
+    def loadDownload(self, path, st, compress, checksum):
+        """Return the result of download for the local file path with the stat st.
+        
+        A compressed download is made from the precompressed copy of the file
+        if it is up to date.
+        
+        """
+        
+        if compress and self.precompressor != None:
+            found = self.precompressor.lookup(path, st, checksum)
+            if found != None:
+                data, crc = found
+                return {'data': base64.b64encode(data), 'crc': crc, 'compressed': True}
+        return self.encodeDownload(self.readFile(path), compress, getChecksum(checksum))
+    
+    def readFile(self, path):
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    
+    def encodeDownload(self, data, compress, computeCRC):
+        """Return the result of download for the file contents data."""
         
         # compute the crc of the data
-        crc = crc16(data)
+        crc = computeCRC(data)
         
         # compress the data if so requested
         if compress:
@@ -147,52 +669,438 @@ class FileTransfer(Plugin):
         # encode the data in base64
         data = base64.b64encode(data)
         
-        return {'data': data, 'crc': crc}
+        return {'data': data, 'crc': crc, 'compressed': bool(compress)}
+    
+    @serviceProcedure(summary="Returns the size, modification time and CRC16 of a file, for downloading it in chunks.",
+                      params=[String('file'), String('checksum')],
+                      ret=Object())
+    def stat(self, file, checksum = None):
+        """Returns the size, modification time and CRC16 of a file, for downloading it in chunks.
+        
+        @param file: path of the file.
+        @param checksum: the name of the checksum crc is, by default crc16.
+        @return: a JSON-RPC Object with keys size, mtime, crc (of the whole
+            file), chunkSize (the suggested length of chunks) and maxChunkSize.
+        
+        """
+        
+        getChecksum(checksum)
+        source = self.getSource(file)
+        return {'size': source.size,
+                'mtime': source.mtime,
+                'crc': source.crc(checksum or DEFAULT_CHECKSUM),
+                'chunkSize': CHUNK_SIZE,
+                'maxChunkSize': MAX_CHUNK_SIZE}
+    
+    @serviceProcedure(summary="Returns part of a file, so large files can be downloaded in chunks, resumed, or fetched in parallel.",
+                      params=[String('file'), Number('offset'), Number('length'), Boolean('compress'), String('checksum')],
+                      ret=Object())
+    def downloadChunk(self, file, offset, length = CHUNK_SIZE, compress = False, checksum = None):
+        """Returns part of a file, so large files can be downloaded in chunks, resumed, or fetched in parallel.
+        
+        Chunks read in order come from a read ahead buffer, so each one only
+        costs a disk read every READ_AHEAD bytes.
+        
+        @param file: path of the file to download.
+        @param offset: the offset in bytes of the chunk.
+        @param length: the length of the chunk, at most maxChunkSize. The chunk
+            is shorter if the file ends first.
+        @param compress: if True the chunk will be compressed with zlib before
+            sending.
+        @param checksum: the name of the checksum crc is, by default crc16.
+        @return: a JSON-RPC Object with keys data (base64 encoded), crc (of
+            the chunk before compression), offset, length (of the chunk before
+            compression), compressed, eof (true if this chunk ends the file),
+            and size and mtime of the file, which change if the file does.
+        
+        """
+        
+        computeCRC = getChecksum(checksum)
+        offset = int(offset)
+        length = int(length)
+        if offset < 0 or length < 0:
+            raise InvalidParametersError('offset and length must not be negative')
+        if length > MAX_CHUNK_SIZE:
+            raise InvalidParametersError('length %d is larger than the maximum chunk size %d' % (length, MAX_CHUNK_SIZE))
+        
+        source = self.getSource(file)
+        if offset > source.size:
+            raise InvalidParametersError('offset %d is beyond the end of %s (%d bytes)' % (offset, file, source.size))
+        data = source.read(offset, length)
+        
+        crc = computeCRC(data)
+        rawLength = len(data)
+        if compress:
+            data = zlib.compress(data)
+        
+        return {'data': base64.b64encode(data),
+                'crc': crc,
+                'offset': offset,
+                'length': rawLength,
+                'compressed': bool(compress),
+                'eof': offset + rawLength >= source.size,
+                'size': source.size,
+                'mtime': source.mtime}
     
     @serviceProcedure(summary="This method uploads a file to the server.",
-                      params=[String('data'), Number('crc'), Boolean('compress')],
+                      params=[String('data'), Number('crc'), Boolean('compress'), String('checksum')],
                       ret=None)
-    def upload(self, filename, data, crc, compressed = False):
+    def upload(self, filename, data, crc, compressed = False, checksum = None):
         """This method uploads a file to the server.
         
         @param filename: file name of the file to download.
         @param data: the contents of the file being uploaded in base64 format.
         @param crc: the CRC-16-IBM (CRC16) Cyclic Redundancy Check for the data.
         @param compressed: if True the data will be decompressed with zlib.
+        @param checksum: the name of the checksum crc is, by default crc16.
         
         """
         
+        computeCRC = getChecksum(checksum)
         # decode the base64 encoded string
         data_ = base64.b64decode(data)
         # decompress the data if needed
         if compressed:
-            data_ = zlib.decompress(data)
+            data_ = zlib.decompress(data_)
         
         # make sure we recieved what we were expecting by computing the crc value
-        if crc16(data_) != crc:
+        if computeCRC(data_) != crc:
             self.log.debug('FileTransfer.upload: crc values did not match for request %s' % filename)
             raise JSONRPCAssertionError('crc value does not match')
         
-        cfg = getConfig(file)
-        ul_plugins = dict([[x.__class__.__name__, x] for x in self.upload_plugins])
-        for plugin in cfg['plugins']:
-            if ul_plugins.has_key(plugin):
-                plugin = ul_plugins[plugin]
-                if plugin.handles(cfg['head'], cfg['tail']):
-                    plugin.upload(cfg['head'], cfg['tail'], data_, cfg['rootpath'])
-                    break
-            else:
-                self.log.debug("FileTransfer.upload: Skipping plugin %s, not found" % plugin)
+        cfg = self.getConfig(filename)
+        if cfg['readonly']:
+            raise ApplicationError('IOError: %s is read-only' % filename)
+        plugin = self.getUploadPlugin(cfg)
+        if plugin != None:
+            plugin.upload(cfg['head'], cfg['tail'], data_, cfg['rootpath'])
         else:   # default upload handling, just save the data
-            path = os.path.normpath(os.path.join(cfg['rootpath'], cfg['tail']))
-            if not os.path.exists(path):
-                raise ApplicationError('IOError: No such file or directory: %s' % filename)
-            if not os.isfile(path):
-                raise ApplicationError('IOError: %s is a directory' % filename)
+            path = self.getUploadTarget(cfg, filename)
             
             f = open(path, 'wb')
             f.write(data_)
             f.close()
+            self.fileChanged(path)
+    
+    @serviceProcedure(summary="Starts uploading a file in chunks, returning the session to send them to.",
+                      params=[String('file'), Number('size'), Number('crc'), String('checksum')],
+                      ret=Object())
+    def beginUpload(self, file, size, crc = None, checksum = None):
+        """Starts uploading a file in chunks, returning the session to send them to.
+        
+        The file does not need to exist, but its directory does. Nothing is
+        changed until commitUpload is called.
+        
+        @param file: path of the file to upload.
+        @param size: the size of the whole file in bytes.
+        @param crc: if given, the CRC16 of the whole file, checked by
+            commitUpload.
+        @param checksum: the name of the checksum of crc and of the chunks,
+            one of those returned by checksums. By default crc16.
+        @return: a JSON-RPC Object with the keys session, the id to pass to
+            the other upload methods, and chunkSize and maxChunkSize.
+        
+        """
+        
+        size = int(size)
+        if size < 0:
+            raise InvalidParametersError('size must not be negative')
+        getChecksum(checksum)
+        checksum = checksum or DEFAULT_CHECKSUM
+        
+        cfg = self.getConfig(file)
+        if cfg['readonly']:
+            raise ApplicationError('IOError: %s is read-only' % file)
+        if self.getUploadPlugin(cfg) == None:
+            self.getUploadTarget(cfg, file)
+        
+        staging = os.path.join(cfg['rootpath'], STAGING_DIR)
+        self.expireUploads(staging)
+        session = UploadSession.create(staging, file, size, crc, checksum)
+        self.uploadsLock.acquire()
+        try:
+            self.uploads[session.id] = session
+        finally:
+            self.uploadsLock.release()
+        
+        return {'session': session.id,
+                'chunkSize': CHUNK_SIZE,
+                'maxChunkSize': MAX_CHUNK_SIZE}
+    
+    @serviceProcedure(summary="Uploads one chunk of a file to an upload session.",
+                      params=[String('session'), Number('offset'), String('data'), Number('crc'), Boolean('compressed'), String('checksum')],
+                      ret=Object())
+    def uploadChunk(self, session, offset, data, crc, compressed = False, checksum = None):
+        """Uploads one chunk of a file to an upload session.
+        
+        Chunks can be sent in any order, and sent again.
+        
+        @param session: the session id returned by beginUpload.
+        @param offset: the offset of the chunk in the file.
+        @param data: the chunk in base64 format.
+        @param crc: the CRC16 of the chunk, before compression.
+        @param compressed: if True the data will be decompressed with zlib.
+        @param checksum: the name of the checksum crc is, by default the one
+            of the session.
+        @return: a JSON-RPC Object with the keys received, the number of bytes
+            of the file received so far, and complete. Under a multi-process
+            server these only count the chunks received by this process,
+            uploadStatus counts them all.
+        
+        """
+        
+        upload = self.getUpload(session)
+        offset = int(offset)
+        computeCRC = getChecksum(checksum or upload.checksum)
+        
+        data = base64.b64decode(data)
+        if compressed:
+            data = zlib.decompress(data)
+        if computeCRC(data) != crc:
+            self.log.debug('FileTransfer.uploadChunk: crc values did not match for chunk %d of %s' % (offset, upload.file))
+            raise JSONRPCAssertionError('crc value does not match')
+        if offset < 0 or offset + len(data) > upload.size:
+            raise InvalidParametersError('chunk of %d bytes at %d is outside %s (%d bytes)' % (len(data), offset, upload.file, upload.size))
+        
+        received = upload.write(offset, data)
+        return {'received': received, 'complete': received == upload.size}
+    
+    @serviceProcedure(summary="Returns the progress of an upload session, to resume it.",
+                      params=[String('session')],
+                      ret=Object())
+    def uploadStatus(self, session):
+        """Returns the progress of an upload session, to resume it.
+        
+        @param session: the session id returned by beginUpload.
+        @return: a JSON-RPC Object with the keys session, file, size,
+            checksum (the name of the session's checksum), received (bytes), ranges (an Array of [start, end] byte ranges
+            received) and complete.
+        
+        """
+        
+        status = self.getUpload(session).status()
+        if status == None:
+            # committed or aborted by another process
+            self.dropUpload(session)
+            raise ApplicationError('No upload session %s' % session)
+        return status
+    
+    @serviceProcedure(summary="Finishes an upload session, replacing the file with the uploaded one.",
+                      params=[String('session')],
+                      ret=Object())
+    def commitUpload(self, session):
+        """Finishes an upload session, replacing the file with the uploaded one.
+        
+        The uploaded file is renamed over the target, so readers see either
+        the old or the new file, never part of one.
+        
+        @param session: the session id returned by beginUpload.
+        @return: a JSON-RPC Object with the keys file, size and crc.
+        
+        """
+        
+        upload = self.getUpload(session)
+        upload.lock.acquire()
+        try:
+            # the chunks may have been written by other processes
+            if not upload.reload():
+                self.dropUpload(session)
+                raise ApplicationError('No upload session %s' % session)
+            if not upload.complete():
+                raise ApplicationError('%d of %d bytes of %s have been received' % (upload.receivedBytes(), upload.size, upload.file))
+            crc = upload.partCRC()
+            if upload.crc != None and crc != upload.crc:
+                self.log.debug('FileTransfer.commitUpload: crc values did not match for %s' % upload.file)
+                raise JSONRPCAssertionError('crc value does not match')
+            
+            cfg = self.getConfig(upload.file)
+            plugin = self.getUploadPlugin(cfg)
+            if plugin != None:
+                f = open(upload.partPath, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                plugin.upload(cfg['head'], cfg['tail'], data, cfg['rootpath'])
+                upload.remove()
+            else:
+                path = self.getUploadTarget(cfg, upload.file)
+                f = open(upload.partPath, 'r+b')
+                try:
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                if os.name == 'nt' and os.path.exists(path):
+                    # rename can't replace a file on windows
+                    os.remove(path)
+                os.rename(upload.partPath, path)
+                upload.remove()
+                self.fileChanged(path)
+        finally:
+            upload.lock.release()
+        
+        self.dropUpload(session)
+        # chunks of the old file must not be served from its read ahead buffer
+        self.sourcesLock.acquire()
+        try:
+            source = self.sources.pop(upload.file, None)
+        finally:
+            self.sourcesLock.release()
+        if source != None:
+            source.close()
+        
+        return {'file': upload.file, 'size': upload.size, 'crc': crc}
+    
+    @serviceProcedure(summary="Abandons an upload session, leaving the file unchanged.",
+                      params=[String('session')],
+                      ret=None)
+    def abortUpload(self, session):
+        """Abandons an upload session, leaving the file unchanged.
+        
+        @param session: the session id returned by beginUpload.
+        
+        """
+        
+        upload = self.getUpload(session)
+        self.dropUpload(session)
+        upload.lock.acquire()
+        try:
+            upload.remove()
+        finally:
+            upload.lock.release()
+    
+    @serviceProcedure(summary="Returns a token to download part of a file as raw bytes over the binary channel.",
+                      params=[String('file'), Number('offset'), Number('length'), String('checksum')],
+                      ret=Object())
+    def openBinaryDownload(self, file, offset = 0, length = None, checksum = None):
+        """Returns a token to download part of a file as raw bytes over the binary channel.
+        
+        This avoids the base64 encoding of downloadChunk, a third less data
+        to send. The channel is only available if a port is configured for it
+        with file.binary.port. The client connects to that port, sends the
+        token, and receives the data as frames each checked with a CRC16, see
+        jsonrpc.binarychannel. The token can be used once, within a minute.
+        
+        @param file: path of the file to download.
+        @param offset: the offset in bytes of the data.
+        @param length: the number of bytes to download, by default the rest of
+            the file.
+        @param checksum: the name of the checksum of the frames, by default
+            crc16.
+        @return: a JSON-RPC Object with keys token, port (of the binary
+            channel), offset, length (which is shorter if the file ends
+            first), and size and mtime of the file.
+        
+        """
+        
+        computeCRC = getChecksum(checksum)
+        offset = int(offset)
+        source = self.getSource(file)
+        if offset < 0 or offset > source.size:
+            raise InvalidParametersError('offset %d is outside %s (%d bytes)' % (offset, file, source.size))
+        if length == None:
+            length = source.size - offset
+        length = min(int(length), source.size - offset)
+        if length < 0:
+            raise InvalidParametersError('length must not be negative')
+        
+        server = self.getBinaryServer()
+        token = server.channel.offerDownload(source.read, offset, length, checksum=computeCRC)
+        return {'token': token,
+                'port': server.server_address[1],
+                'offset': offset,
+                'length': length,
+                'size': source.size,
+                'mtime': source.mtime}
+    
+    @serviceProcedure(summary="Returns a token to upload part of a file in an upload session as raw bytes over the binary channel.",
+                      params=[String('session'), Number('offset'), Number('length'), String('checksum')],
+                      ret=Object())
+    def openBinaryUpload(self, session, offset = 0, length = None, checksum = None):
+        """Returns a token to upload part of a file in an upload session as raw bytes over the binary channel.
+        
+        The client connects to the port of the channel, sends the token and
+        then the data as frames each with a CRC16. Every frame is written
+        like a chunk sent to uploadChunk, so an interrupted transfer is
+        resumed from uploadStatus, and the upload is finished with
+        commitUpload.
+        
+        @param session: the session id returned by beginUpload.
+        @param offset: the offset in the file of the data.
+        @param length: the most bytes that will be sent, by default the rest
+            of the file.
+        @param checksum: the name of the checksum of the frames, by default
+            the one of the session.
+        @return: a JSON-RPC Object with keys token, port (of the binary
+            channel), offset, length and maxFrameSize.
+        
+        """
+        
+        upload = self.getUpload(session)
+        computeCRC = getChecksum(checksum or upload.checksum)
+        offset = int(offset)
+        if offset < 0 or offset > upload.size:
+            raise InvalidParametersError('offset %d is outside %s (%d bytes)' % (offset, upload.file, upload.size))
+        if length == None:
+            length = upload.size - offset
+        length = int(length)
+        if length < 0 or offset + length > upload.size:
+            raise InvalidParametersError('%d bytes at %d is outside %s (%d bytes)' % (length, offset, upload.file, upload.size))
+        
+        server = self.getBinaryServer()
+        token = server.channel.acceptUpload(upload.write, offset, length, checksum=computeCRC)
+        return {'token': token,
+                'port': server.server_address[1],
+                'offset': offset,
+                'length': length,
+                'maxFrameSize': server.channel.maxFrameSize}
+    
+    @serviceProcedure(summary="Returns the names of the checksums the checksum parameter of the other methods accepts.",
+                      ret=Array())
+    def checksums(self):
+        """Returns the names of the checksums the checksum parameter of the other methods accepts.
+        
+        crc16 is used when no checksum is given. crc32 and adler32 are much
+        faster for the server to compute, so clients that support them should
+        use them for large files.
+        
+        @return: an Array of the names, the default first.
+        
+        """
+        
+        return checksumNames()
+    
+    @serviceProcedure(summary="Returns the hit and miss counts and size of the cache of encoded downloads.",
+                      ret=Object())
+    def downloadCacheStats(self):
+        """Returns the hit and miss counts and size of the cache of encoded downloads.
+        
+        @return: a JSON-RPC Object with the keys hits, misses, hitRatio,
+            evictions, invalidations, uncacheable (results larger than the
+            cache), entries, bytes and maxBytes, or null if the cache is
+            disabled.
+        
+        """
+        
+        if self.payloads == None:
+            return None
+        return self.payloads.stats()
+    
+    @serviceProcedure(summary="Returns the progress of the background compression of served files.",
+                      ret=Object())
+    def precompressStats(self):
+        """Returns the progress of the background compression of served files.
+        
+        @return: a JSON-RPC Object with the keys scans, compressed (files),
+            removed (copies of deleted files), errors, hits and misses (of
+            compressed downloads), and scheduled (changed files waiting to be
+            compressed), or null if precompression is not configured.
+        
+        """
+        
+        if self.precompressor == None:
+            return None
+        return self.precompressor.stats()
     
     @serviceProcedure(summary="Returns a directory listing of the given path.",
                       params=[String('path')],
@@ -208,32 +1116,246 @@ class FileTransfer(Plugin):
         
         """
         
-        cfg = getConfig(path)
+        cfg = self.getConfig(path)
         list_plugins = dict([[x.__class__.__name__, x] for x in self.listdir_plugins])
         for plugin in cfg['plugins']:
             if list_plugins.has_key(plugin):
                 plugin = list_plugins[plugin]
-                data = plugin.listDir(cfg['head'], cfg['tail'], cfg['rootpath'])
-                break
+                return plugin.listDir(cfg['head'], cfg['tail'], cfg['rootpath'])
             else:
                 self.log.debug("FileTransfer.listDir: Skipping plugin %s, not found" % plugin)
         else:   # default listDir handling
-            path = os.path.normpath(os.path.join(cfg['rootpath'], cfg['tail']))
-            if not os.path.exists(path):
+            localPath = self.getLocalPath(cfg, path)
+            if not os.path.exists(localPath):
                 raise ApplicationError('IOError: No such file or directory: %s' % path)
-            if not os.isdir(path):
+            if not os.path.isdir(localPath):
                 raise ApplicationError('IOError: %s is not a directory' % path)
             
             out = []
-            for i in os.listdir(path):
+            for i in os.listdir(localPath):
+                if i in (STAGING_DIR, PRECOMPRESS_DIR):
+                    continue
                 name = i
-                size = os.path.getsize(os.path.join(path, i))
-                isdir = os.path.isdir(os.path.join(path, i))
-                readonly = os.access(os.path.join(path, i), os.W_OK)
+                size = os.path.getsize(os.path.join(localPath, i))
+                isdir = os.path.isdir(os.path.join(localPath, i))
+                readonly = not os.access(os.path.join(localPath, i), os.W_OK)
                 out.append(makeDirectoryEntry(name, size, isdir, readonly))
                 
             return out
             
+    def getDownloadPlugin(self, cfg):
+        """Return the download plugin that handles the path with the configuration cfg, or None."""
+        
+        dl_plugins = dict([[x.__class__.__name__, x] for x in self.download_plugins])
+        for plugin in cfg['plugins']:
+            if dl_plugins.has_key(plugin):
+                plugin = dl_plugins[plugin]
+                if plugin.handles(cfg['head'], cfg['tail']):
+                    return plugin
+            else:
+                self.log.debug("FileTransfer.download: Skipping plugin %s, not found" % plugin)
+        return None
+    
+    def getLocalPath(self, cfg, file):
+        """Return the local path of the requested file, which must be inside its rootpath.
+        
+        Every local path of a request is found with this, so a path with
+        .. components, or an absolute tail, can't reach outside the served
+        directories. The upload staging and precompressed directories kept
+        in a rootpath are hidden, as if they did not exist, so half written
+        uploads of other sessions can't be read.
+        
+        """
+        
+        root = os.path.normpath(cfg['rootpath'])
+        path = os.path.normpath(os.path.join(root, cfg['tail']))
+        if path != root and not path.startswith(root.rstrip(os.sep) + os.sep):
+            raise ApplicationError('IOError: Permission denied: %s is outside the served directories' % file)
+        for name in path[len(root):].split(os.sep):
+            if name in (STAGING_DIR, PRECOMPRESS_DIR):
+                raise ApplicationError('IOError: No such file or directory: %s' % file)
+        return path
+    
+    def getLocalFile(self, cfg, file):
+        """Return the local path of the requested file, which must exist and not be a directory."""
+        
+        path = self.getLocalPath(cfg, file)
+        if not os.path.exists(path):
+            raise ApplicationError('IOError: No such file or directory: %s' % file)
+        if not os.path.isfile(path):
+            raise ApplicationError('IOError: %s is a directory' % file)
+        return path
+    
+    def getUploadPlugin(self, cfg):
+        """Return the upload plugin that handles the path with the configuration cfg, or None."""
+        
+        ul_plugins = dict([[x.__class__.__name__, x] for x in self.upload_plugins])
+        for plugin in cfg['plugins']:
+            if ul_plugins.has_key(plugin):
+                plugin = ul_plugins[plugin]
+                if plugin.handles(cfg['head'], cfg['tail']):
+                    return plugin
+            else:
+                self.log.debug("FileTransfer.upload: Skipping plugin %s, not found" % plugin)
+        return None
+    
+    def getUploadTarget(self, cfg, file):
+        """Return the local path an upload of file is written to, whose directory must exist."""
+        
+        path = self.getLocalPath(cfg, file)
+        if os.path.isdir(path):
+            raise ApplicationError('IOError: %s is a directory' % file)
+        if not os.path.isdir(os.path.dirname(path)):
+            raise ApplicationError('IOError: No such directory: %s' % os.path.dirname(file))
+        return path
+    
+    def getUpload(self, id):
+        """Return the UploadSession id, loading it from its journal if another process started it."""
+        
+        self.uploadsLock.acquire()
+        try:
+            session = self.uploads.get(id)
+            if session != None:
+                return session
+            
+            # the id is a hex string, so it can't name a path outside staging
+            if id.isalnum():
+                for staging in self.stagingDirs():
+                    session = UploadSession.load(id, staging)
+                    if session != None:
+                        self.uploads[id] = session
+                        return session
+        finally:
+            self.uploadsLock.release()
+        raise ApplicationError('No upload session %s' % id)
+    
+    def dropUpload(self, id):
+        """Forget the UploadSession id, after it has been committed or aborted."""
+        
+        self.uploadsLock.acquire()
+        try:
+            self.uploads.pop(id, None)
+        finally:
+            self.uploadsLock.release()
+    
+    def rootPaths(self):
+        """Return the absolute paths of every configured rootpath."""
+        
+        cfg = self.config.get('file', {})
+        roots = [cfg.get('rootpath', 'servdocs')]
+        for d in cfg.get('directories', {}).values():
+            if d.has_key('rootpath'):
+                roots.append(d['rootpath'])
+        roots = [os.path.abspath(x) for x in roots]
+        # a rootpath can be configured for more than one directory
+        return [x for i, x in enumerate(roots) if x not in roots[:i]]
+    
+    def stagingDirs(self):
+        """Return the staging directories of every configured rootpath."""
+        
+        return [os.path.join(x, STAGING_DIR) for x in self.rootPaths()]
+    
+    def expireUploads(self, staging):
+        """Remove the sessions in staging that have not been used for UPLOAD_TTL seconds."""
+        
+        if not os.path.isdir(staging):
+            return
+        expired = time.time() - UPLOAD_TTL
+        for name in os.listdir(staging):
+            path = os.path.join(staging, name)
+            if os.path.getmtime(path) < expired:
+                self.uploadsLock.acquire()
+                try:
+                    self.uploads.pop(os.path.splitext(name)[0], None)
+                finally:
+                    self.uploadsLock.release()
+                os.remove(path)
+    
+    def getBinaryServer(self):
+        """Return the BinaryChannelServer binary transfers are made on, starting it the first time.
+        
+        The channel is opt in, it is configured by file.binary with the keys
+        port and host (all interfaces by default). It is not available in the
+        workers of a PreforkServiceServer: each would try to bind the port,
+        and a token issued by one worker is unknown to the others.
+        
+        """
+        
+        self.binaryLock.acquire()
+        try:
+            if self.binaryServer == None:
+                cfg = self.config.get('file', {}).get('binary', {})
+                if not cfg.has_key('port'):
+                    raise ApplicationError('The binary channel is not enabled')
+                if isWorkerProcess():
+                    raise ApplicationError('The binary channel is not available when the server runs '
+                                           'several processes, use downloadChunk and uploadChunk')
+                channel = BinaryChannel(getChecksum(DEFAULT_CHECKSUM), BINARY_FRAME_SIZE, MAX_CHUNK_SIZE)
+                server = BinaryChannelServer((cfg.get('host', ''), int(cfg['port'])), channel)
+                t = threading.Thread(target=server.serve_forever, name='FileTransfer-binary')
+                t.setDaemon(True)
+                t.start()
+                self.log.info('FileTransfer: binary channel listening on port %d' % server.server_address[1])
+                self.binaryServer = server
+            return self.binaryServer
+        finally:
+            self.binaryLock.release()
+    
+    def fileChanged(self, path):
+        """Update the caches of the local file path after it was written.
+        
+        Its cached downloads are removed, changed files are never served from
+        the cache but this frees the memory of their old contents straight
+        away, and it is compressed again without waiting for the next scan.
+        
+        """
+        
+        if self.payloads != None:
+            self.payloads.invalidate(path)
+        if self.precompressor != None:
+            self.precompressor.schedule(path)
+    
+    def getSource(self, file):
+        """Return the FileSource or DataSource chunks of the requested file are read from.
+        
+        Sources are kept for the MAX_SOURCES files used most recently, so
+        each chunk does not open the file or run the download plugin again.
+        
+        """
+        
+        cfg = self.getConfig(file)
+        plugin = self.getDownloadPlugin(cfg)
+        
+        self.sourcesLock.acquire()
+        try:
+            source = self.sources.get(file)
+        finally:
+            self.sourcesLock.release()
+        
+        if plugin != None:
+            if not isinstance(source, DataSource) or source.expires < time.time():
+                source = DataSource(plugin.download(cfg['head'], cfg['tail'], cfg['rootpath']))
+        else:
+            path = self.getLocalFile(cfg, file)
+            st = os.stat(path)
+            if not isinstance(source, FileSource) or not source.current(path, st):
+                source = FileSource(path, st)
+        source.lastUsed = time.time()
+        
+        self.sourcesLock.acquire()
+        try:
+            old = self.sources.get(file)
+            self.sources[file] = source
+            if old != None and old is not source:
+                old.close()
+            while len(self.sources) > MAX_SOURCES:
+                name = min(self.sources, key=lambda x: self.sources[x].lastUsed)
+                self.sources.pop(name).close()
+        finally:
+            self.sourcesLock.release()
+        
+        return source
+    
     def getConfig(self, path):
         """Get the configuration for the supplied path.
         
@@ -82,7 +82,7 @@ class ExtensionPoint(property):
         point interface.
         """
         extensions = PluginMeta._registry.get(self.interface, [])
-        return filter(None, [plugin.pluginmgr[cls] for cls in extensions])
+        return filter(None, [plugin.plugmgr[cls] for cls in extensions])
 
     def __repr__(self):
         """Return a textual representation of the extension point."""
@@ -198,6 +198,7 @@ class PluginManager(object):
         """Initialize the plugin manager."""
         self.plugins = {}
         self.enabled = {}
+        self.enabled_version = 0
         if isinstance(self, Plugin):
             self.plugins[self.__class__] = self
 
@@ -210,7 +211,7 @@ class PluginManager(object):
         existing the instance if the plugin has already been activated.
         """
         if cls not in self.enabled:
-            self.enabled[cls] = self.is_plugin_enabled(cls)
+            self.set_enabled(cls, self.is_plugin_enabled(cls))
         if not self.enabled[cls]:
             return None
         plugin = self.plugins.get(cls)
@@ -224,6 +225,16 @@ class PluginManager(object):
                                 (cls, e))
         return plugin
 
+    def set_enabled(self, cls, enabled):
+        """Set whether the given plugin class (or module name) is enabled.
+
+        Every change increments `enabled_version`, so that anything caching
+        the enabled plugins can tell when it needs to be rebuilt.
+        """
+        if self.enabled.get(cls) != enabled:
+            self.enabled[cls] = enabled
+            self.enabled_version += 1
+
     def plugin_activated(self, plugin):
         """Can be overridden by sub-classes so that special initialization for
         plugins can be provided.
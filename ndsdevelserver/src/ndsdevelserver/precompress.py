@@ -0,0 +1,301 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Background compression of the files in the served directories.
+
+A Precompressor keeps a zlib compressed copy and the checksums of every file
+under its roots in a sidecar store, the PRECOMPRESS_DIR directory of each
+root, so compressed downloads don't compress on the request thread. A worker
+thread scans the roots every interval seconds, compressing new and changed
+files and removing the copies of deleted ones.
+
+"""
+
+__all__ = ['Precompressor', 'PRECOMPRESS_DIR']
+
+import os
+import threading
+import time
+import zlib
+
+from jsonrpc import defaultCodec
+from checksum import Checksum, checksumNames
+
+# the directory, in each root, the compressed files are stored in
+PRECOMPRESS_DIR = '.precompressed'
+# default seconds between scans of the roots
+PRECOMPRESS_INTERVAL = 300.0
+# default zlib compression level
+PRECOMPRESS_LEVEL = 6
+# default size in bytes of the smallest file compressed, smaller ones are
+# quick enough to compress when they are requested
+PRECOMPRESS_MIN_SIZE = 1024
+# bytes of a file read at once
+READ_SIZE = 256 * 1024
+
+class Precompressor(object):
+    """Keeps compressed copies and checksums of the files under roots up to date."""
+
+    def __init__(self, roots, log, interval = PRECOMPRESS_INTERVAL, level = PRECOMPRESS_LEVEL,
+                 minSize = PRECOMPRESS_MIN_SIZE, skip = ()):
+        """Precompressor initialization.
+
+        @param roots: the absolute paths of the directories to compress the
+            files of.
+        @param log: the logger errors are reported to.
+        @param skip: names of directories whose files are not compressed,
+            such as the staging directory of uploads.
+
+        """
+
+        self.roots = [os.path.normpath(x) for x in roots]
+        self.log = log
+        self.interval = interval
+        self.level = level
+        self.minSize = minSize
+        self.skip = set(skip) | set([PRECOMPRESS_DIR])
+        self.codec = defaultCodec()
+
+        self.lock = threading.Lock()
+        self.scheduled = set()  # paths to compress before the next scan
+        self.wake = threading.Event()
+        self.thread = None
+        self.stopped = False
+        self.resetStats()
+
+    def resetStats(self):
+        self.scans = 0
+        self.compressed = 0
+        self.removed = 0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """Start the worker thread, which scans the roots straight away."""
+
+        self.thread = threading.Thread(target=self.run, name='Precompressor')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self, timeout = None):
+        self.stopped = True
+        self.wake.set()
+        if self.thread != None:
+            self.thread.join(timeout)
+
+    def schedule(self, path):
+        """Have the file at path compressed soon, after it was changed."""
+
+        self.lock.acquire()
+        try:
+            self.scheduled.add(path)
+        finally:
+            self.lock.release()
+        self.wake.set()
+
+    def run(self):
+        nextScan = 0
+        while not self.stopped:
+            self.lock.acquire()
+            try:
+                paths = self.scheduled
+                self.scheduled = set()
+            finally:
+                self.lock.release()
+            for path in paths:
+                self.refresh(path)
+
+            if time.time() >= nextScan:
+                self.scan()
+                nextScan = time.time() + self.interval
+
+            self.wake.wait(max(0, nextScan - time.time()))
+            self.wake.clear()
+
+    def scan(self):
+        """Bring the stores of every root up to date with their files."""
+
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                # at any depth, as a root can be inside another
+                dirnames[:] = [x for x in dirnames if x not in self.skip]
+                for name in filenames:
+                    if self.stopped:
+                        return
+                    self.refresh(os.path.join(dirpath, name))
+            self.removeOrphans(root)
+        self.scans += 1
+
+    def removeOrphans(self, root):
+        """Remove the compressed copies of the files under root that no longer exist."""
+
+        store = os.path.join(root, PRECOMPRESS_DIR)
+        for dirpath, dirnames, filenames in os.walk(store):
+            for name in filenames:
+                if not name.endswith('.json'):
+                    continue
+                source = os.path.join(root, os.path.relpath(os.path.join(dirpath, name[:-5]), store))
+                if not os.path.isfile(source):
+                    for ext in ('.json', '.z'):
+                        self.removeFile(os.path.join(dirpath, name[:-5] + ext))
+                    self.removed += 1
+
+    def removeFile(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def sidecar(self, path):
+        """Return the path, without extension, of the compressed copy of path, or None if it is not under a root."""
+
+        path = os.path.normpath(path)
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                rel = path[len(root) + 1:]
+                if [x for x in rel.split(os.sep)[:-1] if x in self.skip]:
+                    return None
+                return os.path.join(root, PRECOMPRESS_DIR, rel)
+        return None
+
+    def readMeta(self, sidecar):
+        try:
+            f = open(sidecar + '.json')
+        except IOError:
+            return None
+        try:
+            try:
+                return self.codec.decode(f.read())
+            except Exception:
+                # a copy being written when the server stopped
+                return None
+        finally:
+            f.close()
+
+    def refresh(self, path):
+        """Compress the file at path again if its copy is missing or out of date."""
+
+        sidecar = self.sidecar(path)
+        if sidecar == None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if st.st_size < self.minSize:
+            return
+        meta = self.readMeta(sidecar)
+        if meta != None and meta['size'] == st.st_size and meta['mtime'] == st.st_mtime:
+            return
+
+        try:
+            self.compress(path, st, sidecar)
+        except (IOError, OSError), e:
+            self.errors += 1
+            self.log.warning('Precompressor: could not compress %s: %s' % (path, e))
+
+    def compress(self, path, st, sidecar):
+        directory = os.path.dirname(sidecar)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        checksums = [Checksum(name) for name in checksumNames()]
+        compressor = zlib.compressobj(self.level)
+        tmp = '%s.z.%d.tmp' % (sidecar, os.getpid())
+        out = open(tmp, 'wb')
+        try:
+            f = open(path, 'rb')
+            try:
+                while 1:
+                    data = f.read(READ_SIZE)
+                    if not data:
+                        break
+                    for c in checksums:
+                        c.update(data)
+                    out.write(compressor.compress(data))
+            finally:
+                f.close()
+            out.write(compressor.flush())
+        finally:
+            out.close()
+
+        # the file changed while it was read, it is compressed on the next scan
+        after = os.stat(path)
+        if after.st_size != st.st_size or after.st_mtime != st.st_mtime:
+            os.remove(tmp)
+            return
+
+        meta = {'size': st.st_size,
+                'mtime': st.st_mtime,
+                'compressedSize': os.path.getsize(tmp),
+                'checksums': dict([(c.name, c.val) for c in checksums])}
+        # the metadata is removed first and written last, so it only
+        # describes a complete copy
+        self.removeFile(sidecar + '.json')
+        if os.name == 'nt' and os.path.exists(sidecar + '.z'):
+            # rename can't replace a file on windows
+            os.remove(sidecar + '.z')
+        os.rename(tmp, sidecar + '.z')
+        tmp = '%s.json.%d.tmp' % (sidecar, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            f.write(self.codec.encode(meta))
+        finally:
+            f.close()
+        os.rename(tmp, sidecar + '.json')
+        self.compressed += 1
+
+    def lookup(self, path, st, checksum):
+        """Return the compressed contents of the file at path and its checksum, or None.
+
+        None is returned unless there is an up to date copy of the file with
+        the stat st.
+
+        """
+
+        sidecar = self.sidecar(path)
+        meta = sidecar != None and self.readMeta(sidecar)
+        if not meta or meta['size'] != st.st_size or meta['mtime'] != st.st_mtime or \
+                not meta['checksums'].has_key(checksum):
+            self.misses += 1
+            return None
+        try:
+            f = open(sidecar + '.z', 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if len(data) != meta['compressedSize']:
+            # replaced while it was read
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data, meta['checksums'][checksum]
+
+    def stats(self):
+        """Return the counts of the work done and downloads served as a dictionary."""
+
+        return {'scans': self.scans,
+                'compressed': self.compressed,
+                'removed': self.removed,
+                'errors': self.errors,
+                'hits': self.hits,
+                'misses': self.misses,
+                'scheduled': len(self.scheduled)}
@@ -31,11 +31,8 @@ class RPCLogging(Plugin):
     
     implements(IRPCService)
     
-    def __init__(self, env):
-        #setup logs from config file
-        self.env = env
-        self.config = env.config
-        self.log = env.log
+    def __init__(self):
+        #setup logs from config file, env and config are set by the Environment
         
         # make sure the directory exists for the default log path
         path = self.config.get('logging', {}).get('default', {}).get('path', None)
@@ -49,10 +46,11 @@ class RPCLogging(Plugin):
         for log in self.config.get('logging', {}).get('logs', {}):
             self.setup_log(log)
 
-    @serviceProcedure(summary="Logs a message to the named logger with a given log level.",
+    # not named log, as that is the logger the Environment gives every plugin
+    @serviceProcedure(name='log', summary="Logs a message to the named logger with a given log level.",
                       params=[String('name'), Number('level'), String('message')],
                       ret=None)
-    def log(self, name, level, message):
+    def logMessage(self, name, level, message):
         """Logs a message to the named logger with a given log level."""
         
         if not isinstance(name, (str, unicode)) and \
@@ -12,10 +12,12 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-__all__ = ['ServicePluginHandler', 'IRPCService']
+__all__ = ['ServicePluginHandler', 'IRPCService', 'servicePluginHandlerFactory']
 
-from jsonrpc import ServiceHandler, ServiceHolder, niceJSON
-from plugin import Plugin, ExtensionPoint, Interface
+from jsonrpc import ServiceHandler, ServiceHolder, routeNamespace
+from jsonrpc.base import MAX_BATCH_SIZE
+from plugin import Plugin, PluginMeta, ExtensionPoint, Interface
+from enviroment import Environment
 
 class IRPCService(Interface):
     """Plugin Interface for Service plugins."""
@@ -26,63 +28,85 @@ class ServicePluginHandler(ServiceHandler):
     service_plugins = ExtensionPoint(IRPCService)
     
     def __init__(self, name, env, id = None, version = None, summary = None,
-                 help = None, json = niceJSON(True), sysServices = True):
+                 help = None, json = None, sysServices = True,
+                 batchExecutor = None, maxBatchSize = MAX_BATCH_SIZE,
+                 metrics = True, profileDir = None, resultCache = None,
+                 notificationExecutor = None):
         ServiceHandler.__init__(self, name, id, version, summary, help, json,
-                                sysServices)
+                                sysServices, batchExecutor, maxBatchSize, metrics,
+                                profileDir, resultCache, notificationExecutor)
         self.env = env
+        # lets plugins invalidate cached results with env.invalidate_results
+        env.add_result_cache_handler(self)
+        # lets service_plugins find the plugins enabled in env
+        self.plugmgr = env
+        
+        self._pluginServices = {}
+        self._pluginServicesKey = None
     
-    def findServiceEndpoint(self, name):
-        """Overrides ServiceHandler.findServiceEndpoint to first check plugins.
+    def pluginServices(self):
+        """Return a dictionary mapping service names to a ServiceHolder for
+        each enabled IRPCService plugin.
         
-        If a plugin is not found that matches the service endpoint then the
-        base method is called.
+        The dictionary is cached, and only rebuilt when the set of enabled
+        plugins in the environment, or the set of IRPCService plugin classes,
+        changes.
         
         """
         
-        for plugin in self.service_plugins.extensions(self.env):
-            sh = ServiceHolder(plugin)
-            if name.startswith(sh.name) and name[len(sh.name)] == '.':
-                return sh
+        if self._pluginServicesKey != self.pluginServicesKey():
+            services = {}
+            for plugin in self.service_plugins:
+                sh = ServiceHolder(plugin)
+                services[sh.name] = sh
+            self._pluginServices = services
+            # activating the plugins can fill in the enabled set, so take the
+            # version afterwards
+            self._pluginServicesKey = self.pluginServicesKey()
         
-        return ServiceHandler.findServiceEndpoint(self, name)
+        return self._pluginServices
     
-    def listMethods(self):
-        """Overrides ServiceHandler.listMethods to add methods supplied by plugins."""
-        
-        methods = ServiceHandler.listMethods(self)
-        for plugin in self.service_plugins.extensions(self.env):
-            methods.extend(ServiceHolder(plugin).listMethods())
+    def pluginServicesKey(self):
+        """Return a value that changes when the enabled IRPCService plugins may have."""
         
-        return methods
+        return (self.env.enabled_version, len(PluginMeta._registry.get(IRPCService, [])))
     
-    def methodSignature(self, name):
-        """Overrides ServiceHandler.methodSignature to return method signatures supplied by plugins."""
+    def findService(self, name):
+        """Overrides ServiceHandler.findService to first check plugins.
         
-        for plugin in self.service_plugins.extensions(self.env):
-            sh = ServiceHolder(plugin)
-            if name.startswith(sh.name) and name[len(sh.name)] == '.':
-                return sh.methodSignature(name[len(sh.name)+1:])
+        If a plugin is not found that matches the service endpoint then the
+        base method is called.
         
-        return ServiceHandler.methodSignature(self, name)
-    
-    def methodHelp(self, name):
-        """Overrides ServiceHandler.methodHelp to return help on methods supplied by plugins."""
+        """
         
-        for plugin in self.service_plugins.extensions(self.env):
-            sh = ServiceHolder(plugin)
-            if name.startswith(sh.name) and name[len(sh.name)] == '.':
-                return sh.methodHelp(name[len(sh.name)+1:])
+        service, mname = routeNamespace(self.pluginServices(), name)
+        if service == None:
+            return ServiceHandler.findService(self, name)
         
-        return ServiceHandler.methodHelp(self, name)
+        return service, mname
     
-    def describe(self):
-        """Overrides ServiceHandler.describe to return help on methods supplied by plugins."""
+    def serviceHolders(self):
+        """Overrides ServiceHandler.serviceHolders to add the services supplied by plugins."""
         
-        obj = ServiceHandler.describe(self)
-        procs = obj.setdefault('procs', [])
-        for plugin in self.service_plugins.extensions(self.env):
-            sh = ServiceHolder(plugin)
-            procs.extend(sh.methodDescriptions())
-        
-        return obj
+        return ServiceHandler.serviceHolders(self) + self.pluginServices().values()
+    
+    def introspectionKey(self):
+        """Overrides ServiceHandler.introspectionKey to include plugin enable changes."""
         
+        # build the plugin services first, as that can change the key
+        self.pluginServices()
+        return (ServiceHandler.introspectionKey(self), self._pluginServicesKey)
+
+def servicePluginHandlerFactory(name, **kwargs):
+    """Return a function that builds a ServicePluginHandler in a new Environment.
+    
+    This is the handlerFactory for a jsonrpc PreforkServiceServer, so that
+    every worker process loads its own configuration and plugins. kwargs are
+    passed on to ServicePluginHandler.
+    
+    """
+    
+    def factory():
+        return ServicePluginHandler(name, Environment(), **kwargs)
+    
+    return factory
@@ -45,6 +45,7 @@ class Update(Plugin):
     #===============================================================================
     
     @serviceProcedure(summary="returns true if the system supplies a given update, false otherwise.",
+                      idempotent=True,
                       params=[String('name')],
                       ret=Boolean())
     def hasUpdate(self, name):
@@ -58,6 +59,7 @@ class Update(Plugin):
         return (self.getUpdateMetadata(name) != None)
     
     @serviceProcedure(summary="Returns the version of the update system.",
+                      idempotent=True,
                       ret=Array())
     def systemVersion(self):
         """Returns the version of the update system.
@@ -70,6 +72,7 @@ class Update(Plugin):
         return _VERSION
     
     @serviceProcedure(summary="Returns a string representation of the update systems version.",
+                      idempotent=True,
                       ret=String())
     def systemVersionString(self):
         """Returns a string representation of the update systems version.
@@ -81,6 +84,7 @@ class Update(Plugin):
         return "%d.%d" % tuple(_VERSION)
     
     @serviceProcedure(summary="Returns a string representation of the update systems version.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=Array())
     def version(self, update):
@@ -98,6 +102,7 @@ class Update(Plugin):
             return meta['version']
     
     @serviceProcedure(summary="Returns the string representation of the version of a given update.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=String())
     def versionString(self, update):
@@ -115,6 +120,7 @@ class Update(Plugin):
             return '%d.%d' % tuple(meta['version'])\
     
     @serviceProcedure(summary="Returns the meta data of a given update.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=Object())
     def metaData(self, update):
@@ -164,6 +170,7 @@ class Update(Plugin):
         return out
     
     @serviceProcedure(summary="Returns the creation timestamp of a given update.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=Number())
     def timestamp(self, update):
@@ -181,6 +188,7 @@ class Update(Plugin):
         return meta['timestamp']
     
     @serviceProcedure(summary="Returns the creation timestamp of a given update as an ISO 8601 Format string.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=String())
     def timestampString(self, update):
@@ -198,6 +206,7 @@ class Update(Plugin):
         return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(meta['timestamp']))
     
     @serviceProcedure(summary="Returns the description of a given update.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=String())
     def description(self, update):
@@ -215,6 +224,7 @@ class Update(Plugin):
         return meta.get('description', '')
     
     @serviceProcedure(summary="Returns an array of file meta data for a given update.",
+                      idempotent=True,
                       params=[String('update')],
                       ret=Array())
     def files(self, update):
@@ -247,6 +257,7 @@ class Update(Plugin):
         return files
     
     @serviceProcedure(summary="Returns the meta data for file within a given update.",
+                      idempotent=True,
                       params=[String('update'), String('filename')],
                       ret=Object())
     def fileMetaData(self, update, filename):
@@ -280,6 +291,7 @@ class Update(Plugin):
             raise ApplicationError('update %s does not contain file %s' % (update, filename))
     
     @serviceProcedure(summary="Returns the install path for a file within a given update.",
+                      idempotent=True,
                       params=[String('update'), String('filename')],
                       ret=String())
     def filePath(self, update, filename):
@@ -367,16 +379,9 @@ class Update(Plugin):
     # Utility Methods
     #===============================================================================
     
-    def getUpdateMetadata(self, update):
-        """This method returns the metadata for an update.
-        
-        @param update: string containing the name of the update to fetch the metadata for.
-        @return: a dictionary containing Update metadata, if the update exists
-            and is enabled, None otherwise.
-        
-        """
-        
-        path = ''
+    def getUpdatePath(self, update):
+        """Return the path of the directory or archive of an update, or None
+        if the update does not exist or is disabled."""
         
         for update_cfg in self.config.get('update', {}).get('updates', {}):
             if update_cfg['name'] == update:
@@ -386,15 +391,59 @@ class Update(Plugin):
                 path = update_cfg['path']
                 if not os.path.exists(path):
                     return None
-                break
+                return path
+        
+        root = self.config.get('update', {}).get('rootpath', 'updates')
+        for i in os.listdir(root):
+            if i == update:
+                return os.path.join(root, i)
+        return None
+    
+    def _resultStamp(self, name, params):
+        """Return the stamp cached results of the procedure name are checked against.
+        
+        The metadata of an update is read from its update file or archive on
+        every call, and those can be replaced while the server runs, so the
+        results of the procedures taking an update are stamped with the path
+        and mtime of its metadata. An update that doesn't exist is stamped
+        with the mtime of the updates root, which changes when one is added.
+        
+        """
+        
+        if name in ('systemVersion', 'systemVersionString'):
+            return None
+        
+        if isinstance(params, dict):
+            update = params.get('update', params.get('name'))
         else:
-            root = self.config.get('update', {}).get('rootpath', 'updates')
-            for i in os.listdir(root):
-                if i == update:
-                    path = os.path.join(root, i)
-                    break
-            else:
-                return None
+            update = params and params[0] or None
+        if not isinstance(update, basestring):
+            return None
+        
+        try:
+            path = self.getUpdatePath(update)
+            if path == None:
+                root = self.config.get('update', {}).get('rootpath', 'updates')
+                return (None, os.path.getmtime(root))
+            if os.path.isdir(path):
+                path = os.path.join(path, 'update')
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (path, st.st_mtime, st.st_size)
+    
+    def getUpdateMetadata(self, update):
+        """This method returns the metadata for an update.
+        
+        @param update: string containing the name of the update to fetch the metadata for.
+        @return: a dictionary containing Update metadata, if the update exists
+            and is enabled, None otherwise.
+        
+        """
+        
+        path = self.getUpdatePath(update)
+        if path == None:
+            return None
         
         # have a path to a possible update, first check if its a file system update
         # or an archive update
@@ -404,11 +453,11 @@ class Update(Plugin):
                 self.log.debug('update %s does not have an update configuration file' % update)
                 return None
             try:
-                update_meta = load(open(filename), Loader=Loader)
+                update_meta = load(open(update_path), Loader=Loader)
             except:
                 # the CLoader has problems with throwing exceptions so call the python version here to get a meaningful exception
                 try:
-                    load(open(filename))
+                    load(open(update_path))
                 except YAMLError, e:
                     self.log.debug('update %s has invalid configuration file: %s' % (update, str(e)))
                     return None
@@ -14,4 +14,9 @@
 
 from jsonrpcexceptions import *
 from parametertypes import *
+from threadpool import *
+from codec import *
+from cache import *
+from binder import *
 from base import *
+from client import *
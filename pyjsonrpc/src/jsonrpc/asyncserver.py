@@ -0,0 +1,292 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""An event loop JSON-RPC server, for large numbers of connections."""
+
+import asyncore
+import socket
+import select
+import logging
+import time
+import threading
+import collections
+
+from jsonrpcexceptions import JSONRPCError, InternalError
+from framing import JSONFramer, MAX_MESSAGE_SIZE
+from threadpool import ThreadPool
+from socketserver import Connection, ConnectionStats, registerKeepAlive, \
+                         handleConnectionRequest, RECVSIZE, KEEPALIVE_TIMEOUT, \
+                         KEEPALIVE_MAX_REQUESTS
+
+__all__ = ['AsyncServiceServer']
+
+# default number of threads that run procedures
+WORKERS = 8
+# default limit on requests waiting for or running on a worker
+MAX_PENDING = 256
+
+def _socketpair():
+    """Return a pair of connected sockets."""
+
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    # no socketpair on windows, so connect over the loopback interface
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    a.connect(listener.getsockname())
+    b = listener.accept()[0]
+    listener.close()
+    return a, b
+
+class Waker(asyncore.dispatcher):
+    """Wakes the event loop from another thread when requests have finished."""
+
+    def __init__(self, server):
+        a, self.writer = _socketpair()
+        self.writer.setblocking(0)
+        asyncore.dispatcher.__init__(self, a, map=server.map)
+        self.server = server
+
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error:
+            # the buffer is full, so the loop has already been woken
+            pass
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.server.processCompleted()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
+class ServiceChannel(asyncore.dispatcher):
+    """A client connection to an AsyncServiceServer.
+
+    One request per connection is run at a time, further requests already
+    received wait in the framer until the response has been queued.
+
+    """
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.framer = JSONFramer(server.maxMessageSize)
+        self.conn = Connection(server)
+        self.out = ''
+        self.outPos = 0
+        self.busy = False       # a request is running on a worker
+        self.closing = False    # close once the output has been sent
+        self.closed = False
+        self.idleTimeout = False
+        self.lastActive = time.time()
+
+    def readable(self):
+        return not self.busy and not self.closing and \
+               self.server.pending < self.server.maxPending
+
+    def writable(self):
+        return self.outPos < len(self.out)
+
+    def handle_read(self):
+        data = self.recv(RECVSIZE)
+        if data:
+            self.lastActive = time.time()
+            self.framer.feed(data)
+            self.nextRequest()
+
+    def nextRequest(self):
+        """Start running the next buffered request, if there is one."""
+
+        try:
+            json = self.framer.nextMessage()
+        except JSONRPCError, e:
+            logging.getLogger('service').debug('invalid request from %s: %s' % (self.addr[0], e))
+            self.respond(self.server.serviceHandler.translateResult(None, e, None), True)
+            return
+
+        if json != None:
+            self.busy = True
+            self.server.submit(self, json)
+
+    def requestDone(self, ret):
+        """Called from the event loop with the response to the running request."""
+
+        self.busy = False
+        self.conn.requests += 1
+        self.lastActive = time.time()
+        close = not self.conn.keepAlive or self.conn.requests >= self.server.maxRequests
+        self.respond(ret, close)
+        if not close:
+            self.nextRequest()
+
+    def respond(self, data, close = False):
+        if data:
+            if self.outPos == len(self.out):
+                self.out = data
+            else:
+                self.out = self.out[self.outPos:] + data
+            self.outPos = 0
+        if close:
+            self.closing = True
+            if not self.writable():
+                self.close()
+
+    def handle_write(self):
+        self.outPos += self.send(buffer(self.out, self.outPos))
+        if not self.writable():
+            self.out = ''
+            self.outPos = 0
+            if self.closing:
+                self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logging.getLogger('service').exception('error on connection from %s' % (self.addr,))
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.server.connectionStats.connectionClosed(self.conn, self.idleTimeout)
+        asyncore.dispatcher.close(self)
+
+class AsyncServiceServer(asyncore.dispatcher):
+    """A JSON-RPC server that handles every connection on one event loop thread.
+
+    Decoding, dispatch and encoding are done by serviceHandler.handleRequest
+    on a ThreadPool of workers threads, so the event loop never blocks on a
+    procedure. When maxPending requests are waiting for or running on the
+    workers, no more requests are read until some finish.
+
+    Connections that are idle for idleTimeout seconds are closed. The
+    remaining arguments are the same as for TCPServiceServer.
+
+    """
+
+    def __init__(self, server_address, serviceHandler, workers = WORKERS,
+                 maxPending = MAX_PENDING, maxMessageSize = MAX_MESSAGE_SIZE,
+                 keepAlive = False, idleTimeout = KEEPALIVE_TIMEOUT,
+                 maxRequests = KEEPALIVE_MAX_REQUESTS):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(128)
+        self.server_address = self.socket.getsockname()
+
+        self.serviceHandler = serviceHandler
+        self.maxPending = maxPending
+        self.maxMessageSize = maxMessageSize
+        self.keepAlive = keepAlive
+        self.idleTimeout = idleTimeout
+        self.maxRequests = maxRequests
+        self.connectionStats = ConnectionStats()
+
+        self.executor = ThreadPool(workers, name='AsyncServiceServer')
+        self.pending = 0
+        self.completed = collections.deque()
+        self.waker = Waker(self)
+        self.running = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+
+        if keepAlive:
+            registerKeepAlive(serviceHandler)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair != None:
+            logging.getLogger('service').info('recieved connection from %s' % pair[1][0])
+            ServiceChannel(pair[0], self)
+
+    def submit(self, channel, json):
+        """Run the request json from channel on a worker."""
+
+        self.pending += 1
+        future = self.executor.submit(handleConnectionRequest, self.serviceHandler,
+                                      channel.conn, json)
+        future.addDoneCallback(lambda f: self.requestCompleted(channel, f))
+
+    def requestCompleted(self, channel, future):
+        # called on the worker thread, so hand over to the event loop
+        self.completed.append((channel, future))
+        self.waker.wake()
+
+    def processCompleted(self):
+        """Pass the responses of finished requests on to their channels."""
+
+        while self.completed:
+            channel, future = self.completed.popleft()
+            self.pending -= 1
+            try:
+                ret = future.result()
+            except Exception, e:
+                logging.getLogger('service').exception('request failed')
+                ret = self.serviceHandler.translateResult(None, InternalError(str(e)), None)
+            if not channel.closed:
+                channel.requestDone(ret)
+
+    def closeIdle(self):
+        now = time.time()
+        for channel in self.map.values():
+            if isinstance(channel, ServiceChannel) and not channel.busy and \
+               not channel.writable() and now - channel.lastActive > self.idleTimeout:
+                channel.idleTimeout = True
+                channel.close()
+
+    def serve_forever(self, poll_interval = 0.5):
+        """Run the event loop until shutdown is called."""
+
+        self.running = True
+        self.stopped.clear()
+        lastCheck = time.time()
+        usePoll = hasattr(select, 'poll')
+        try:
+            while self.running:
+                asyncore.loop(poll_interval, usePoll, self.map, 1)
+                if time.time() - lastCheck >= poll_interval:
+                    self.closeIdle()
+                    lastCheck = time.time()
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        """Stop serve_forever and wait for it to return.
+
+        This must be called from a different thread to serve_forever.
+
+        """
+
+        self.running = False
+        self.waker.wake()
+        self.stopped.wait()
+
+    def server_close(self):
+        """Close the listening socket and every connection."""
+
+        for channel in self.map.values():
+            channel.close()
+        self.executor.shutdown(False)
@@ -14,38 +14,27 @@
 
 """Base functionality for jsonrpc"""
 
-from nicefloat import nicefloat
-from demjson import JSON, nan, inf, neginf, JSONDecodeError, JSONEncodeError
+from demjson import JSONDecodeError, JSONEncodeError
 
+import hashlib
 import inspect
 import types
 import uuid
 import re
+import threading
+import time
 
 from jsonrpcexceptions import *
+from threadpool import ThreadPool
+from codec import niceJSON, defaultCodec, EncodedJSON
+from metrics import ServiceMetrics, threadCPUTime, UNKNOWN_METHOD, INVALID_REQUEST
+from profiler import RequestProfiler
+from binder import compileBinder
+from response import ResponseWriter
 import parametertypes
 
-__all__ = ['serviceProcedure', 'ServiceHandler', 'ServiceHolder', 'niceJson']
-
-class niceJSON(JSON):
-    """A subclass of JSON that uses nicefloat to print the shortest decimal that represents a float."""
-    
-    def __init__(self, strict=False, compactly=True, escape_unicode=False):
-        JSON.__init__(self, strict, compactly, escape_unicode)
-    
-    def encode_number(self, n):
-        if isinstance(n, float):
-            global  nan, inf, neginf
-            if n is nan:
-                return 'NaN'
-            elif n is inf:
-                return 'Infinity'
-            elif n is neginf:
-                return '-Infinity'
-            
-            return nicefloat().str(n)
-        else:
-            return JSON.encode_number(self, n)
+__all__ = ['serviceProcedure', 'ServiceHandler', 'ServiceHolder', 'niceJSON',
+           'routeNamespace']
 
 class FunctionMeta(object):
     def __init__(self, name, summary = None, help = None,
@@ -132,13 +121,21 @@ class FunctionMeta(object):
     def signature(self):
         """Return a signature for this function if ret and optionally params hold values, None otherwise."""
         
-        if self.params and self.ret:
-            sig = [self.ret]
+        ret = self.ret
+        if isinstance(ret, dict):
+            ret = ret['type']
+        if self.params and ret:
+            sig = [ret]
             for p in self.params:
-                sig.append(p._type)
+                # params are stored as their description, a type string or
+                # an object with the name and type
+                if isinstance(p, dict):
+                    sig.append(p['type'])
+                else:
+                    sig.append(p)
             return sig
-        elif self.ret:
-            return [self.ret]
+        elif ret:
+            return [ret]
         else:
             return None
 
@@ -156,10 +153,22 @@ class FunctionHolder(object):
                 help = function.__doc__
             
             self.meta = FunctionMeta(name, summary, help, idempotent, params, ret)
+        self.binder = compileBinder(self.meta.name, function, self.meta.params)
     
     def __call__(self, *args, **kwargs):
         return self.function(*args, **kwargs)
     
+    def dispatch(self, params = [], kwparams = {}):
+        """Call the function with params after checking them against its arguments.
+        
+        throws InvalidParametersError if the params don't match the function.
+        
+        """
+        
+        if self.binder != None:
+            params, kwparams = self.binder.bind(params, kwparams)
+        return self.function(*params, **kwparams)
+    
     def name(self):
         return self.meta.name
     
@@ -167,7 +176,7 @@ class FunctionHolder(object):
         return self.meta.help
     
     def params(self):
-        return self.mata.params
+        return self.meta.params
     
     def ret(self):  # return value
         return self.meta.ret
@@ -199,6 +208,36 @@ class ServiceHolder(object):
         
         self.service = service
         self.all = all
+        self.refresh()
+    
+    def refresh(self):
+        """Rebuild the index of methods exposed by the service.
+        
+        This is done once on initialization, so that a dispatch is a single
+        dictionary lookup. It needs to be called again if methods are added to
+        or removed from the service after it has been registered.
+        
+        """
+        
+        self.dispatcher = getattr(self.service, '_dispatch', None)
+        self.stamper = getattr(self.service, '_resultStamp', None)
+        
+        members = inspect.getmembers(self.service, inspect.ismethod)
+        methods = {}
+        for name, method in members:
+            if hasattr(method, '_jsonrpcMeta'):
+                methods[method._jsonrpcMeta.name] = method
+        if self.all and self.dispatcher == None:
+            for name, method in members:
+                # procedures with meta data are only exposed under their meta name
+                if not name.startswith('_') and not hasattr(method, '_jsonrpcMeta'):
+                    methods.setdefault(name, method)
+        
+        self.methods = methods
+        self.binders = {}
+        for name, method in methods.items():
+            meta = getattr(method, '_jsonrpcMeta', None)
+            self.binders[name] = compileBinder(self.name + '.' + name, method, meta and meta.params)
     
     def listMethods(self, plain = False):
         """Return a list of the methods supplied by this service.
@@ -209,34 +248,46 @@ class ServiceHolder(object):
         
         if hasattr(self.service, '_listMethods'):
             methods = self.service._listMethods()
-        elif self.all and not hasattr(self.service, '_dispatch'):
-            methods = [x[0] for x in inspect.getmembers(self.service, inspect.ismethod) if not x[0].startswith('_')]
         else:
-            methods = [x[1]._jsonrpcMeta.name for x in inspect.getmembers(self.service, inspect.ismethod) if hasattr(x[1], '_jsonrpcMeta')]
+            methods = self.methods.keys()
         
-        if not plain:
-            return [self.name + '.' + x for x in methods]
+        if plain:
+            return methods
+        return [self.name + '.' + x for x in methods]
     
     def methodSignature(self, name):
         """Return the method signature of a method."""
         
         if hasattr(self.service, '_methodSignature'):
             return self.service._methodSignature(name)
-        elif name in [x[1]._jsonrpcMeta.name for x in inspect.getmembers(self.service, inspect.ismethod) if hasattr(x[1], '_jsonrpcMeta')]:
-            return getattr(self.service, name)._jsonrpcMeta.signature()
+        
+        method = self.methods.get(name)
+        if method != None and hasattr(method, '_jsonrpcMeta'):
+            return method._jsonrpcMeta.signature()
         else:
             return None
     
+    def hasMethod(self, name):
+        """Return True if name is in the method index, or the service dispatches its own methods."""
+        
+        return self.dispatcher != None or self.methods.has_key(name)
+    
+    def procedureMeta(self, name):
+        """Return the FunctionMeta of a method, or None if it has none."""
+        
+        return getattr(self.methods.get(name), '_jsonrpcMeta', None)
+    
     def methodHelp(self, name):
         if hasattr(self.service, '_methodHelp'):
             return self.service._methodHelp(name)
-        elif self.all and not hasattr(self.service, '_dispatch') \
-            and name in [x[0] for x in inspect.getmembers(self.service, inspect.ismethod) if not x[0].startswith('_')]:
-            return getattr(self.service, name).__doc__ or ""
-        elif name in [x[1]._jsonrpcMeta.name for x in inspect.getmembers(self.service, inspect.ismethod) if hasattr(x[1], '_jsonrpcMeta')]:
-            return getattr(self.service, name)._jsonrpcMeta.summary or ""
-        else:
+        
+        method = self.methods.get(name)
+        if method == None:
             return ""
+        elif hasattr(method, '_jsonrpcMeta'):
+            return method._jsonrpcMeta.summary or ""
+        else:
+            return method.__doc__ or ""
     
     def methodDescriptions(self):
         """Return a list of all the method descriptions."""
@@ -246,15 +297,15 @@ class ServiceHolder(object):
             for method in methods:
                 method['name'] = self.name + '.' + method['name']
         else:
-            if self.all and not hasattr(self.service, '_dispatch'):
-                methods = []
-                for method in [x[1] for x in inspect.getmembers(instance, inspect.ismember()) if not x[0].startswith('_')]:
-                    obj = {"name": self.name + '.' + method.__name__}
+            methods = []
+            for name, method in self.methods.items():
+                if hasattr(method, '_jsonrpcMeta'):
+                    methods.append(method._jsonrpcMeta.description(self.name))
+                else:
+                    obj = {"name": self.name + '.' + name}
                     if method.__doc__:
                         obj['summary'] = method.__doc__
                     methods.append(obj)
-            else:
-                methods = [x[1]._jsonrpcMeta.description(self.name) for x in inspect.getmembers(self.service, inspect.ismethod) if hasattr(x[1], '_jsonrpcMeta')]
         
         return methods
     
@@ -262,30 +313,21 @@ class ServiceHolder(object):
         """Attempt to dispatch a call to this instance, passing params.
         
         throws MethodNotFoundError if name is not supplied by this service.
-        throws InvalidParametersError if AttributrError is called.
+        throws InvalidParametersError if params don't match the method's arguments.
         
         """
         
-        if hasattr(self.service, '_dispatch'):
-            ret = self.service._dispatch(name, params, kwparams)
-        else:
-            method = [x[1] for x in inspect.getmembers(self.service, inspect.ismethod) if (hasattr(x[1], '_jsonrpcMeta') and x[1]._jsonrpcMeta.name == name)]
-            if method:
-                method = method[0]
-            else:
-                method = [x[1] for x in inspect.getmembers(self.service, inspect.ismethod) if (not x[0].startswith('_') and x[0] == name)]
-                if method:
-                    method = method[0]
-            
-            if method:
-                try:
-                    ret = method(*params, **kwparams)
-                except AttributeError, e:
-                    raise InvalidParametersError("method %s called with invalid parameters" % name)
-            else:
-                raise MethodNotFoundError("Method %s not found in service %s" % (name, self.name))
+        if self.dispatcher != None:
+            return self.dispatcher(name, params, kwparams)
+        
+        method = self.methods.get(name)
+        if method == None:
+            raise MethodNotFoundError("Method %s not found in service %s" % (name, self.name))
         
-        return ret
+        binder = self.binders[name]
+        if binder != None:
+            params, kwparams = binder.bind(params, kwparams)
+        return method(*params, **kwparams)
 
 def serviceProcedure(name = None, summary = None, help = None,
                  idempotent = False, params = None, ret = None):
@@ -307,8 +349,57 @@ def serviceProcedure(name = None, summary = None, help = None,
         return fn
     return decorate
 
+def routeNamespace(table, name):
+    """Find the service that handles the dotted method name name.
+    
+    table is a dictionary mapping service namespaces to services. The longest
+    registered namespace that prefixes name wins, so with both 'file' and
+    'file.cache' registered 'file.cache.x' is routed to 'file.cache'. This costs
+    one dictionary lookup per dot in name, independent of the size of table.
+    
+    Returns a tuple of the service and the method name relative to it, or
+    (None, None) if no service matches.
+    
+    """
+    
+    i = name.rfind('.')
+    while i > 0:
+        service = table.get(name[:i])
+        if service != None:
+            return service, name[i+1:]
+        i = name.rfind('.', 0, i)
+    
+    return None, None
+
+# number of worker threads for running batch requests when no executor is given
+BATCH_WORKERS = 4
+# default limit on the number of requests in a batch
+MAX_BATCH_SIZE = 100
+
 _idregex = re.compile('"id"\w*:\w"?(?P<id>.*?)"?\w*,')
 
+class Introspection(object):
+    """The precomputed results of the introspection procedures of a ServiceHandler.
+    
+    key identifies the set of procedures they were computed from. etag is a
+    hash of the description, which is kept both as an object and encoded.
+    
+    """
+    
+    def __init__(self, key, description, methods, signatures, help, json):
+        self.key = key
+        self.methods = methods
+        self.signatures = signatures
+        self.help = help
+        
+        # the etag is a hash of the description without it, so it only
+        # changes when the description does
+        self.etag = hashlib.sha1(json.encode(description)).hexdigest()
+        self.description = dict(description)
+        self.description['etag'] = self.etag
+        self.encoded = EncodedJSON(json.encode(self.description))
+        self.unchanged = EncodedJSON(json.encode({'etag': self.etag, 'unchanged': True}))
+
 class ServiceHandler(object):
     """A JSON-RPC service handler.
     
@@ -317,11 +408,81 @@ class ServiceHandler(object):
     """
     
     def __init__(self, name, id = None, version = None, summary = None,
-                 help = None, json = niceJSON(True), sysServices = True):
+                 help = None, json = None, sysServices = True,
+                 batchExecutor = None, maxBatchSize = MAX_BATCH_SIZE,
+                 metrics = True, profileDir = None, resultCache = None,
+                 notificationExecutor = None):
+        """ServiceHandler initialization.
+        
+        The members of a batch request are run concurrently by batchExecutor,
+        any object with a map(function, sequence) method such as a ThreadPool.
+        If it is None a ThreadPool of BATCH_WORKERS threads is created when the
+        first batch arrives. Batches with more than maxBatchSize requests are
+        rejected, a maxBatchSize of 0 means there is no limit.
+        
+        json is the codec used for requests and results (see the codec module),
+        if it is None the fastest available codec is used.
+        
+        If metrics is true the calls, errors, latency, CPU time and request and
+        response sizes of each method are recorded in a ServiceMetrics, and
+        can be read with the system.stats procedure.
+        
+        If profileDir is given calls can be profiled while the server runs,
+        see profile, and the system.profile procedure is registered. Profiles
+        are written to profileDir.
+        
+        If resultCache is given, a ResultCache, the results of procedures
+        declared idempotent are cached in it, so repeated calls with the same
+        parameters are not run again until the result expires or is removed
+        with invalidateResults. A service whose results depend on data that
+        changes outside the server, such as files, can define
+        _resultStamp(name, params) returning a value that changes with that
+        data, and a cached result is only used while the stamp is unchanged.
+        
+        If notificationExecutor is given, any object with a submit(function,
+        *args) method such as a ThreadPool, notifications are run by it and
+        handleRequest returns as soon as they are queued. A ThreadPool with a
+        queueSize bounds the memory used, and its overflow policy chooses
+        whether a burst of notifications blocks the transport or drops the
+        oldest or newest of them. A single worker keeps the notifications in
+        the order they arrived. system procedures are always run immediately,
+        as some of them depend on the connection they arrived on.
+        
+        """
+        
+        if json == None:
+            json = defaultCodec()
         self.json = json
+        self.responses = ResponseWriter(json)
         self.functions = {}
         self.services = {}
         
+        self.batchExecutor = batchExecutor
+        self.maxBatchSize = maxBatchSize
+        self._batchLock = threading.Lock()
+        
+        if metrics:
+            self.metrics = ServiceMetrics()
+        else:
+            self.metrics = None
+        
+        if profileDir != None:
+            self.profiler = RequestProfiler(profileDir)
+        else:
+            self.profiler = None
+        
+        self.resultCache = resultCache
+        self.notificationExecutor = notificationExecutor
+        
+        self._introspection = None
+        self._introspectionVersion = 0
+        self._introspectionLock = threading.Lock()
+        # service.describe is not in functions as it shouldn't describe itself
+        self.describeHolder = FunctionHolder(self.serviceDescribe, "service.describe",
+                              "This method takes an optional string parameter, the etag of a description returned earlier. It returns the description of this service, or if the etag is unchanged an object with the etag and unchanged set to true.",
+                              params = [parametertypes.String('etag')],
+                              ret = parametertypes.Object())
+        
         self.name = name
         # id should really be passed from a stored value.
         if id == None:
@@ -344,6 +505,9 @@ class ServiceHandler(object):
         if all is true and the service does not provide a relevant introspection method,
         then all class methods not starting with an underscore will be exposed.
         
+        Registering a service again under the same name replaces it, and
+        rebuilds its method index.
+        
         """
         
         # allow the instance to appear under a different name than its class name
@@ -354,6 +518,7 @@ class ServiceHandler(object):
             raise InvalidParametersError("Attempt made to add reserved system instance.")
         
         self.services[sh.name] = sh
+        self.invalidateIntrospection()
     
     def registerFunction(self, function, name = None, summary = None, help = None,
                          idempotent = False, params = None, ret = None):
@@ -365,6 +530,7 @@ class ServiceHandler(object):
         
         fh = FunctionHolder(function, name, summary, help, idempotent, params, ret)
         self.functions[fh.name()] = fh
+        self.invalidateIntrospection()
     
     def registerSystemServices(self):
         """Register the system services functions."""
@@ -384,47 +550,137 @@ class ServiceHandler(object):
                               'This method takes one parameter of any type, and returns it as "result". It serves as a simple test-function.',
                               params = parametertypes.Any(),
                               ret = parametertypes.Any())
-        # possibly support multicall
-#===============================================================================
-#        self.functions['system.multicall'] = FunctionHolder(self.multicall, "system.multicall",
-#                              'Allows the caller to package multiple JSON-RPC calls into a single request. Returning an array of results.',
-#                              params = parametertypes.Array(),
-#                              ret = parametertypes.Array())
-#===============================================================================
+        if self.metrics != None:
+            self.functions['system.stats'] = FunctionHolder(self.stats, "system.stats",
+                              'This method takes an optional boolean parameter (default false). It returns an object with the call count, error counts by code, latency percentiles and means of CPU time and request and response sizes of each method, the hit and miss counts of the result cache if there is one, and the queue and dropped counts of the notification executor if there is one. Times are in milliseconds. If the parameter is true the statistics are reset after being read.',
+                              params = parametertypes.Boolean(),
+                              ret = parametertypes.Object())
+        if self.profiler != None:
+            self.functions['system.profile'] = FunctionHolder(self.profile, "system.profile",
+                              'This method controls profiling of calls with cProfile. If enable is true calls to the methods named in methods are profiled, and if every is greater than 0 so is every every\'th call to any method. If only enable is given every call is profiled. If enable is false profiling stops. If dump is true the statistics collected for each method are written to pstats files on the server, and if reset is true they are discarded. It returns an object with the profiling settings, the number of calls profiled for each method, and the names of any files written.',
+                              params = [parametertypes.Boolean('enable'),
+                                        parametertypes.Number('every'),
+                                        parametertypes.Array('methods'),
+                                        parametertypes.Boolean('dump'),
+                                        parametertypes.Boolean('reset')],
+                              ret = parametertypes.Object())
     
     def handleRequest(self, json):
-        """Handle a method request for this service.
+        """Handle a method request, or a batch of requests, for this service.
         
         returns a string to be sent,
         or None if the request was a notification and no reply should be sent.
         
         """
         
-        err=None
-        result = None
-        id_=None
+        started = None
+        if self.metrics != None:
+            started = (time.time(), threadCPUTime())
         
         try:
             req = self.translateRequest(json)
         except ParseError, e:
-            err = e
-
-        if err == None:
-            id_ = req.get('id', None)  # if id is None its a notification
-            missing = [x for x in ['jsonrpc', 'method'] if not req.has_key(x)]
-            if missing:
-                err = InvalidRequestError("Required members (%s) missing from request" % ', '.join(missing))
-            elif req['jsonrpc'] != '2.0':
-                err = InvalidRequestError("service only supports JSON-RPC 2.0")
-            else:
-                methName = req.get('method')
-                args = req.get('params', [])
+            if started != None:
+                self.recordCall(INVALID_REQUEST, started, len(json), 0, e)
+            return None
+        
+        if isinstance(req, list):
+            return self.handleBatch(req, len(json))
+        else:
+            return self.processRequest(req, len(json), started)
+    
+    def handleBatch(self, reqs, size = 0):
+        """Handle a JSON-RPC 2.0 batch, a list of decoded requests.
+        
+        The requests are run concurrently on the batch executor. Returns a
+        string with an array of the responses, or None if every request in
+        the batch was a notification. size is the length of the encoded batch,
+        which is shared evenly between the requests in the metrics.
+        
+        """
+        
+        if not reqs:
+            return self.translateResult(None, InvalidRequestError("Empty batch"), None)
+        elif self.maxBatchSize and len(reqs) > self.maxBatchSize:
+            return self.translateResult(None, InvalidRequestError("Batch of %d requests exceeds the limit of %d" % (len(reqs), self.maxBatchSize)), None)
+        
+        size = size / len(reqs)
+        if len(reqs) == 1:
+            responses = [self.processRequest(reqs[0], size)]
+        else:
+            responses = self.getBatchExecutor().map(lambda req: self.processRequest(req, size), reqs)
+        
+        responses = [x for x in responses if x != None]
+        if responses:
+            return '[' + ','.join(responses) + ']'
+        else:
+            return None
+    
+    def getBatchExecutor(self):
+        """Return the batch executor, creating the default ThreadPool if needed."""
+        
+        if self.batchExecutor == None:
+            self._batchLock.acquire()
+            try:
+                if self.batchExecutor == None:
+                    self.batchExecutor = ThreadPool(BATCH_WORKERS, name='BatchExecutor')
+            finally:
+                self._batchLock.release()
+        
+        return self.batchExecutor
+    
+    def processRequest(self, req, size = 0, started = None):
+        """Run a single decoded request.
+        
+        size is the length of the encoded request, and started a tuple of the
+        time and thread CPU time its handling started, for the metrics. If
+        started is None the time is measured from here.
+        
+        returns a string with the encoded response,
+        or None if the request was a notification and no reply should be sent.
+        
+        """
+        
+        err=None
+        result = None
+        id_=None
+        
+        if self.metrics != None and started == None:
+            started = (time.time(), threadCPUTime())
+        
+        if not isinstance(req, dict):
+            err = InvalidRequestError("Request is not an Object")
+            resultdata = self.translateResult(None, err, None)
+            if started != None:
+                self.recordCall(INVALID_REQUEST, started, size, len(resultdata), err)
+            return resultdata
+        
+        id_ = req.get('id', None)  # if id is None its a notification
+        methName = INVALID_REQUEST
+        missing = [x for x in ['jsonrpc', 'method'] if not req.has_key(x)]
+        if missing:
+            err = InvalidRequestError("Required members (%s) missing from request" % ', '.join(missing))
+        elif req['jsonrpc'] != '2.0':
+            err = InvalidRequestError("service only supports JSON-RPC 2.0")
+        elif not isinstance(req['method'], basestring):
+            err = InvalidRequestError("Request method must be a String")
+        else:
+            methName = req.get('method')
+            args = req.get('params', [])
         
         if err == None:
             try:
                 meth = self.findServiceEndpoint(methName)
+                if isinstance(meth, ServiceHolder) and not meth.hasMethod(methName[len(meth.name)+1:]):
+                    raise MethodNotFoundError("Method %s not found in service %s" % (methName[len(meth.name)+1:], meth.name))
             except Exception, e:
                 err = e
+                methName = UNKNOWN_METHOD
+        
+        if err == None and id_ == None and self.notificationExecutor != None \
+                and not methName.startswith('system.'):
+            self.notificationExecutor.submit(self.runNotification, methName, meth, args, size, started)
+            return None
         
         if err == None:
             try:
@@ -436,10 +692,50 @@ class ServiceHandler(object):
 
         if id_ != None:
             resultdata = self.translateResult(result, err, id_)
-
-            return resultdata
         else:
-            return None
+            resultdata = None
+        
+        if started != None:
+            self.recordCall(methName, started, size, resultdata and len(resultdata) or 0, err)
+        return resultdata
+    
+    def runNotification(self, name, meth, args, size = 0, started = None):
+        """Run a notification queued on the notificationExecutor.
+        
+        Errors are only recorded in the metrics, as there is nobody to send
+        them to. The latency recorded includes the time spent in the queue.
+        
+        """
+        
+        err = None
+        if started != None:
+            # CPU time is per thread, so it has to be measured from here
+            started = (started[0], threadCPUTime())
+        try:
+            self.invokeServiceEndpoint(name, meth, args)
+        except Exception, e:
+            err = e
+        if started != None:
+            self.recordCall(name, started, size, 0, err)
+    
+    def recordCall(self, method, started, requestBytes, responseBytes, err):
+        """Record a call in the metrics, started is a tuple of the time and thread CPU time it started.
+        
+        Calls that fail with MethodNotFoundError are recorded under
+        UNKNOWN_METHOD, whatever name they were made with, so a client can't
+        add entries to the metrics.
+        
+        """
+        
+        if isinstance(err, MethodNotFoundError):
+            method = UNKNOWN_METHOD
+        code = None
+        if isinstance(err, JSONRPCError):
+            code = err.code
+        elif err != None:
+            code = InternalError().code
+        self.metrics.record(method, time.time() - started[0], threadCPUTime() - started[1],
+                            requestBytes, responseBytes, code)
 
     def translateRequest(self, data):
         try:
@@ -457,81 +753,244 @@ class ServiceHandler(object):
         
         if name == 'service.describe':
             # special case handler for service.describe as it shouldn't describe itself.
-            return self.describe
+            return self.describeHolder
         elif self.functions.has_key(name):
             return self.functions[name]
         else:
-            for key in self.services:
-                if name.startswith(key) and name[len(key)] == '.':
-                    return self.services[key]
-            raise MethodNotFoundError(name)
+            service, mname = self.findService(name)
+            if service == None:
+                raise MethodNotFoundError(name)
+            return service
+    
+    def findService(self, name):
+        """Return a tuple of the ServiceHolder that handles the method name
+        and the method name relative to it, or (None, None) if there is none.
+        
+        """
+        
+        return routeNamespace(self.services, name)
 
     def invokeServiceEndpoint(self, name, meth, args):
+        """Call the method name on meth, returning cached results of idempotent procedures."""
+        
+        cache = self.resultCache
+        if cache != None and self.isIdempotent(name, meth):
+            key = cache.key(name, args)
+            stamp = self.resultStamp(name, meth, args)
+            found, result = cache.get(key, stamp)
+            if not found:
+                result = self.callServiceEndpoint(name, meth, args)
+                cache.put(key, result, stamp)
+            return result
+        
+        return self.callServiceEndpoint(name, meth, args)
+    
+    def isIdempotent(self, name, meth):
+        """Return True if the method name on meth was declared idempotent."""
+        
+        if isinstance(meth, FunctionHolder):
+            meta = meth.meta
+        elif isinstance(meth, ServiceHolder):
+            meta = meth.procedureMeta(name[len(meth.name)+1:])
+        else:
+            return False
+        return meta != None and meta.idempotent
+    
+    def resultStamp(self, name, meth, args):
+        """Return the stamp of the data the result of the method name on meth depends on, or None."""
+        
+        if isinstance(meth, ServiceHolder) and meth.stamper != None:
+            return meth.stamper(name[len(meth.name)+1:], args)
+        return None
+    
+    def invalidateResults(self, name = None, params = None):
+        """Remove cached results, see ResultCache.invalidate. Returns the number removed."""
+        
+        if self.resultCache == None:
+            return 0
+        return self.resultCache.invalidate(name, params)
+    
+    def callServiceEndpoint(self, name, meth, args):
         # first need to determine if args is by value or keyword
         if isinstance(args, list):
             kwargs = {}
-        else:
+        elif isinstance(args, dict):
             kwargs = args
             args = []
+        else:
+            raise InvalidParametersError("params must be an Array or Object")
             
         if isinstance(meth, FunctionHolder):
-            return meth(*args, **kwargs)
+            return meth.dispatch(args, kwargs)
         else:
             mname = name[len(meth.name)+1:]
             return meth.dispatch(mname, args, kwargs)
 
     def translateResult(self, rslt, err, id_):
-        try:
-            obj = {}
-            obj["jsonrpc"] = "2.0"
+        """Return the encoded response with either the result rslt or the error err, for the request id_."""
         
+        try:
             if err != None:
-                obj["error"] = err
-            else:
-                obj["result"] = rslt
-            obj["id"] = id_
-            
-            out = self.json.encode(obj)
+                return self.responses.error(err, id_)
+            return self.responses.result(rslt, id_)
         except JSONEncodeError, e:
-            out = '{"jsonrpc": "2.0", "error": {"code": -32603, "message": "Internal error.", "data": "Result encoding failed: %s"}, "id": %s}' % (e, self.encoder.encode(id_))
-
-        return out
+            return self.responses.error(InternalError("Result encoding failed: %s" % e), id_)
+    
+    def serviceHolders(self):
+        """Return the ServiceHolders of every registered service."""
+        
+        return self.services.values()
+    
+    def introspectionKey(self):
+        """Return a value that changes whenever the set of procedures does."""
+        
+        return self._introspectionVersion
+    
+    def invalidateIntrospection(self):
+        """Have the introspection results computed again when next needed.
+        
+        This is done by registerService and registerFunction, and only needs
+        to be called directly after changing the name, version, summary or
+        help of the handler, or refreshing a ServiceHolder.
+        
+        """
+        
+        self._introspectionLock.acquire()
+        try:
+            self._introspectionVersion += 1
+        finally:
+            self._introspectionLock.release()
+    
+    def introspection(self):
+        """Return the Introspection of the current procedures, computing it if they changed."""
+        
+        key = self.introspectionKey()
+        intro = self._introspection
+        if intro != None and intro.key == key:
+            return intro
+        
+        self._introspectionLock.acquire()
+        try:
+            intro = self._introspection
+            if intro == None or intro.key != key:
+                methods = self.lookupMethods()
+                names = methods + [x for x in self.functions if x.startswith('system.')]
+                intro = Introspection(key, self.buildDescription(), methods,
+                                      dict([(x, self.lookupSignature(x)) for x in names]),
+                                      dict([(x, self.lookupHelp(x)) for x in names]),
+                                      self.json)
+                self._introspection = intro
+            return intro
+        finally:
+            self._introspectionLock.release()
     
     def listMethods(self):
         """returns a list of strings, one for each (non-system) method supported by this server."""
         
+        return list(self.introspection().methods)
+    
+    def methodSignature(self, name):
+        """Return the method signature of a named function."""
+        
+        signatures = self.introspection().signatures
+        if name in signatures:
+            return signatures[name]
+        # services with their own _listMethods can have methods they don't list
+        return self.lookupSignature(name)
+    
+    def methodHelp(self, name):
+        """Return the summary of a method."""
+        
+        help = self.introspection().help
+        if name in help:
+            return help[name]
+        return self.lookupHelp(name)
+    
+    def lookupMethods(self):
+        """Return a sorted list of the names of the (non-system) methods, without using the introspection cache."""
+        
         methods = [x for x in self.functions.keys() if not x.startswith('system.')]
         
-        for service in self.services.values():
+        for service in self.serviceHolders():
             methods.extend(service.listMethods())
         
         # just to make sure there arn't any duplicates
-        return list(set(methods))
+        return sorted(set(methods))
     
-    def methodSignature(self, name):
-        """Return the method signature of a named function."""
+    def lookupSignature(self, name):
+        """Return the method signature of a named function, without using the introspection cache."""
         
         if self.functions.has_key(name):
             return self.functions[name].signature()
-        elif name.find('.'):
-            for key in self.services:
-                if name.startswith(key) and name[len(key)] == '.':
-                    return self.services[key].methodSignature(name[len(key)+1:])
+        
+        service, mname = self.findService(name)
+        if service != None:
+            return service.methodSignature(mname)
         
         return None
     
-    def methodHelp(self, name):
-        """Return the summary of a method."""
+    def lookupHelp(self, name):
+        """Return the summary of a method, without using the introspection cache."""
         
         if self.functions.has_key(name):
             return self.functions[name].help()
-        elif name.find('.'):
-            for key in self.services:
-                if name.startswith(key) and name[len(key)] == '.':
-                    return self.services[key].methodHelp(name[len(key)+1:])
+        
+        service, mname = self.findService(name)
+        if service != None:
+            return service.methodHelp(mname)
         
         return ""
 
+    def profile(self, enable = None, every = None, methods = None, dump = False, reset = False):
+        """Start or stop profiling calls, and dump or reset the statistics.
+        
+        Profiling replaces invokeServiceEndpoint on this instance with one
+        that runs sampled calls under cProfile, and stopping removes it again,
+        so there is no cost when profiling is off.
+        
+        """
+        
+        profiler = self.profiler
+        if enable:
+            if not every and not methods:
+                every = 1
+            profiler.configure(every or 0, methods)
+            self.invokeServiceEndpoint = self.profileServiceEndpoint
+        elif enable != None:
+            self.__dict__.pop('invokeServiceEndpoint', None)
+        
+        status = profiler.status()
+        status['enabled'] = 'invokeServiceEndpoint' in self.__dict__
+        if dump:
+            status['files'] = profiler.dump()
+        if reset:
+            profiler.reset()
+        return status
+    
+    def profileServiceEndpoint(self, name, meth, args):
+        """invokeServiceEndpoint while profiling is on."""
+        
+        invoke = self.__class__.invokeServiceEndpoint
+        if self.profiler.sample(name):
+            return self.profiler.runcall(name, invoke, self, name, meth, args)
+        return invoke(self, name, meth, args)
+    
+    def stats(self, reset = False):
+        """Return the metrics of each method, see ServiceMetrics.stats, and those of the result cache."""
+        
+        stats = self.metrics.stats()
+        if self.resultCache != None:
+            stats['resultCache'] = self.resultCache.stats()
+        if hasattr(self.notificationExecutor, 'stats'):
+            stats['notifications'] = self.notificationExecutor.stats()
+        if reset:
+            self.metrics.reset()
+            if self.resultCache != None:
+                self.resultCache.resetStats()
+            if hasattr(self.notificationExecutor, 'resetStats'):
+                self.notificationExecutor.resetStats()
+        return stats
+    
     def echo(self, *args, **kwargs):
         """Return the parameters passed."""
         
@@ -541,7 +1000,30 @@ class ServiceHandler(object):
             return kwargs
 
     def describe(self):
-        """Return a description object for this JSON-RPC service."""
+        """Return a description object for this JSON-RPC service.
+        
+        The object is shared with later calls until the procedures change, so
+        it must not be modified.
+        
+        """
+        
+        return self.introspection().description
+    
+    def serviceDescribe(self, etag = None):
+        """The service.describe procedure, returning the encoded description.
+        
+        If etag is that of the current description, only the etag and
+        unchanged set to true are returned.
+        
+        """
+        
+        intro = self.introspection()
+        if etag != None and etag == intro.etag:
+            return intro.unchanged
+        return intro.encoded
+    
+    def buildDescription(self):
+        """Return a description object for this JSON-RPC service, without using the introspection cache."""
         
         obj = {'sdversion': '1.0',
             'name': self.name,
@@ -555,10 +1037,11 @@ class ServiceHandler(object):
             obj['help'] = str(self.help)
         
         procs = [x.description() for x in self.functions.values()]
-        for x in self.services.values():
+        for x in self.serviceHolders():
             procs.extend(x.methodDescriptions())
         
         if procs:
+            procs.sort(key=lambda x: x['name'])
             obj['procs'] = procs
         
         return obj
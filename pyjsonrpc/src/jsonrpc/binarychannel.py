@@ -0,0 +1,400 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""A side channel that sends raw bytes, for data too large to send as base64 in JSON.
+
+A procedure negotiates a transfer by registering it with a BinaryChannel,
+and returns the token it is given to the client. The client connects to the
+BinaryChannelServer, sends the token, and the data is sent as a stream of
+length prefixed frames, each with a checksum.
+
+    # in the procedure
+    token = channel.offerDownload(source.read, 0, source.size)
+    return {'token': token, 'port': server.server_address[1]}
+
+    # in the client
+    data = receiveBinary((host, port), token)
+
+Every frame starts with a header of its type, length and checksum, as
+network order unsigned char and longs, then length bytes follow. A transfer
+is a number of DATA frames ended by an END frame. Either side can send an
+ERROR frame, holding a message, instead of the next frame, and the
+connection is closed after it.
+
+A connection starts with MAGIC and the token. For a download the server
+then sends the data, for an upload the client does and the server answers
+with an END frame once the data is written.
+
+"""
+
+import SocketServer
+import binascii
+import logging
+import socket
+import struct
+import threading
+import time
+import uuid
+
+from threadpool import ThreadPool
+from socketserver import POOL_WORKERS, POOL_QUEUE_SIZE
+
+__all__ = ['BinaryChannel', 'BinaryChannelServer', 'BinaryChannelError',
+           'receiveBinary', 'sendBinary', 'crc32']
+
+# sent by the client at the start of a connection, followed by the token
+MAGIC = 'JRB1'
+TOKEN_SIZE = 32
+
+FRAME_DATA = 0
+FRAME_END = 1
+FRAME_ERROR = 2
+
+_header = struct.Struct('!BLL')
+
+# default length of the frames data is sent in
+FRAME_SIZE = 64 * 1024
+# default limit on the length of a frame received
+MAX_FRAME_SIZE = 1024 * 1024
+# default seconds a token can be used for after it is issued
+TOKEN_TTL = 60.0
+# default seconds to wait for the other side of a transfer
+CHANNEL_TIMEOUT = 30.0
+
+DOWNLOAD = 'download'
+UPLOAD = 'upload'
+
+class BinaryChannelError(socket.error):
+    """Raised when a transfer fails, or the other side reports that it failed."""
+
+def crc32(data, value = 0):
+    """Return the CRC-32 of data as an unsigned number, the default checksum of frames."""
+
+    return binascii.crc32(data, value) & 0xffffffff
+
+def _recvExactly(sock, n):
+    """Return the next n bytes received on sock."""
+
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        received = sock.recv_into(view[pos:], n - pos)
+        if not received:
+            raise BinaryChannelError('connection closed during the transfer')
+        pos += received
+    return str(buf)
+
+def _sendFrame(sock, type_, data = '', checksum = 0):
+    sock.sendall(_header.pack(type_, len(data), checksum) + data)
+
+def _recvFrame(sock, maxFrameSize):
+    """Return the type, data and checksum of the next frame received on sock."""
+
+    type_, length, checksum = _header.unpack(_recvExactly(sock, _header.size))
+    if length > maxFrameSize:
+        raise BinaryChannelError('frame of %d bytes exceeds the maximum of %d' % (length, maxFrameSize))
+    data = length and _recvExactly(sock, length) or ''
+    if type_ == FRAME_ERROR:
+        raise BinaryChannelError(data.decode('utf-8', 'replace'))
+    return type_, data, checksum
+
+def _sendError(sock, message):
+    try:
+        _sendFrame(sock, FRAME_ERROR, unicode(message).encode('utf-8'))
+    except socket.error:
+        pass
+
+class BinaryTransfer(object):
+    """A transfer a token was issued for.
+
+    For a download callback is called as read(offset, length) and returns
+    the data, for an upload it is called as write(offset, data). done, if
+    given, is called with the number of bytes sent or received when the
+    transfer finishes. checksum, if given, replaces the checksum of the
+    channel for the frames of this transfer.
+
+    """
+
+    def __init__(self, kind, callback, offset, length, expires, done = None, checksum = None):
+        self.kind = kind
+        self.callback = callback
+        self.offset = offset
+        self.length = length
+        self.expires = expires
+        self.done = done
+        self.checksum = checksum
+
+class BinaryChannel(object):
+    """The transfers negotiated through procedures, and the protocol they are made with.
+
+    A token can be used once, and only for tokenTTL seconds after it was
+    issued. Frames are checked with checksum, a function of a string
+    returning a number that fits in 32 bits, so the procedures can use the
+    same checksum as the rest of their service.
+
+    """
+
+    def __init__(self, checksum = crc32, frameSize = FRAME_SIZE, maxFrameSize = MAX_FRAME_SIZE,
+                 tokenTTL = TOKEN_TTL, timeout = CHANNEL_TIMEOUT):
+        self.checksum = checksum
+        self.frameSize = frameSize
+        self.maxFrameSize = maxFrameSize
+        self.tokenTTL = tokenTTL
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.transfers = {}     # token -> BinaryTransfer
+        self.resetStats()
+
+    def resetStats(self):
+        self.issued = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def offerDownload(self, read, offset, length, done = None, checksum = None):
+        """Return the token to receive length bytes from offset, read with read(offset, length)."""
+
+        return self.register(BinaryTransfer(DOWNLOAD, read, offset, length, None, done, checksum))
+
+    def acceptUpload(self, write, offset, length, done = None, checksum = None):
+        """Return the token to send at most length bytes to, written from offset with write(offset, data)."""
+
+        return self.register(BinaryTransfer(UPLOAD, write, offset, length, None, done, checksum))
+
+    def register(self, transfer):
+        token = uuid.uuid4().hex
+        now = time.time()
+        transfer.expires = now + self.tokenTTL
+        self.lock.acquire()
+        try:
+            self.expire(now)
+            self.transfers[token] = transfer
+            self.issued += 1
+        finally:
+            self.lock.release()
+        return token
+
+    def expire(self, now):
+        # the caller holds the lock
+        for token in [t for t, x in self.transfers.items() if x.expires < now]:
+            del self.transfers[token]
+            self.expired += 1
+
+    def take(self, token):
+        """Return the transfer for token, which can't be used again, or None if there is none."""
+
+        self.lock.acquire()
+        try:
+            self.expire(time.time())
+            return self.transfers.pop(token, None)
+        finally:
+            self.lock.release()
+
+    def handle(self, sock):
+        """Make the transfer requested on the connected socket sock."""
+
+        log = logging.getLogger('service')
+        sock.settimeout(self.timeout)
+        try:
+            start = _recvExactly(sock, len(MAGIC) + TOKEN_SIZE)
+            if start[:len(MAGIC)] != MAGIC:
+                _sendError(sock, 'not a binary channel request')
+                return
+            transfer = self.take(start[len(MAGIC):])
+            if transfer == None:
+                _sendError(sock, 'unknown or expired token')
+                self.count('failed')
+                return
+
+            try:
+                if transfer.kind == DOWNLOAD:
+                    n = self.send(sock, transfer)
+                else:
+                    n = self.receive(sock, transfer)
+                if transfer.done != None:
+                    transfer.done(n)
+            except socket.error:
+                raise
+            except Exception, e:
+                # a failure of the callback, not of the connection
+                log.exception('binary %s failed' % transfer.kind)
+                _sendError(sock, '%s: %s' % (e.__class__.__name__, e))
+                self.count('failed')
+                return
+
+            if transfer.kind == UPLOAD:
+                _sendFrame(sock, FRAME_END)
+            self.count('completed')
+        except BinaryChannelError, e:
+            log.debug('binary transfer failed: %s' % e)
+            _sendError(sock, e)
+            self.count('failed')
+        except socket.error, e:
+            log.debug('binary transfer connection failed: %s' % e)
+            self.count('failed')
+
+    def send(self, sock, transfer):
+        checksum = transfer.checksum or self.checksum
+        pos = transfer.offset
+        end = transfer.offset + transfer.length
+        try:
+            while pos < end:
+                data = transfer.callback(pos, min(self.frameSize, end - pos))
+                if not data:
+                    # the data ended early
+                    break
+                _sendFrame(sock, FRAME_DATA, data, checksum(data))
+                pos += len(data)
+            _sendFrame(sock, FRAME_END)
+        finally:
+            self.count('bytesSent', pos - transfer.offset)
+        return pos - transfer.offset
+
+    def receive(self, sock, transfer):
+        checksum = transfer.checksum or self.checksum
+        pos = transfer.offset
+        end = transfer.offset + transfer.length
+        try:
+            while 1:
+                type_, data, crc = _recvFrame(sock, self.maxFrameSize)
+                if type_ == FRAME_END:
+                    break
+                if pos + len(data) > end:
+                    raise BinaryChannelError('more than the %d bytes of the transfer were sent' % transfer.length)
+                if checksum(data) != crc:
+                    raise BinaryChannelError('checksum of the frame at %d does not match' % pos)
+                transfer.callback(pos, data)
+                pos += len(data)
+        finally:
+            self.count('bytesReceived', pos - transfer.offset)
+        return pos - transfer.offset
+
+    def count(self, name, n = 1):
+        """Add n to the counter name, transfers are handled on several threads."""
+
+        self.lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + n)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the transfer counts of the channel as a dictionary."""
+
+        self.lock.acquire()
+        try:
+            return {'issued': self.issued,
+                    'pending': len(self.transfers),
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'expired': self.expired,
+                    'bytesSent': self.bytesSent,
+                    'bytesReceived': self.bytesReceived}
+        finally:
+            self.lock.release()
+
+class BinaryRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.server.channel.handle(self.request)
+
+class BinaryChannelServer(SocketServer.TCPServer):
+    """Serves the transfers of channel on their own port, on a fixed pool of worker threads.
+
+    Like PooledTCPServiceServer, accepted connections wait in a queue of
+    queueSize for one of the workers, and in the listen backlog once it is
+    full.
+
+    """
+
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, channel, workers = POOL_WORKERS,
+                 queueSize = POOL_QUEUE_SIZE, bind_and_activate = True):
+        SocketServer.TCPServer.__init__(self, server_address, BinaryRequestHandler, bind_and_activate)
+        self.channel = channel
+        self.pool = ThreadPool(workers, queueSize, 'BinaryChannelServer')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.pool.shutdown(True, 1.0)
+
+    def poolStats(self):
+        """Return the statistics of the worker pool, see ThreadPool.stats."""
+
+        return self.pool.stats()
+
+def _connect(address, token, timeout):
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(MAGIC + str(token))
+    return sock
+
+def receiveBinary(address, token, checksum = crc32, maxFrameSize = MAX_FRAME_SIZE,
+                  timeout = CHANNEL_TIMEOUT):
+    """Return the data of the download token from the BinaryChannelServer at address.
+
+    throws BinaryChannelError if the transfer fails or a frame is corrupt.
+
+    """
+
+    sock = _connect(address, token, timeout)
+    try:
+        parts = []
+        while 1:
+            type_, data, crc = _recvFrame(sock, maxFrameSize)
+            if type_ == FRAME_END:
+                return ''.join(parts)
+            if checksum(data) != crc:
+                raise BinaryChannelError('checksum of the frame at %d does not match' % sum(map(len, parts)))
+            parts.append(data)
+    finally:
+        sock.close()
+
+def sendBinary(address, token, data, checksum = crc32, frameSize = FRAME_SIZE,
+               timeout = CHANNEL_TIMEOUT):
+    """Send data for the upload token to the BinaryChannelServer at address.
+
+    throws BinaryChannelError if the server rejects the data.
+
+    """
+
+    sock = _connect(address, token, timeout)
+    try:
+        try:
+            view = buffer(data)
+            for pos in xrange(0, len(data), frameSize):
+                frame = str(view[pos:pos + frameSize])
+                _sendFrame(sock, FRAME_DATA, frame, checksum(frame))
+            _sendFrame(sock, FRAME_END)
+        except socket.error:
+            # the server may have closed the connection after an error frame
+            _recvFrame(sock, MAX_FRAME_SIZE)
+            raise
+        _recvFrame(sock, MAX_FRAME_SIZE)
+    finally:
+        sock.close()
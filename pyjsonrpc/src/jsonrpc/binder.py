@@ -0,0 +1,196 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Binding of JSON-RPC params to the arguments of a procedure."""
+
+import inspect
+import sys
+
+from jsonrpcexceptions import InvalidParametersError
+
+__all__ = ['ParameterBinder', 'compileBinder']
+
+# the python types of the decoded JSON values each parameter type accepts,
+# any has no entry as it accepts everything
+_parameterTypes = {'bit': frozenset([bool]),
+                   'num': frozenset([int, long, float]),
+                   'str': frozenset([str, unicode]),
+                   'arr': frozenset([list]),
+                   'obj': frozenset([dict])}
+
+_typeNames = {'bit': 'Boolean', 'num': 'Number', 'str': 'String',
+              'arr': 'Array', 'obj': 'Object'}
+
+_noDefault = object()
+
+def _jsonTypeName(value):
+    for t, types in _parameterTypes.items():
+        if type(value) in types:
+            return _typeNames[t]
+    if value == None:
+        return 'null'
+    return type(value).__name__
+
+class ParameterBinder(object):
+    """Checks the params of a call against a procedure and binds them to its arguments.
+
+    This is compiled once when the procedure is registered, so a call only
+    does the checks that apply to it, and bad calls are rejected with an
+    InvalidParametersError before the procedure is called rather than by
+    catching the TypeError python raises.
+
+    """
+
+    def __init__(self, name, args, defaults = None, varargs = False, varkw = False, types = None):
+        """ParameterBinder initialization.
+
+        args is the list of argument names, excluding self, and defaults the
+        default values of the last of them. types maps argument names to the
+        parameter type string ('num', 'str' etc.) their values must have.
+
+        """
+
+        self.name = name
+        self.args = list(args)
+        self.varargs = varargs
+        self.varkw = varkw
+
+        defaults = list(defaults or [])
+        self.required = len(self.args) - len(defaults)
+        self.defaults = [_noDefault] * self.required + defaults
+        self.named = zip(self.args, self.defaults)
+        self.indexes = dict([(arg, i) for i, arg in enumerate(self.args)])
+        if varargs:
+            self.maxArgs = sys.maxint
+        else:
+            self.maxArgs = len(self.args)
+
+        # (index, argument name, accepted python types, type string) of the
+        # arguments that are checked, null is accepted for optional arguments
+        self.checks = []
+        for arg, t in (types or {}).items():
+            if arg in self.indexes and t in _parameterTypes:
+                i = self.indexes[arg]
+                accepted = _parameterTypes[t]
+                if i >= self.required:
+                    accepted = accepted | frozenset([type(None)])
+                self.checks.append((i, arg, accepted, t))
+        self.checks.sort()
+
+    def bind(self, params = [], kwparams = {}):
+        """Return the positional and keyword arguments to call the procedure with.
+
+        throws InvalidParametersError if the params don't match the procedure.
+
+        """
+
+        n = len(params)
+        named = kwparams
+        if kwparams:
+            params = self.bindNamed(params, kwparams)
+            if self.varkw:
+                kwparams = dict([(k, v) for k, v in kwparams.items() if k not in self.indexes])
+            else:
+                kwparams = {}
+        else:
+            if n < self.required:
+                self.missing(self.args[n:self.required])
+            if n > self.maxArgs:
+                self.tooMany(n)
+
+        # only the params the client gave are checked, not the defaults
+        # bindNamed filled in
+        for i, arg, accepted, t in self.checks:
+            if i >= n and arg not in named:
+                continue
+            if i >= len(params):
+                break
+            if type(params[i]) not in accepted:
+                raise InvalidParametersError("%s parameter %s must be a %s, not %s" %
+                                             (self.name, arg, _typeNames[t], _jsonTypeName(params[i])))
+
+        return params, kwparams
+
+    def bindNamed(self, params, kwparams):
+        """Return the positional arguments with the named ones and defaults filled in."""
+
+        n = len(params)
+        if n > self.maxArgs:
+            self.tooMany(n)
+
+        args = list(params)
+        found = 0
+        for arg, default in self.named[n:]:
+            if arg in kwparams:
+                args.append(kwparams[arg])
+                found += 1
+            else:
+                args.append(default)
+
+        if found < len(kwparams):
+            # some names are not arguments, or were also given by position
+            repeated = [arg for arg in self.args[:n] if arg in kwparams]
+            if repeated:
+                raise InvalidParametersError("%s parameter %s given by position and name" %
+                                             (self.name, ', '.join(repeated)))
+            if not self.varkw:
+                unknown = [k for k in kwparams if k not in self.indexes]
+                raise InvalidParametersError("%s has no parameter %s" % (self.name, ', '.join(sorted(unknown))))
+        if n < self.required:
+            missing = [arg for arg, value in zip(self.args, args) if value is _noDefault]
+            if missing:
+                self.missing(missing)
+        return args
+
+    def missing(self, args):
+        raise InvalidParametersError("%s missing required parameter %s" % (self.name, ', '.join(args)))
+
+    def tooMany(self, n):
+        raise InvalidParametersError("%s takes at most %d parameters (%d given)" %
+                                     (self.name, len(self.args), n))
+
+def compileBinder(name, function, params = None):
+    """Return a ParameterBinder for function, or None if its arguments can't be found.
+
+    params are the FunctionMeta params of the procedure. Named ones are
+    matched to the arguments of the same name, and unnamed ones to the
+    arguments in order. Named params without a matching argument are ignored.
+
+    """
+
+    if inspect.isfunction(function) or inspect.ismethod(function):
+        target = function
+    elif hasattr(function, '__call__') and inspect.ismethod(function.__call__):
+        # a callable instance
+        target = function.__call__
+    else:
+        # builtins and the like can't be inspected
+        return None
+
+    args, varargs, varkw, defaults = inspect.getargspec(target)
+    if inspect.ismethod(target) and target.im_self != None:
+        args = args[1:]
+
+    # arguments unpacked from tuples are not supported
+    if [arg for arg in args if not isinstance(arg, str)]:
+        return None
+
+    types = {}
+    for i, p in enumerate(params or []):
+        if isinstance(p, dict):
+            types[p.get('name')] = p.get('type')
+        elif i < len(args):
+            types[args[i]] = p
+
+    return ParameterBinder(name, args, defaults, varargs != None, varkw != None, types)
@@ -0,0 +1,192 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""A cache of the results of idempotent procedures."""
+
+import threading
+import time
+
+__all__ = ['ResultCache']
+
+# defaults for ResultCache
+CACHE_SIZE = 1024
+CACHE_TTL = 60.0
+
+# the parameter types that need no conversion to be part of a key, bool is
+# left out so that true and 1 are different
+_scalarTypes = frozenset([str, unicode, int, long, float, type(None)])
+
+# the fields of a link in the recently used list
+_PREV, _NEXT, _KEY, _EXPIRES, _RESULT, _STAMP = range(6)
+
+def _canonical(obj):
+    """Return a hashable equivalent of the decoded JSON value obj.
+
+    Objects compare equal whatever the order of their members, and Arrays and
+    Objects, or true and 1, do not.
+
+    """
+
+    t = type(obj)
+    if t is list:
+        for x in obj:
+            if type(x) not in _scalarTypes:
+                return tuple([_canonical(x) for x in obj])
+        return tuple(obj)
+    elif t is dict:
+        return (dict, tuple(sorted([(k, _canonical(v)) for k, v in obj.iteritems()])))
+    elif t is bool:
+        return (bool, obj)
+    return obj
+
+class ResultCache(object):
+    """A least recently used cache of procedure results, that expire after ttl seconds.
+
+    Results are keyed on the method name and its parameters. At most maxSize
+    results are kept, and a ttl of 0 or None means results never expire.
+
+    A result can be stored with a stamp, any value describing the data it
+    was computed from, such as the mtime of a file. It is only found again
+    by a get with an equal stamp, so a result goes stale as soon as its data
+    changes, without waiting for the ttl.
+
+    """
+
+    def __init__(self, maxSize = CACHE_SIZE, ttl = CACHE_TTL):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> link, the links form a circular list from the least to the
+        # most recently used, so a lookup only relinks one entry
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None, None]
+        self.resetStats()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def key(self, method, params):
+        return (method, _canonical(params))
+
+    def get(self, key, stamp = None):
+        """Return a tuple of whether the result for key with stamp was found, and the result."""
+
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link == None:
+                self.misses += 1
+                return False, None
+            if link[_EXPIRES] != None and link[_EXPIRES] < time.time():
+                self._remove(link)
+                self.expired += 1
+                self.misses += 1
+                return False, None
+            if link[_STAMP] != stamp:
+                self._remove(link)
+                self.stale += 1
+                self.misses += 1
+                return False, None
+
+            # move it to the most recently used end
+            prev, next = link[_PREV], link[_NEXT]
+            prev[_NEXT] = next
+            next[_PREV] = prev
+            root = self.root
+            last = root[_PREV]
+            last[_NEXT] = root[_PREV] = link
+            link[_PREV] = last
+            link[_NEXT] = root
+
+            self.hits += 1
+            return True, link[_RESULT]
+        finally:
+            self.lock.release()
+
+    def put(self, key, result, stamp = None):
+        if self.ttl:
+            expires = time.time() + self.ttl
+        else:
+            expires = None
+
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link != None:
+                self._remove(link)
+            root = self.root
+            last = root[_PREV]
+            link = [last, root, key, expires, result, stamp]
+            last[_NEXT] = root[_PREV] = self.entries[key] = link
+            while len(self.entries) > self.maxSize:
+                self._remove(root[_NEXT])
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def _remove(self, link):
+        prev, next = link[_PREV], link[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+        del self.entries[link[_KEY]]
+
+    def invalidate(self, name = None, params = None):
+        """Remove cached results, returning the number removed.
+
+        With no arguments every result is removed. Otherwise name is a method,
+        or a service whose methods' results are all removed. If params is given
+        only the result of the call with those parameters is removed.
+
+        """
+
+        self.lock.acquire()
+        try:
+            if name == None:
+                keys = self.entries.keys()
+            elif params != None:
+                keys = [k for k in [self.key(name, params)] if k in self.entries]
+            else:
+                prefix = name + '.'
+                keys = [k for k in self.entries if k[0] == name or k[0].startswith(prefix)]
+            for k in keys:
+                self._remove(self.entries[k])
+            self.invalidations += len(keys)
+            return len(keys)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the hit and miss counts and size of the cache as a dictionary."""
+
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRatio': lookups and float(self.hits) / lookups or 0.0,
+                    'expired': self.expired,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'stale': self.stale,
+                    'size': len(self.entries),
+                    'maxSize': self.maxSize,
+                    'ttl': self.ttl}
+        finally:
+            self.lock.release()
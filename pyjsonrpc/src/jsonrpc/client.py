@@ -0,0 +1,477 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""A JSON-RPC client with a pool of persistent, pipelined connections.
+
+    client = ServiceClient(('localhost', 50042))
+    proxy = ServiceProxy(client)
+    print proxy.system.echo('test')
+
+    # concurrent calls
+    futures = [client.callAsync('system.echo', i) for i in range(10)]
+    print [f.result() for f in futures]
+
+    # several calls in one request
+    batch = client.batch()
+    a = batch.call('system.echo', 'a')
+    batch.notify('system.echo', 'b')
+    batch.send()
+    print a.result()
+
+"""
+
+import socket
+import threading
+import itertools
+import collections
+import logging
+import time
+
+from jsonrpcexceptions import JSONRPCError, InternalError, errorFromJSON
+from framing import JSONFramer, MAX_MESSAGE_SIZE
+from threadpool import Future
+from codec import defaultCodec
+from socketserver import RECVSIZE, KEEPALIVE_TIMEOUT, KEEPALIVE_MAX_REQUESTS
+
+__all__ = ['ServiceClient', 'ServiceProxy', 'Batch', 'ConnectionClosedError']
+
+# default number of connections to a server
+POOL_SIZE = 4
+# default limit on requests sent on a connection that are waiting for a response
+MAX_IN_FLIGHT = 32
+# default time to wait for a connection or a response
+CALL_TIMEOUT = 30.0
+
+class ConnectionClosedError(socket.error):
+    """Raised for a request whose connection closed before the response arrived."""
+
+def _params(args, kwargs):
+    if args and kwargs:
+        raise TypeError('a procedure can be called with positional or named arguments, not both')
+    return kwargs or list(args)
+
+def _raise(future, err):
+    future.setException((type(err), err, None))
+
+class ClientConnection(object):
+    """A connection to the server that requests are pipelined on.
+
+    Requests are sent without waiting for the responses to earlier ones, and
+    a reader thread completes their Futures as the responses arrive, matching
+    them by id.
+
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.sock = socket.create_connection(client.address, client.timeout)
+        self.framer = JSONFramer(client.maxMessageSize)
+        self.persistent = False
+        self.requests = 0       # messages sent, as counted by the server
+        self.pending = 0        # messages waiting for a response
+        self.lastUsed = time.time()
+        self.closed = False
+
+        self.sendLock = threading.Lock()
+        self.lock = threading.Lock()
+        self.inflight = {}                      # id -> Future
+        self.messages = collections.deque()     # ids of each message, in the order sent
+
+    def negotiate(self):
+        """Ask the server to keep the connection open, return True if it will."""
+
+        self.requests += 1
+        self.sock.sendall(self.client.codec.encode({'jsonrpc': '2.0', 'method': 'system.keepAlive',
+                                                    'params': [True], 'id': self.client.nextId()}))
+        json = self.framer.nextMessage()
+        while json == None:
+            data = self.sock.recv(RECVSIZE)
+            if not data:
+                return False
+            self.framer.feed(data)
+            json = self.framer.nextMessage()
+
+        self.persistent = self.client.codec.decode(json).get('result') == True
+        return self.persistent
+
+    def start(self):
+        self.sock.settimeout(self.client.timeout)
+        t = threading.Thread(target=self.read, name='ClientConnection-reader')
+        t.setDaemon(True)
+        t.start()
+
+    def usable(self):
+        """Return True if another request can be sent on this connection."""
+
+        if self.closed:
+            return False
+        if not self.persistent:
+            return self.requests == 0
+        return self.requests < self.client.maxRequests and \
+               time.time() - self.lastUsed < self.client.idleTimeout
+
+    def send(self, data, calls):
+        """Send the encoded message data, calls is a list of (id, Future) expecting a response."""
+
+        self.sendLock.acquire()
+        try:
+            if calls:
+                self.lock.acquire()
+                try:
+                    if self.closed:
+                        raise ConnectionClosedError('connection closed')
+                    for id_, future in calls:
+                        self.inflight[id_] = future
+                    self.messages.append([id_ for id_, future in calls])
+                finally:
+                    self.lock.release()
+            self.sock.sendall(data)
+        finally:
+            self.sendLock.release()
+
+    def read(self):
+        log = logging.getLogger('client')
+        try:
+            while 1:
+                json = self.framer.nextMessage()
+                if json == None:
+                    try:
+                        data = self.sock.recv(RECVSIZE)
+                    except socket.timeout:
+                        if self.pending:
+                            raise
+                        continue
+                    if not data:
+                        break
+                    self.framer.feed(data)
+                    continue
+                self.received(self.client.codec.decode(json))
+        except Exception, e:
+            if not self.closed:
+                log.debug('connection to %s failed: %s' % (self.client.address, e))
+        self.close()
+
+    def received(self, response):
+        self.lock.acquire()
+        try:
+            if self.messages:
+                ids = self.messages.popleft()
+            else:
+                ids = []
+            if not isinstance(response, list):
+                response = [response]
+            futures = []
+            for obj in response:
+                if obj.get('id') == None:
+                    # an error for the whole message, such as a parse error
+                    futures.extend([(self.inflight.pop(id_), obj) for id_ in ids if id_ in self.inflight])
+                elif obj['id'] in self.inflight:
+                    futures.append((self.inflight.pop(obj['id']), obj))
+            missing = [self.inflight.pop(id_) for id_ in ids if id_ in self.inflight]
+        finally:
+            self.lock.release()
+
+        self.client.messageDone(self)
+        for future, obj in futures:
+            if obj.get('error') != None:
+                _raise(future, errorFromJSON(obj['error']))
+            else:
+                future.setResult(obj.get('result'))
+        for future in missing:
+            _raise(future, InternalError('No response was returned for the request'))
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            futures = self.inflight.values()
+            self.inflight.clear()
+            self.messages.clear()
+        finally:
+            self.lock.release()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for future in futures:
+            _raise(future, ConnectionClosedError('connection closed before the response arrived'))
+        self.client.connectionClosed(self)
+
+class ServiceClient(object):
+    """Calls procedures on a JSON-RPC server over a pool of connections.
+
+    Up to poolSize connections are opened to the server at address. If
+    keepAlive is true each one asks the server to keep it open with
+    system.keepAlive; if the server agrees, up to maxInFlight requests are
+    pipelined on it, and it is reused until maxRequests requests have been
+    sent or it has been idle for idleTimeout seconds. Otherwise every request
+    is sent on a new connection. Requests wait up to timeout seconds for a
+    free connection, and a connection whose responses stop arriving for
+    timeout seconds is closed, failing the requests waiting on it.
+
+    """
+
+    def __init__(self, address, poolSize = POOL_SIZE, timeout = CALL_TIMEOUT,
+                 keepAlive = True, maxInFlight = MAX_IN_FLIGHT,
+                 maxRequests = KEEPALIVE_MAX_REQUESTS, idleTimeout = KEEPALIVE_TIMEOUT / 2,
+                 maxMessageSize = MAX_MESSAGE_SIZE, json = None):
+        if json == None:
+            json = defaultCodec()
+
+        self.address = address
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self.keepAlive = keepAlive
+        self.maxInFlight = maxInFlight
+        self.maxRequests = maxRequests
+        self.idleTimeout = idleTimeout
+        self.maxMessageSize = maxMessageSize
+        self.codec = json
+
+        self.ids = itertools.count(1)
+        self.cond = threading.Condition()
+        self.connections = []
+        self.connecting = 0
+        self.persistent = None      # whether the server keeps connections open
+        self.opened = 0
+        self.sent = 0
+
+    def nextId(self):
+        return self.ids.next()
+
+    def call(self, method, *args, **kwargs):
+        """Call method and return its result, JSONRPCErrors from the server are raised."""
+
+        # the connection times out instead of the Future, as waiting with a
+        # timeout polls
+        return self.callAsync(method, *args, **kwargs).result()
+
+    def callAsync(self, method, *args, **kwargs):
+        """Send a call to method and return a Future for its result."""
+
+        future = Future()
+        id_ = self.nextId()
+        data = self.codec.encode({'jsonrpc': '2.0', 'method': method,
+                                  'params': _params(args, kwargs), 'id': id_})
+        self.send(data, [(id_, future)])
+        return future
+
+    def notify(self, method, *args, **kwargs):
+        """Send a notification to method, which has no response."""
+
+        self.send(self.codec.encode({'jsonrpc': '2.0', 'method': method,
+                                     'params': _params(args, kwargs)}), [])
+
+    def batch(self):
+        """Return a Batch that sends calls to this client's server together."""
+
+        return Batch(self)
+
+    def send(self, data, calls):
+        conn = self.acquire(bool(calls))
+        try:
+            conn.send(data, calls)
+        except socket.error:
+            conn.close()
+            raise
+        if not calls and not conn.persistent:
+            # nothing will be read, the server closes the connection
+            conn.close()
+
+    def acquire(self, response):
+        """Return a connection to send a message on, opening one if needed."""
+
+        deadline = time.time() + self.timeout
+        self.cond.acquire()
+        try:
+            while 1:
+                for conn in self.connections[:]:
+                    if conn.pending == 0 and not conn.usable():
+                        conn.close()
+
+                # the least loaded connection that will take another request
+                best = None
+                for conn in self.connections:
+                    if conn.usable() and conn.pending < self.maxInFlight and \
+                       (best == None or conn.pending < best.pending):
+                        best = conn
+                if best != None:
+                    break
+
+                if len(self.connections) + self.connecting < self.poolSize:
+                    self.connecting += 1
+                    self.cond.release()
+                    try:
+                        best = self.connect()
+                    finally:
+                        self.cond.acquire()
+                        self.connecting -= 1
+                    self.connections.append(best)
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectionClosedError('timed out waiting for a connection')
+                self.cond.wait(remaining)
+
+            best.requests += 1
+            best.lastUsed = time.time()
+            if response:
+                best.pending += 1
+            self.sent += 1
+            return best
+        finally:
+            self.cond.release()
+
+    def connect(self):
+        conn = ClientConnection(self)
+        if self.keepAlive and self.persistent != False:
+            try:
+                self.persistent = conn.negotiate()
+            except JSONRPCError:
+                self.persistent = False
+            if not self.persistent:
+                # the server closes the connection after the response
+                conn.sock.close()
+                conn = ClientConnection(self)
+        self.opened += 1
+        conn.start()
+        return conn
+
+    def messageDone(self, conn):
+        self.cond.acquire()
+        try:
+            conn.pending -= 1
+            conn.lastUsed = time.time()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if not conn.persistent or (conn.pending == 0 and not conn.usable()):
+            conn.close()
+
+    def connectionClosed(self, conn):
+        self.cond.acquire()
+        try:
+            if conn in self.connections:
+                self.connections.remove(conn)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        """Return the number of open and opened connections and of messages sent."""
+
+        self.cond.acquire()
+        try:
+            return {'connections': len(self.connections),
+                    'opened': self.opened,
+                    'sent': self.sent,
+                    'inFlight': sum([c.pending for c in self.connections]),
+                    'persistent': bool(self.persistent)}
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Close every connection, failing the calls still waiting for a response."""
+
+        self.cond.acquire()
+        try:
+            connections = self.connections[:]
+        finally:
+            self.cond.release()
+        for conn in connections:
+            conn.close()
+
+class Batch(object):
+    """Calls and notifications that are sent to the server as one batch request.
+
+    It can be used in a with statement, which sends it at the end.
+
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+        self.calls = []
+
+    def call(self, method, *args, **kwargs):
+        """Add a call to method, and return a Future for its result."""
+
+        future = Future()
+        id_ = self.client.nextId()
+        self.requests.append({'jsonrpc': '2.0', 'method': method,
+                              'params': _params(args, kwargs), 'id': id_})
+        self.calls.append((id_, future))
+        return future
+
+    callAsync = call
+
+    def notify(self, method, *args, **kwargs):
+        """Add a notification to method."""
+
+        self.requests.append({'jsonrpc': '2.0', 'method': method,
+                              'params': _params(args, kwargs)})
+
+    def send(self):
+        """Send the batch. The Futures of its calls complete when the response arrives."""
+
+        if self.requests:
+            requests, calls = self.requests, self.calls
+            self.requests = []
+            self.calls = []
+            self.client.send(self.client.codec.encode(requests), calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType == None:
+            self.send()
+
+class ServiceProxy(object):
+    """Calls procedures as attributes, proxy.update.version('x') calls update.version.
+
+    target is a ServiceClient, a Batch, or an address to create a
+    ServiceClient for. If futures is true a Future is returned instead of
+    the result; calls through a Batch always return Futures.
+
+    """
+
+    def __init__(self, target, name = None, futures = False):
+        if isinstance(target, tuple):
+            target = ServiceClient(target)
+        self._target = target
+        self._name = name
+        self._futures = futures
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if self._name != None:
+            name = '%s.%s' % (self._name, name)
+        return ServiceProxy(self._target, name, self._futures)
+
+    def __call__(self, *args, **kwargs):
+        if self._name == None:
+            raise TypeError('a procedure name is required')
+        if self._futures:
+            return self._target.callAsync(self._name, *args, **kwargs)
+        return self._target.call(self._name, *args, **kwargs)
+
+    def __repr__(self):
+        return '<ServiceProxy %s>' % (self._name or '')
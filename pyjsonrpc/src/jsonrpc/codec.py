@@ -0,0 +1,136 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""JSON codecs used by ServiceHandler to decode requests and encode results.
+
+A codec is any object with decode(string) and encode(object) methods, that
+raise demjson's JSONDecodeError and JSONEncodeError on failure, so a demjson
+JSON instance can be used as a codec directly.
+
+"""
+
+from demjson import JSON, inf, neginf
+
+try:
+    from nicefloat import nicefloat
+except ImportError:
+    # from python 2.7 repr already gives the shortest string that represents a float
+    nicefloat = None
+
+try:
+    import json as _json
+except ImportError:
+    try:
+        import simplejson as _json
+    except ImportError:
+        _json = None
+
+__all__ = ['niceJSON', 'StdlibCodec', 'EncodedJSON', 'EncodedObject', 'defaultCodec']
+
+class niceJSON(JSON):
+    """A subclass of JSON that uses nicefloat to print the shortest decimal that represents a float."""
+
+    def __init__(self, strict=False, compactly=True, escape_unicode=False):
+        JSON.__init__(self, strict, compactly, escape_unicode)
+
+    def encode_number(self, n):
+        if isinstance(n, float):
+            # compare by value, as not every NaN or infinity is demjson's instance
+            if n != n:
+                return 'NaN'
+            elif n == inf:
+                return 'Infinity'
+            elif n == neginf:
+                return '-Infinity'
+
+            if nicefloat == None:
+                return repr(n)
+            return nicefloat().str(n)
+        else:
+            return JSON.encode_number(self, n)
+
+def _jsonEquivalent(obj):
+    """Encoding hook for objects that provide json_equivalent, such as JSONRPCError."""
+
+    if hasattr(obj, 'json_equivalent'):
+        return obj.json_equivalent()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+class StdlibCodec(object):
+    """A codec using the C accelerated json module from the standard library.
+
+    Like niceJSON it writes NaN, Infinity and -Infinity for the non finite
+    floats and the shortest decimal for other floats. Anything the json module
+    rejects, either input it can not parse or objects it can not encode, is
+    passed on to fallback (a strict niceJSON by default) so the result is the
+    same as using demjson alone.
+
+    """
+
+    def __init__(self, fallback = None):
+        if fallback == None:
+            fallback = niceJSON(True)
+        self.fallback = fallback
+
+        self.decoder = _json.JSONDecoder()
+        self.encoder = _json.JSONEncoder(separators=(',', ':'), allow_nan=True,
+                                         default=_jsonEquivalent)
+
+    def decode(self, data):
+        try:
+            return self.decoder.decode(data)
+        except ValueError:
+            return self.fallback.decode(data)
+
+    def encode(self, obj):
+        try:
+            return self.encoder.encode(obj)
+        except (TypeError, ValueError):
+            return self.fallback.encode(obj)
+
+class EncodedJSON(object):
+    """A result that has already been encoded.
+
+    ServiceHandler puts json in the response as is, so a result that is sent
+    often only needs to be encoded once.
+
+    """
+
+    def __init__(self, json):
+        self.json = json
+
+class EncodedObject(dict):
+    """A dictionary result that has also already been encoded, as json.
+
+    To python callers it is an ordinary dictionary, and ServiceHandler puts
+    json in the response instead of encoding it again. It must not be
+    changed once it is made, as json would no longer match it.
+
+    """
+
+    def __init__(self, value, json):
+        dict.__init__(self, value)
+        self.json = json
+
+def defaultCodec():
+    """Return the fastest codec available.
+
+    That is a StdlibCodec if there is a json module and floats repr to their
+    shortest decimal (python 2.7 and later), otherwise a strict niceJSON.
+
+    """
+
+    if _json != None and repr(1.1) == '1.1':
+        return StdlibCodec()
+    return niceJSON(True)
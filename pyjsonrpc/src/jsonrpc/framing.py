@@ -0,0 +1,130 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Framing of JSON messages sent over a stream socket."""
+
+import re
+
+from jsonrpcexceptions import InvalidRequestError
+
+__all__ = ['JSONFramer', 'MAX_MESSAGE_SIZE']
+
+# default limit on the size of a single message
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# the characters that matter outside and inside of strings
+_structural = re.compile(r'[{}\[\]"]')
+_stringEnd = re.compile(r'["\\]')
+_nonSpace = re.compile(r'\S')
+
+_OPEN = (ord('{'), ord('['))
+_CLOSE = (ord('}'), ord(']'))
+_QUOTE = ord('"')
+_BACKSLASH = ord('\\')
+
+class JSONFramer(object):
+    """Splits a stream of bytes into complete top level JSON values.
+
+    Data is added with feed as it arrives, and each complete Object or Array
+    is returned by nextMessage. The scan picks up where it left off, and
+    jumps through strings with a regular expression, so a large message is
+    found in linear time without ever being parsed. Only the framing is
+    checked, the messages still need to be decoded.
+
+    """
+
+    def __init__(self, maxSize = MAX_MESSAGE_SIZE):
+        self.maxSize = maxSize
+        self.buffer = bytearray()
+
+        self._pos = 0           # where scanning continues from
+        self._depth = 0         # nesting depth of Objects and Arrays
+        self._inString = False
+
+    def feed(self, data):
+        """Add received data to the buffer."""
+
+        self.buffer += data
+
+    def pending(self):
+        """Return True if the buffer holds part of a message."""
+
+        return _nonSpace.search(self.buffer) != None
+
+    def nextMessage(self):
+        """Return the next complete message as a string, or None if there isn't one yet.
+
+        throws InvalidRequestError if the data is not an Object or Array, or
+        if a message is larger than maxSize. The stream can not be recovered
+        after that.
+
+        """
+
+        buf = self.buffer
+        pos = self._pos
+
+        if self._depth == 0:
+            # skip the whitespace before the next message
+            m = _nonSpace.search(buf, pos)
+            if m == None:
+                del buf[:]
+                self._pos = 0
+                return None
+            del buf[:m.start()]
+            pos = 0
+            if buf[0] not in _OPEN:
+                raise InvalidRequestError("Request is not an Object or Array")
+
+        while 1:
+            if self._inString:
+                m = _stringEnd.search(buf, pos)
+                if m == None:
+                    pos = len(buf)
+                    break
+                if buf[m.start()] == _BACKSLASH:
+                    if m.end() == len(buf):
+                        # wait for the escaped character
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                else:
+                    pos = m.end()
+                    self._inString = False
+            else:
+                m = _structural.search(buf, pos)
+                if m == None:
+                    pos = len(buf)
+                    break
+                c = buf[m.start()]
+                pos = m.end()
+                if c == _QUOTE:
+                    self._inString = True
+                elif c in _OPEN:
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        break
+
+        if pos > self.maxSize:
+            raise InvalidRequestError("Request exceeds the maximum size of %d bytes" % self.maxSize)
+
+        if self._depth != 0 or self._inString:
+            self._pos = pos
+            return None
+
+        message = str(buf[:pos])
+        del buf[:pos]
+        self._pos = 0
+        return message
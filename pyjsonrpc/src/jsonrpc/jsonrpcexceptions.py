@@ -66,3 +66,28 @@ class JSONRPCAssertionError(JSONRPCError):
 class JSONRPCNotImplementedError(JSONRPCError):
     def __init__(self, data=None):
         JSONRPCError.__init__(self, -32002, "Not Implemented", data)
+
+_errorClasses = {}
+for _cls in (ParseError, InvalidRequestError, MethodNotFoundError,
+             InvalidParametersError, InternalError, ApplicationError,
+             JSONRPCAssertionError, JSONRPCNotImplementedError):
+    _errorClasses[_cls().code] = _cls
+del _cls
+
+def errorFromJSON(obj):
+    """Return the JSONRPCError for the error member of a response.
+    
+    The standard error codes give an instance of their subclass, others a
+    JSONRPCError.
+    
+    """
+    
+    code = obj.get('code')
+    cls = _errorClasses.get(code)
+    if cls == None:
+        return JSONRPCError(code, obj.get('message'), obj.get('data'))
+    
+    err = cls(obj.get('data'))
+    if obj.get('message') != None:
+        err.message = obj['message']
+    return err
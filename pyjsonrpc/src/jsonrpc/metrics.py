@@ -0,0 +1,219 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Per method call metrics for ServiceHandler."""
+
+import math
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # windows
+    resource = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+__all__ = ['LatencyHistogram', 'MethodStats', 'ServiceMetrics', 'threadCPUTime']
+
+# RUSAGE_THREAD is missing from the resource module before python 3.2
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', sys.platform.startswith('linux') and 1 or None)
+
+# the names calls are recorded under when they have no registered method
+UNKNOWN_METHOD = '<unknown>'
+INVALID_REQUEST = '<invalid>'
+
+def _clockGettime():
+    """Return clock_gettime from the C library, or None if it is not available."""
+
+    if ctypes == None or not sys.platform.startswith('linux'):
+        return None
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        return lib.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+_clock_gettime = _clockGettime()
+# from linux/time.h
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+if _clock_gettime != None:
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    def threadCPUTime():
+        """Return the CPU time in seconds used by the current thread."""
+
+        # getrusage is only as precise as the scheduler tick, which is longer
+        # than most calls
+        ts = _timespec()
+        _clock_gettime(_CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+elif resource != None and _RUSAGE_THREAD != None:
+    def threadCPUTime():
+        """Return the CPU time in seconds used by the current thread."""
+
+        usage = resource.getrusage(_RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+else:
+    def threadCPUTime():
+        """Return the CPU time in seconds used by the process.
+
+        The time used by one thread can't be found on this platform, so this
+        includes the time of every thread.
+
+        """
+
+        return time.clock()
+
+class LatencyHistogram(object):
+    """Counts of values in buckets whose bounds grow geometrically.
+
+    Memory use is fixed no matter how many values are added. Percentiles are
+    given as the upper bound of the bucket they fall in, so they are at most
+    growth - 1 (10% by default) above the true value.
+
+    """
+
+    def __init__(self, minValue = 1e-6, maxValue = 100.0, growth = 1.1):
+        self.minValue = minValue
+        self.logGrowth = math.log(growth)
+        self.growth = growth
+        # bucket 0 holds values up to minValue, the last bucket everything
+        # above maxValue
+        self.size = int(math.ceil(math.log(maxValue / minValue) / self.logGrowth)) + 2
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * self.size
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.minValue:
+            i = 0
+        else:
+            i = min(int(math.log(value / self.minValue) / self.logGrowth) + 1, self.size - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return the value that p percent of the values are at or below."""
+
+        if self.count == 0:
+            return 0.0
+
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                break
+        return min(self.minValue * self.growth ** i, self.max)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+class MethodStats(object):
+    """The metrics of one method."""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}        # error code -> count
+        self.latency = LatencyHistogram()
+        self.cpuTime = 0.0
+        self.requestBytes = 0
+        self.responseBytes = 0
+
+    def record(self, wallTime, cpuTime, requestBytes, responseBytes, errorCode):
+        self.calls += 1
+        if errorCode != None:
+            self.errors[errorCode] = self.errors.get(errorCode, 0) + 1
+        self.latency.add(wallTime)
+        self.cpuTime += cpuTime
+        self.requestBytes += requestBytes
+        self.responseBytes += responseBytes
+
+    def stats(self):
+        """Return the metrics as a JSON encodable dictionary, times are in milliseconds."""
+
+        calls = self.calls or 1
+        return {'calls': self.calls,
+                'errors': dict([(str(code), n) for code, n in self.errors.items()]),
+                'latency': {'mean': self.latency.mean() * 1000,
+                            'p50': self.latency.percentile(50) * 1000,
+                            'p95': self.latency.percentile(95) * 1000,
+                            'p99': self.latency.percentile(99) * 1000,
+                            'max': self.latency.max * 1000},
+                'cpu': {'total': self.cpuTime * 1000,
+                        'mean': self.cpuTime * 1000 / calls},
+                'requestBytes': {'total': self.requestBytes,
+                                 'mean': self.requestBytes / calls},
+                'responseBytes': {'total': self.responseBytes,
+                                  'mean': self.responseBytes / calls}}
+
+class ServiceMetrics(object):
+    """Call metrics for each method of a ServiceHandler.
+
+    Calls to methods that don't exist are recorded under UNKNOWN_METHOD, and
+    requests that can't be parsed or are invalid under INVALID_REQUEST, so
+    memory use only grows with the number of registered methods.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.methods = {}
+            self.since = time.time()
+        finally:
+            self.lock.release()
+
+    def record(self, method, wallTime, cpuTime, requestBytes, responseBytes, errorCode = None):
+        self.lock.acquire()
+        try:
+            stats = self.methods.get(method)
+            if stats == None:
+                stats = self.methods[method] = MethodStats()
+            stats.record(wallTime, cpuTime, requestBytes, responseBytes, errorCode)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return the metrics of every method as a JSON encodable dictionary."""
+
+        self.lock.acquire()
+        try:
+            return {'since': self.since,
+                    'uptime': time.time() - self.since,
+                    'methods': dict([(name, s.stats()) for name, s in self.methods.items()])}
+        finally:
+            self.lock.release()
@@ -0,0 +1,243 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""A pre-forking JSON-RPC server, that runs procedures on every processor."""
+
+import os
+import sys
+import errno
+import signal
+import socket
+import logging
+import threading
+import time
+
+from socketserver import ThreadedTCPServiceServer
+
+__all__ = ['PreforkServiceServer', 'cpuCount', 'isWorkerProcess']
+
+# SO_REUSEPORT is missing from the socket module before python 3.4
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', sys.platform.startswith('linux') and 15 or None)
+
+# a worker that exits sooner than this after starting is restarted after a delay
+MIN_UPTIME = 1.0
+# the longest delay before restarting a worker that keeps failing
+MAX_RESTART_DELAY = 30.0
+
+# set in the worker processes of a PreforkServiceServer
+_workerProcess = False
+
+def isWorkerProcess():
+    """Return True in a worker process of a PreforkServiceServer.
+
+    Services that keep state a client has to come back to, such as a port
+    they listen on, can't offer it there, as the next connection may reach
+    another worker.
+
+    """
+
+    return _workerProcess
+
+def cpuCount():
+    """Return the number of processors, or 1 if it can not be found."""
+
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+class PreforkServiceServer(object):
+    """A supervisor that serves JSON-RPC requests from several worker processes.
+
+    Procedures run in a ThreadedTCPServiceServer are serialized by the global
+    interpreter lock, so CPU bound procedures such as compressing a file can
+    only use one processor. PreforkServiceServer forks processes workers
+    (one per processor by default) that accept connections on the same port.
+
+    Every worker calls handlerFactory to build its own ServiceHandler, so no
+    state is shared between workers, and serves it with serverClass, which is
+    passed serverArgs as keyword arguments. By default the listening socket
+    is created before forking and inherited by the workers; with reusePort
+    each worker binds its own socket with SO_REUSEPORT, and the kernel
+    balances connections between them.
+
+    A worker that exits is restarted, after a delay that grows while workers
+    keep failing straight after starting. Fork is required, so this is not
+    available on Windows.
+
+    """
+
+    def __init__(self, server_address, handlerFactory, processes = None,
+                 serverClass = ThreadedTCPServiceServer, reusePort = False,
+                 **serverArgs):
+        if not hasattr(os, 'fork'):
+            raise NotImplementedError('PreforkServiceServer requires os.fork')
+        if reusePort and SO_REUSEPORT == None:
+            raise ValueError('SO_REUSEPORT is not supported on this platform')
+
+        self.handlerFactory = handlerFactory
+        self.processes = processes or cpuCount()
+        self.serverClass = serverClass
+        self.serverArgs = serverArgs
+        self.reusePort = reusePort
+
+        self.socket = self.createSocket(server_address)
+        self.server_address = self.socket.getsockname()
+        if reusePort:
+            # the port is now fixed, so workers bind to it instead of to port 0
+            self.bindAddress = self.server_address
+        else:
+            self.socket.listen(serverClass.request_queue_size)
+
+        self.workers = {}           # pid -> start time
+        self.restarts = 0
+        self.running = False
+        self.isWorker = False
+
+    def createSocket(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reusePort:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(address)
+        return sock
+
+    def serve_forever(self):
+        """Start the workers and restart them when they exit, until shutdown is called.
+
+        When called from the main thread SIGTERM and SIGINT also shut the
+        server down.
+
+        """
+
+        log = logging.getLogger('service')
+        self.running = True
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.shutdown())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.shutdown())
+        except ValueError:
+            # not the main thread
+            pass
+
+        delay = 0.0
+        while self.running:
+            while self.running and len(self.workers) < self.processes:
+                self.spawnWorker()
+
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            started = self.workers.pop(pid, None)
+            if started == None or not self.running:
+                continue
+
+            log.error('worker %d exited with status %d, restarting' % (pid, status))
+            self.restarts += 1
+            if time.time() - started < MIN_UPTIME:
+                # back off if workers are failing at startup
+                delay = min(max(delay * 2, MIN_UPTIME), MAX_RESTART_DELAY)
+                time.sleep(delay)
+            else:
+                delay = 0.0
+
+        self.reapWorkers()
+
+    def spawnWorker(self):
+        global _workerProcess
+        pid = os.fork()
+        if pid == 0:
+            _workerProcess = True
+            self.isWorker = True
+            status = 1
+            try:
+                try:
+                    self.runWorker()
+                    status = 0
+                except:
+                    logging.getLogger('service').exception('worker %d failed' % os.getpid())
+            finally:
+                # never return into the supervisor's loop
+                os._exit(status)
+
+        self.workers[pid] = time.time()
+        logging.getLogger('service').info('started worker %d' % pid)
+
+    def runWorker(self):
+        """Build a service handler and serve it until SIGTERM is received."""
+
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        # the supervisor handles interrupts from the terminal
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        server = self.serverClass(self.server_address, self.handlerFactory(),
+                                  bind_and_activate=False, **self.serverArgs)
+        server.socket.close()
+        if self.reusePort:
+            self.socket.close()
+            server.socket = self.createSocket(self.bindAddress)
+            server.socket.listen(server.request_queue_size)
+        else:
+            server.socket = self.socket
+        # every worker is woken when a connection arrives, so those that lose
+        # the race to accept it must not block in accept
+        server.socket.setblocking(0)
+
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+        # signals are only delivered to the main thread, so wait here
+        while not stopping.isSet() and t.isAlive():
+            stopping.wait(1.0)
+
+        server.shutdown()
+        server.server_close()
+
+    def shutdown(self):
+        """Stop restarting workers and ask them to exit.
+
+        serve_forever returns once they have.
+
+        """
+
+        self.running = False
+        for pid in self.workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def reapWorkers(self):
+        # a worker may have been started after shutdown signalled the others
+        self.shutdown()
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            self.workers.pop(pid, None)
+        self.workers.clear()
+
+    def server_close(self):
+        self.socket.close()
@@ -0,0 +1,121 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Profiling of service procedures while the server is running."""
+
+import os
+import re
+import threading
+import time
+import cProfile
+import pstats
+
+__all__ = ['RequestProfiler']
+
+class RequestProfiler(object):
+    """Profiles calls with cProfile and aggregates the statistics per method.
+
+    Every call to one of methods is profiled, and if every is greater than 0
+    so is every every'th call to any other method. Statistics are written as
+    pstats files to directory by dump.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.every = 0
+        self.methods = set()
+        self.count = 0
+        self.reset()
+
+    def configure(self, every = 0, methods = None):
+        self.lock.acquire()
+        try:
+            self.every = every
+            self.methods = set(methods or [])
+            self.count = 0
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        """Discard the statistics collected so far."""
+
+        self.lock.acquire()
+        try:
+            self.stats = {}     # method -> pstats.Stats
+            self.calls = {}     # method -> number of profiled calls
+        finally:
+            self.lock.release()
+
+    def sample(self, name):
+        """Return True if this call to the method name should be profiled."""
+
+        if name in self.methods:
+            return True
+        if self.every > 0:
+            self.lock.acquire()
+            try:
+                self.count += 1
+                return self.count % self.every == 0
+            finally:
+                self.lock.release()
+        return False
+
+    def runcall(self, name, fn, *args):
+        """Call fn with args under the profiler, adding the statistics to those of name."""
+
+        # cProfile only follows the thread it was enabled in, so concurrent
+        # calls each need their own profiler
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(fn, *args)
+        finally:
+            prof.create_stats()
+            self.lock.acquire()
+            try:
+                if name in self.stats:
+                    self.stats[name].add(prof)
+                else:
+                    self.stats[name] = pstats.Stats(prof)
+                self.calls[name] = self.calls.get(name, 0) + 1
+            finally:
+                self.lock.release()
+
+    def dump(self):
+        """Write the statistics of each method to a pstats file, and return the file names."""
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        files = []
+        self.lock.acquire()
+        try:
+            for name, stats in self.stats.items():
+                path = os.path.join(self.directory, '%s-%s.pstats' % (re.sub(r'[^\w.-]', '_', name), stamp))
+                stats.dump_stats(path)
+                files.append(path)
+        finally:
+            self.lock.release()
+        return files
+
+    def status(self):
+        self.lock.acquire()
+        try:
+            return {'every': self.every,
+                    'methods': sorted(self.methods),
+                    'calls': dict(self.calls)}
+        finally:
+            self.lock.release()
@@ -0,0 +1,103 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""Encoding of JSON-RPC responses."""
+
+from jsonrpcexceptions import JSONRPCError, InternalError
+from codec import EncodedJSON, EncodedObject
+
+__all__ = ['ResponseWriter']
+
+# the envelopes of responses, the encoded result or error and id are
+# spliced in so only they need encoding
+RESULT_TEMPLATE = '{"jsonrpc":"2.0","result":%s,"id":%s}'
+ERROR_TEMPLATE = '{"jsonrpc":"2.0","error":%s,"id":%s}'
+
+# the most error codes and messages whose encoding is kept
+MAX_ERROR_HEADS = 256
+
+class ResponseWriter(object):
+    """Writes encoded JSON-RPC 2.0 responses with the codec json.
+
+    Only the result, or the data of an error, and the id of a response are
+    encoded for each response. The code and message of errors are encoded
+    the first time they are used and kept, so a standard error without data
+    costs no encoding at all.
+
+    """
+
+    def __init__(self, json):
+        self.json = json
+        # (code, message) -> the start of the encoded error object, without
+        # the closing brace
+        self.errorHeads = {}
+
+    def result(self, result, id_):
+        """Return the encoded response with result for the request id_.
+
+        result may be an EncodedJSON or EncodedObject, whose json is used as
+        is.
+
+        """
+
+        t = type(result)
+        if t is int or t is long:
+            encoded = str(result)
+        elif t is bool:
+            encoded = result and 'true' or 'false'
+        elif result == None:
+            encoded = 'null'
+        elif t is EncodedJSON or t is EncodedObject:
+            encoded = result.json
+        else:
+            encoded = self.json.encode(result)
+        return RESULT_TEMPLATE % (encoded, self.encodeId(id_))
+
+    def error(self, err, id_):
+        """Return the encoded response with the error err for the request id_."""
+
+        return ERROR_TEMPLATE % (self.encodeError(err), self.encodeId(id_))
+
+    def encodeId(self, id_):
+        t = type(id_)
+        if t is int or t is long:
+            return str(id_)
+        elif id_ == None:
+            return 'null'
+        return self.json.encode(id_)
+
+    def encodeError(self, err):
+        """Return the encoded error object of err.
+
+        err is a JSONRPCError, any other exception is sent as an InternalError.
+
+        """
+
+        if not isinstance(err, JSONRPCError):
+            err = InternalError(str(err))
+        # subclasses that encode themselves differently are left to the codec
+        if type(err).json_equivalent.im_func is not JSONRPCError.json_equivalent.im_func:
+            return self.json.encode(err)
+
+        key = (err.code, err.message)
+        head = self.errorHeads.get(key)
+        if head == None:
+            head = '{"code":%s,"message":%s' % (self.json.encode(err.code), self.json.encode(err.message))
+            # errors built with varying messages are not kept
+            if len(self.errorHeads) < MAX_ERROR_HEADS:
+                self.errorHeads[key] = head
+
+        if err.data == None:
+            return head + '}'
+        return '%s,"data":%s}' % (head, self.json.encode(err.data))
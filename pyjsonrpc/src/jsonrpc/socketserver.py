@@ -15,47 +15,258 @@
 import SocketServer
 import socket
 import logging
+import threading
 
-__all__ = ['TCPServiceServer', 'ThreadedTCPServiceServer', 'ServiceRequestHandler']
+from jsonrpcexceptions import JSONRPCError
+from framing import JSONFramer, MAX_MESSAGE_SIZE
+from threadpool import ThreadPool
+import parametertypes
 
-RECVSIZE = 1024
+__all__ = ['TCPServiceServer', 'ThreadedTCPServiceServer', 'PooledTCPServiceServer',
+           'ServiceRequestHandler', 'ConnectionStats']
+
+RECVSIZE = 16384
+
+# defaults for persistent connections
+KEEPALIVE_TIMEOUT = 30.0
+KEEPALIVE_MAX_REQUESTS = 1000
+
+# defaults for PooledTCPServiceServer
+POOL_WORKERS = 16
+POOL_QUEUE_SIZE = 64
+
+# the connection whose request is being handled by the current thread
+_connection = threading.local()
+
+class Connection(object):
+    """The state of a client connection."""
+    
+    def __init__(self, server):
+        self.server = server
+        self.keepAlive = False
+        self.requests = 0
+
+def keepConnectionAlive(enable = True):
+    """Keep the connection this request arrived on open for further requests.
+    
+    Returns True if the connection will be kept open, False otherwise.
+    
+    """
+    
+    conn = getattr(_connection, 'current', None)
+    if conn == None or not conn.server.keepAlive:
+        return False
+    
+    conn.keepAlive = bool(enable)
+    return conn.keepAlive
+
+def registerKeepAlive(serviceHandler):
+    """Register the system.keepAlive procedure with serviceHandler."""
+    
+    serviceHandler.registerFunction(keepConnectionAlive, 'system.keepAlive',
+                      'This method takes an optional boolean parameter (default true). If true the connection is kept open for further requests after the response, until it is idle for too long. It returns true if the connection will be kept open.',
+                      params = parametertypes.Boolean(),
+                      ret = parametertypes.Boolean())
+
+def handleConnectionRequest(serviceHandler, conn, json):
+    """Have serviceHandler handle a request that arrived on the Connection conn."""
+    
+    _connection.current = conn
+    try:
+        return serviceHandler.handleRequest(json)
+    finally:
+        _connection.current = None
+
+class ConnectionStats(object):
+    """Counts of connections and requests, for measuring connection reuse."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.connections = 0
+        self.persistentConnections = 0
+        self.requests = 0
+        self.reusedRequests = 0     # requests that did not need a new connection
+        self.idleTimeouts = 0
+        self.requestLimitCloses = 0
+    
+    def connectionClosed(self, conn, idleTimeout = False):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+            self.requests += conn.requests
+            if conn.requests > 1:
+                self.reusedRequests += conn.requests - 1
+            if conn.keepAlive:
+                self.persistentConnections += 1
+                if idleTimeout:
+                    self.idleTimeouts += 1
+                elif conn.requests >= conn.server.maxRequests:
+                    self.requestLimitCloses += 1
+        finally:
+            self.lock.release()
+    
+    def reuseRatio(self):
+        """Return the fraction of requests that were served on an already open connection."""
+        
+        if self.requests == 0:
+            return 0.0
+        return float(self.reusedRequests) / self.requests
+    
+    def stats(self):
+        """Return the statistics as a dictionary."""
+        
+        self.lock.acquire()
+        try:
+            return {'connections': self.connections,
+                    'persistentConnections': self.persistentConnections,
+                    'requests': self.requests,
+                    'reusedRequests': self.reusedRequests,
+                    'reuseRatio': self.reuseRatio(),
+                    'idleTimeouts': self.idleTimeouts,
+                    'requestLimitCloses': self.requestLimitCloses}
+        finally:
+            self.lock.release()
 
 class ServiceRequestHandler(object):
-    def __init__(self, serviceHandler):
+    def __init__(self, serviceHandler, maxMessageSize = MAX_MESSAGE_SIZE):
         self.serviceHandler = serviceHandler
+        self.maxMessageSize = maxMessageSize
         
     def __call__(self, *args, **kwargs):
         handler = self.serviceHandler
+        maxMessageSize = self.maxMessageSize
         class StreamRequestHandler (SocketServer.BaseRequestHandler):
             def handle(self):
                 log = logging.getLogger('service')
                 log.info('recieved request from %s' % self.client_address[0])
-                json = ''
+                framer = JSONFramer(maxMessageSize)
+                conn = Connection(self.server)
+                idleTimeout = False
                 try:
                     while 1:
-                        recv = self.request.recv(RECVSIZE)
-                        json += recv
-                        if len(recv) != RECVSIZE:
-                            break
+                        try:
+                            json = self.readMessage(framer)
+                        except socket.timeout:
+                            log.debug('idle connection from %s timed out' % self.client_address[0])
+                            idleTimeout = True
+                            return
+                        except JSONRPCError, e:
+                            log.debug('invalid request from %s: %s' % (self.client_address[0], e))
+                            self.request.sendall(handler.translateResult(None, e, None))
+                            return
+                        if json == None:
+                            return
                         
-                    log.debug('request: %s' % json)
-                    ret = handler.handleRequest(json)
-    
-                    if ret != None:
-                        log.debug('returning: %s' % ret)
-                        self.request.send(ret)
+                        log.debug('request: %s' % json)
+                        ret = handleConnectionRequest(handler, conn, json)
+                        conn.requests += 1
+        
+                        if ret != None:
+                            log.debug('returning: %s' % ret)
+                            self.request.sendall(ret)
+                        
+                        if not conn.keepAlive or conn.requests >= self.server.maxRequests:
+                            return
+                        self.request.settimeout(self.server.idleTimeout)
                 except socket.error, msg:
                     log.debug('connection reset by %s' % self.client_address[0])
-                    return
+                finally:
+                    self.server.connectionStats.connectionClosed(conn, idleTimeout)
+            
+            def readMessage(self, framer):
+                """Return the next request on the connection, or None if it was closed."""
+                
+                json = framer.nextMessage()
+                while json == None:
+                    recv = self.request.recv(RECVSIZE)
+                    if not recv:
+                        if framer.pending():
+                            log = logging.getLogger('service')
+                            log.debug('connection closed by %s before the request was complete' % self.client_address[0])
+                        return None
+                    framer.feed(recv)
+                    json = framer.nextMessage()
+                
+                return json
         
         return StreamRequestHandler(*args, **kwargs)
 
 class TCPServiceServer(SocketServer.TCPServer):
-    def __init__(self, server_address, serviceHandler):
-        SocketServer.TCPServer.__init__(self, server_address, ServiceRequestHandler(serviceHandler))
+    def __init__(self, server_address, serviceHandler, maxMessageSize = MAX_MESSAGE_SIZE,
+                 keepAlive = False, idleTimeout = KEEPALIVE_TIMEOUT,
+                 maxRequests = KEEPALIVE_MAX_REQUESTS, bind_and_activate = True):
+        """TCPServiceServer initialization.
+        
+        Requests larger than maxMessageSize bytes are rejected.
+        
+        If keepAlive is true the system.keepAlive procedure is registered with
+        serviceHandler. A client that calls it (as a single request, not in a
+        batch) can send further requests on the same connection, until it is
+        idle for idleTimeout seconds or maxRequests requests have been served.
+        Every other connection is closed after one request, as existing clients
+        expect.
+        
+        If bind_and_activate is false the socket is not bound or listened on,
+        so that an already listening socket can be swapped in.
+        
+        """
+        
+        SocketServer.TCPServer.__init__(self, server_address, ServiceRequestHandler(serviceHandler, maxMessageSize),
+                                        bind_and_activate)
+        
+        self.keepAlive = keepAlive
+        self.idleTimeout = idleTimeout
+        self.maxRequests = maxRequests
+        self.connectionStats = ConnectionStats()
+        
+        if keepAlive:
+            registerKeepAlive(serviceHandler)
         
 class ThreadedTCPServiceServer(SocketServer.ThreadingMixIn, TCPServiceServer): pass
 
+class PooledTCPServiceServer(TCPServiceServer):
+    """A TCPServiceServer that handles connections on a fixed pool of worker threads.
+    
+    Accepted connections wait in a queue of queueSize for one of the workers.
+    When the queue is full the server stops accepting, and new connections
+    wait in the listen backlog instead. poolStats returns the queue depth,
+    wait times and worker utilization.
+    
+    """
+    
+    # connections wait in the listen backlog while the queue is full
+    request_queue_size = 128
+    
+    def __init__(self, server_address, serviceHandler, workers = POOL_WORKERS,
+                 queueSize = POOL_QUEUE_SIZE, maxMessageSize = MAX_MESSAGE_SIZE,
+                 keepAlive = False, idleTimeout = KEEPALIVE_TIMEOUT,
+                 maxRequests = KEEPALIVE_MAX_REQUESTS, bind_and_activate = True):
+        TCPServiceServer.__init__(self, server_address, serviceHandler, maxMessageSize,
+                                  keepAlive, idleTimeout, maxRequests, bind_and_activate)
+        self.pool = ThreadPool(workers, queueSize, 'PooledTCPServiceServer')
+    
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+    
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+    
+    def server_close(self):
+        TCPServiceServer.server_close(self)
+        self.pool.shutdown(True, 1.0)
+    
+    def poolStats(self):
+        """Return the statistics of the worker pool, see ThreadPool.stats."""
+        
+        return self.pool.stats()
+
 if __name__ == '__main__':
     import socket
     import threading
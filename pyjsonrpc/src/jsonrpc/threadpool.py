@@ -0,0 +1,310 @@
+# Copyright (c) 2008, Michael Lunnay <mlunnay@gmail.com.au>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""A fixed size pool of worker threads for running calls concurrently."""
+
+import threading
+import Queue
+import sys
+import time
+import atexit
+import weakref
+
+__all__ = ['ThreadPool', 'Future', 'TimeoutError', 'DroppedError',
+           'OVERFLOW_BLOCK', 'OVERFLOW_DROP_OLDEST', 'OVERFLOW_DROP_NEWEST']
+
+# what ThreadPool.submit does when the queue is full
+OVERFLOW_BLOCK = 'block'                # wait for room in the queue
+OVERFLOW_DROP_OLDEST = 'dropOldest'     # drop the call that has waited longest
+OVERFLOW_DROP_NEWEST = 'dropNewest'     # drop the call being submitted
+
+# the pools that are running, so their workers can be stopped before the
+# interpreter shuts down
+_pools = weakref.WeakKeyDictionary()
+
+class TimeoutError(Exception):
+    """Raised when waiting on a Future times out."""
+
+class DroppedError(Exception):
+    """Raised by the Future of a call that was dropped because the queue was full."""
+
+class Future(object):
+    """The pending result of a call submitted to a ThreadPool."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._excInfo = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True if the call has finished."""
+
+        return self._done.isSet()
+
+    def result(self, timeout = None):
+        """Return the result of the call, waiting up to timeout seconds for it.
+
+        If the call raised an exception it is re-raised here.
+        throws TimeoutError if the call has not finished within timeout.
+
+        """
+
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise TimeoutError()
+
+        if self._excInfo != None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+
+    def exception(self, timeout = None):
+        """Return the exception raised by the call, or None if it succeeded."""
+
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise TimeoutError()
+
+        if self._excInfo != None:
+            return self._excInfo[1]
+        return None
+
+    def addDoneCallback(self, fn):
+        """Call fn with this Future once it has finished.
+
+        If it has already finished fn is called immediately.
+
+        """
+
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def setResult(self, result):
+        self._result = result
+        self._finish()
+
+    def setException(self, excInfo = None):
+        """Set the exception for this Future, from sys.exc_info() if excInfo is not given."""
+
+        if excInfo == None:
+            excInfo = sys.exc_info()
+        self._excInfo = excInfo
+        self._finish()
+
+    def _finish(self):
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+
+        for fn in callbacks:
+            fn(self)
+
+class ThreadPool(object):
+    """A fixed number of daemon worker threads that run submitted calls.
+
+    If queueSize is greater than 0 at most that many calls wait for a worker.
+    When the queue is full submit does what overflow says: OVERFLOW_BLOCK
+    waits for room, OVERFLOW_DROP_OLDEST drops the call that has waited
+    longest and OVERFLOW_DROP_NEWEST the call being submitted. The Futures of
+    dropped calls raise DroppedError, and they are counted in the stats.
+
+    The pool keeps statistics for sizing it, see stats.
+
+    """
+
+    def __init__(self, workers, queueSize = 0, name = 'ThreadPool', overflow = OVERFLOW_BLOCK):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.workers = workers
+        self.queueSize = queueSize
+        self.overflow = overflow
+        self.queue = Queue.Queue(queueSize)
+        self.threads = []
+        self.stopped = False
+
+        self.statsLock = threading.Lock()
+        self.resetStats()
+
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='%s-%d' % (name, i))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+        _pools[self] = True
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) to run on a worker, and return its Future."""
+
+        future = Future()
+        item = (future, fn, args, kwargs, time.time())
+        if self.overflow == OVERFLOW_BLOCK:
+            self.queue.put(item)
+            return future
+
+        while 1:
+            try:
+                self.queue.put_nowait(item)
+                return future
+            except Queue.Full:
+                pass
+
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self._drop(item)
+                return future
+            try:
+                oldest = self.queue.get_nowait()
+            except Queue.Empty:
+                # a worker took it first, there is room now
+                continue
+            if oldest == None:
+                # the pool is shutting down, keep the stop marker
+                self.queue.put(None)
+                self._drop(item)
+                return future
+            self._drop(oldest)
+
+    def _drop(self, item):
+        self.statsLock.acquire()
+        try:
+            self.dropped += 1
+        finally:
+            self.statsLock.release()
+        item[0].setException((DroppedError, DroppedError("Queue of %d calls is full" % self.queueSize), None))
+
+    def map(self, fn, seq):
+        """Call fn on each item of seq concurrently, and return a list of the results in order."""
+
+        futures = [self.submit(fn, x) for x in seq]
+        return [f.result() for f in futures]
+
+    def shutdown(self, wait = True, timeout = None):
+        """Stop the workers once the calls already submitted have been run.
+
+        If wait is true, wait up to timeout seconds for each worker to stop.
+
+        """
+
+        if not self.stopped:
+            self.stopped = True
+            for t in self.threads:
+                self.queue.put(None)
+        if wait:
+            for t in self.threads:
+                t.join(timeout)
+
+    def _work(self):
+        while 1:
+            item = self.queue.get()
+            if item == None:
+                return
+
+            future, fn, args, kwargs, queued = item
+            start = time.time()
+            self._started(start - queued)
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                self._finished(time.time() - start)
+                future.setException()
+            else:
+                self._finished(time.time() - start)
+                future.setResult(result)
+
+    def _started(self, wait):
+        self.statsLock.acquire()
+        try:
+            self.busy += 1
+            self.waitTotal += wait
+            if wait > self.waitMax:
+                self.waitMax = wait
+        finally:
+            self.statsLock.release()
+
+    def _finished(self, runTime):
+        self.statsLock.acquire()
+        try:
+            self.busy -= 1
+            self.completed += 1
+            self.busyTime += runTime
+        finally:
+            self.statsLock.release()
+
+    def resetStats(self):
+        """Start collecting the statistics afresh."""
+
+        self.statsLock.acquire()
+        try:
+            self.statsStart = time.time()
+            self.busy = 0           # workers running a call
+            self.completed = 0
+            self.busyTime = 0.0     # total time spent running calls
+            self.waitTotal = 0.0    # total time calls waited in the queue
+            self.waitMax = 0.0
+            self.dropped = 0        # calls dropped because the queue was full
+        finally:
+            self.statsLock.release()
+
+    def stats(self):
+        """Return a dictionary of statistics about the pool.
+
+        queueDepth is the number of calls waiting for a worker, avgWait and
+        maxWait are how long calls waited in seconds, utilization is the
+        fraction of the workers' time spent running calls, and dropped the
+        number of calls dropped because the queue was full, since the pool was
+        created or resetStats was called.
+
+        """
+
+        self.statsLock.acquire()
+        try:
+            elapsed = time.time() - self.statsStart
+            started = self.completed + self.busy
+            if started:
+                avgWait = self.waitTotal / started
+            else:
+                avgWait = 0.0
+            if elapsed > 0:
+                utilization = self.busyTime / (elapsed * self.workers)
+            else:
+                utilization = 0.0
+
+            return {'workers': self.workers,
+                    'busyWorkers': self.busy,
+                    'queueDepth': self.queue.qsize(),
+                    'queueSize': self.queueSize,
+                    'overflow': self.overflow,
+                    'completed': self.completed,
+                    'dropped': self.dropped,
+                    'avgWait': avgWait,
+                    'maxWait': self.waitMax,
+                    'utilization': utilization}
+        finally:
+            self.statsLock.release()
+
+def _shutdownPools():
+    for pool in _pools.keys():
+        pool.shutdown(True, 1.0)
+
+atexit.register(_shutdownPools)
@@ -0,0 +1,122 @@
+import base64
+import os
+import sys
+import threading
+import time
+
+import jsonrpc
+from jsonrpc.socketserver import ThreadedTCPServiceServer
+from jsonrpc.binarychannel import BinaryChannel, BinaryChannelServer, receiveBinary, sendBinary, crc32
+
+# Compares the throughput of downloading and uploading a file in base64
+# encoded chunks, like FileTransfer.downloadChunk and uploadChunk, with the
+# raw bytes of the binary channel. Both check the data with a CRC-32, so the
+# difference is the cost of base64 and JSON.
+#
+# usage: benchbinary.py [megabytes] [chunk size in KB]
+
+MEGABYTES = 16
+CHUNK_SIZE = 64 * 1024
+
+class File(object):
+    _jsonrpcName = 'file'
+
+    def __init__(self, data, channel, port):
+        self.data = data
+        self.uploaded = bytearray(len(data))
+        self.channel = channel
+        self.port = port
+
+    def read(self, offset, length):
+        return self.data[offset:offset + length]
+
+    def write(self, offset, data):
+        self.uploaded[offset:offset + len(data)] = data
+
+    @jsonrpc.serviceProcedure(params=[jsonrpc.Number('offset'), jsonrpc.Number('length')], ret=jsonrpc.Object())
+    def downloadChunk(self, offset, length):
+        data = self.read(offset, length)
+        return {'data': base64.b64encode(data), 'crc': crc32(data)}
+
+    @jsonrpc.serviceProcedure(params=[jsonrpc.Number('offset'), jsonrpc.String('data'), jsonrpc.Number('crc')],
+                              ret=jsonrpc.Number())
+    def uploadChunk(self, offset, data, crc):
+        data = base64.b64decode(data)
+        assert crc32(data) == crc
+        self.write(offset, data)
+        return len(data)
+
+    @jsonrpc.serviceProcedure(ret=jsonrpc.Object())
+    def openBinaryDownload(self):
+        return {'token': self.channel.offerDownload(self.read, 0, len(self.data)), 'port': self.port}
+
+    @jsonrpc.serviceProcedure(ret=jsonrpc.Object())
+    def openBinaryUpload(self):
+        return {'token': self.channel.acceptUpload(self.write, 0, len(self.data)), 'port': self.port}
+
+def serve(server):
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+
+def base64Download(client, size, chunkSize):
+    parts = []
+    for offset in range(0, size, chunkSize):
+        chunk = client.call('file.downloadChunk', offset, chunkSize)
+        data = base64.b64decode(chunk['data'])
+        assert crc32(data) == chunk['crc']
+        parts.append(data)
+    return ''.join(parts)
+
+def base64Upload(client, data, chunkSize):
+    for offset in range(0, len(data), chunkSize):
+        chunk = data[offset:offset + chunkSize]
+        client.call('file.uploadChunk', offset, base64.b64encode(chunk), crc32(chunk))
+
+def binaryDownload(client, host):
+    r = client.call('file.openBinaryDownload')
+    return receiveBinary((host, r['port']), r['token'])
+
+def binaryUpload(client, host, data, chunkSize):
+    r = client.call('file.openBinaryUpload')
+    sendBinary((host, r['port']), r['token'], data, frameSize=chunkSize)
+
+def bench(name, fn, size):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    print '%-22s %8.2f MB/sec %8.1f ms' % (name, size / elapsed / 1e6, elapsed * 1000)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        MEGABYTES = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        CHUNK_SIZE = int(sys.argv[2]) * 1024
+
+    data = os.urandom(MEGABYTES * 1024 * 1024)
+    host = '127.0.0.1'
+    channel = BinaryChannel(frameSize=CHUNK_SIZE)
+    binary = BinaryChannelServer((host, 0), channel)
+    serve(binary)
+    f = File(data, channel, binary.server_address[1])
+    handler = jsonrpc.ServiceHandler('BenchBinary')
+    handler.registerService(f)
+    server = ThreadedTCPServiceServer((host, 0), handler, keepAlive=True)
+    serve(server)
+    client = jsonrpc.ServiceClient((host, server.server_address[1]), poolSize=1)
+
+    print '%d MB in %d KB chunks' % (MEGABYTES, CHUNK_SIZE / 1024)
+    result = []
+    bench('download.base64', lambda: result.append(base64Download(client, len(data), CHUNK_SIZE)), len(data))
+    bench('download.binary', lambda: result.append(binaryDownload(client, host)), len(data))
+    assert result == [data, data]
+    bench('upload.base64', lambda: base64Upload(client, data, CHUNK_SIZE), len(data))
+    assert str(f.uploaded) == data
+    f.uploaded = bytearray(len(data))
+    bench('upload.binary', lambda: binaryUpload(client, host, data, CHUNK_SIZE), len(data))
+    assert str(f.uploaded) == data
+    print '    channel:', channel.stats()
+
+    client.close()
+    server.shutdown()
+    binary.shutdown()
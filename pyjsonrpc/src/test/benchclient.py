@@ -0,0 +1,66 @@
+import sys
+import threading
+import time
+
+import jsonrpc
+from jsonrpc.socketserver import ThreadedTCPServiceServer
+
+# Compares calls per second made with ServiceClient: a new connection per
+# call, calls on persistent connections, pipelined calls with futures, and
+# batches.
+#
+# usage: benchclient.py [calls]
+
+CALLS = 2000
+
+def serve(keepAlive):
+    server = ThreadedTCPServiceServer(('127.0.0.1', 0), jsonrpc.ServiceHandler('BenchClient'),
+                                      keepAlive=keepAlive)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+def sequential(client, calls):
+    proxy = jsonrpc.ServiceProxy(client)
+    for i in range(calls):
+        assert proxy.system.echo(i) == [i]
+
+def pipelined(client, calls):
+    futures = [client.callAsync('system.echo', i) for i in range(calls)]
+    for i, f in enumerate(futures):
+        assert f.result() == [i]
+
+def batched(client, calls, size = 50):
+    futures = []
+    for start in range(0, calls, size):
+        batch = client.batch()
+        futures.extend([batch.call('system.echo', i) for i in range(start, min(start + size, calls))])
+        batch.send()
+    for i, f in enumerate(futures):
+        assert f.result() == [i]
+
+def bench(name, server, fn, calls, **kwargs):
+    client = jsonrpc.ServiceClient(server.server_address, **kwargs)
+    start = time.time()
+    fn(client, calls)
+    elapsed = time.time() - start
+    print '%-28s %8.1f calls/sec  %s' % (name, calls / elapsed, client.stats())
+    client.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        CALLS = int(sys.argv[1])
+
+    server = serve(False)
+    bench('connection per call', server, sequential, CALLS)
+    server.shutdown()
+    server.server_close()
+
+    server = serve(True)
+    bench('persistent', server, sequential, CALLS)
+    bench('pipelined, 1 connection', server, pipelined, CALLS, poolSize=1)
+    bench('pipelined, 4 connections', server, pipelined, CALLS)
+    bench('batches of 50', server, batched, CALLS)
+    server.shutdown()
+    server.server_close()
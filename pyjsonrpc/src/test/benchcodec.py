@@ -0,0 +1,45 @@
+import base64
+import os
+import time
+
+import jsonrpc
+
+# Benchmark of the JSON codecs on typical RPC and file transfer payloads.
+
+def request(method, params, id=1):
+    return {"jsonrpc": "2.0", "method": method, "params": params, "id": id}
+
+def response(result, id=1):
+    return {"jsonrpc": "2.0", "result": result, "id": id}
+
+listing = [{"name": "file%d.nds" % i, "size": i * 1024, "isDir": False, "readonly": True}
+           for i in range(100)]
+
+payloads = [
+    ('echo request', request("system.echo", ["test", 2.2, True])),
+    ('version response', response([1, 0])),
+    ('listDir response', response(listing)),
+    ('download 64K', response({"data": base64.b64encode(os.urandom(64 * 1024)), "crc": 12345})),
+    ('upload 1M', request("file.upload", ["/roms/test.nds", base64.b64encode(os.urandom(1024 * 1024)), 12345, False])),
+]
+
+codecs = [('niceJSON', jsonrpc.niceJSON(True)), ('StdlibCodec', jsonrpc.StdlibCodec())]
+
+def bench(fn, arg):
+    # run for at least half a second
+    count = 0
+    start = time.time()
+    while 1:
+        fn(arg)
+        count += 1
+        elapsed = time.time() - start
+        if elapsed > 0.5:
+            return elapsed / count
+
+for name, obj in payloads:
+    data = codecs[1][1].encode(obj)
+    for cname, codec in codecs:
+        enc = bench(codec.encode, obj)
+        dec = bench(codec.decode, data)
+        print '%-18s %9d bytes %-12s encode %10.1f usec  decode %10.1f usec' % \
+              (name, len(data), cname, enc * 1e6, dec * 1e6)
@@ -0,0 +1,85 @@
+import base64
+import binascii
+import os
+import socket
+import sys
+import threading
+import time
+import zlib
+
+import jsonrpc
+from jsonrpc.socketserver import ThreadedTCPServiceServer
+from jsonrpc.prefork import PreforkServiceServer, cpuCount
+
+# Compares the throughput of a compression bound procedure, like
+# FileTransfer.download, on ThreadedTCPServiceServer and PreforkServiceServer.
+# Prefork should scale with the number of processors, the threaded server
+# is held to one by the global interpreter lock.
+#
+# usage: benchprefork.py [clients] [calls per client]
+
+CLIENTS = 16
+CALLS = 10
+
+DATA = os.urandom(64 * 1024) + 'x' * 192 * 1024
+
+MESSAGE = '{"jsonrpc": "2.0", "method": "compress", "params": [], "id": 1}'
+
+def compress():
+    data = zlib.compress(DATA, 9)
+    return {'data': base64.b64encode(data), 'crc': binascii.crc32(data)}
+
+def makeHandler():
+    handler = jsonrpc.ServiceHandler('BenchPrefork')
+    handler.registerFunction(compress)
+    return handler
+
+def call(address):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(address)
+    s.sendall(MESSAGE)
+    while s.recv(65536):
+        pass
+    s.close()
+
+def client(address, calls):
+    for i in range(calls):
+        call(address)
+
+def run(address, clients, calls):
+    threads = [threading.Thread(target=client, args=(address, calls)) for i in range(clients)]
+    start = time.time()
+    for c in threads:
+        c.start()
+    for c in threads:
+        c.join()
+    return clients * calls / (time.time() - start)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        CLIENTS = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        CALLS = int(sys.argv[2])
+
+    ThreadedTCPServiceServer.request_queue_size = 128
+    server = ThreadedTCPServiceServer(('127.0.0.1', 0), makeHandler())
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    rate = run(server.server_address, CLIENTS, CALLS)
+    server.shutdown()
+    server.server_close()
+    print '%-24s %8.1f calls/sec' % ('ThreadedTCPServiceServer', rate)
+
+    for processes in sorted(set([1, 2, cpuCount()])):
+        server = PreforkServiceServer(('127.0.0.1', 0), makeHandler, processes)
+        pid = os.fork()
+        if pid == 0:
+            server.serve_forever()
+            os._exit(0)
+        time.sleep(0.5)
+        rate = run(server.server_address, CLIENTS, CALLS)
+        os.kill(pid, 15)
+        os.waitpid(pid, 0)
+        server.server_close()
+        print '%-24s %8.1f calls/sec' % ('PreforkServiceServer x%d' % processes, rate)
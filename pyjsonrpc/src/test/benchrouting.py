@@ -0,0 +1,24 @@
+import timeit
+
+import jsonrpc
+
+# Benchmark of ServiceHandler.findServiceEndpoint as the number of registered
+# services grows. The time per lookup should stay flat.
+
+class BenchService(object):
+    @jsonrpc.serviceProcedure()
+    def method(self):
+        pass
+
+NUMBER = 100000
+
+for count in [1, 10, 100, 1000]:
+    service = jsonrpc.ServiceHandler('BenchRouting')
+    for i in range(count):
+        service.registerService(BenchService(), 'service%d' % i)
+    # a nested namespace, with a parent namespace also registered
+    service.registerService(BenchService(), 'service0.cache')
+
+    for name in ['service0.method', 'service%d.method' % (count - 1), 'service0.cache.method']:
+        t = timeit.Timer(lambda: service.findServiceEndpoint(name)).timeit(NUMBER)
+        print '%5d services: %-22s %.3f usec/lookup' % (count, name, t / NUMBER * 1e6)
@@ -0,0 +1,76 @@
+import socket
+import sys
+import threading
+import time
+
+import jsonrpc
+from jsonrpc.socketserver import ThreadedTCPServiceServer, PooledTCPServiceServer
+from jsonrpc.asyncserver import AsyncServiceServer
+
+# Compares connections per second and latency of the threaded, pooled and
+# event loop servers. Each client thread opens a new connection for every call.
+#
+# usage: benchservers.py [clients] [calls per client]
+
+CLIENTS = 50
+CALLS = 40
+
+MESSAGE = '{"jsonrpc": "2.0", "method": "system.echo", "params": ["test", 2.2, true], "id": 234}'
+
+def call(address, latencies):
+    start = time.time()
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(address)
+    s.sendall(MESSAGE)
+    while s.recv(4096):
+        pass
+    s.close()
+    latencies.append(time.time() - start)
+
+def client(address, calls, latencies, errors):
+    for i in range(calls):
+        try:
+            call(address, latencies)
+        except socket.error:
+            errors.append(1)
+
+def bench(name, server, clients, calls):
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    address = ('127.0.0.1', server.server_address[1])
+
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=client, args=(address, calls, latencies, errors))
+               for i in range(clients)]
+    start = time.time()
+    for c in threads:
+        c.start()
+    for c in threads:
+        c.join()
+    elapsed = time.time() - start
+
+    server.shutdown()
+    server.server_close()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) / 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print '%-26s %6d calls %8.1f conn/sec  p50 %7.2f ms  p99 %7.2f ms  errors %d' % \
+          (name, len(latencies), len(latencies) / elapsed, p50 * 1000, p99 * 1000, len(errors))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        CLIENTS = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        CALLS = int(sys.argv[2])
+
+    ThreadedTCPServiceServer.request_queue_size = 128
+    bench('ThreadedTCPServiceServer', ThreadedTCPServiceServer(('127.0.0.1', 0),
+          jsonrpc.ServiceHandler('BenchServers')), CLIENTS, CALLS)
+    pooled = PooledTCPServiceServer(('127.0.0.1', 0), jsonrpc.ServiceHandler('BenchServers'))
+    bench('PooledTCPServiceServer', pooled, CLIENTS, CALLS)
+    print '    pool:', pooled.poolStats()
+    bench('AsyncServiceServer', AsyncServiceServer(('127.0.0.1', 0),
+          jsonrpc.ServiceHandler('BenchServers')), CLIENTS, CALLS)
@@ -0,0 +1,228 @@
+import base64
+import optparse
+import os
+import platform
+import sys
+import time
+
+import jsonrpc
+
+# Micro-benchmarks of the ServiceHandler request path, each measured in
+# isolation, with small, medium and multi-megabyte payloads.
+#
+# Results are printed as a table, and can be written as JSON with -o. Given
+# a baseline written by an earlier run with -b, benchmarks that got slower by
+# more than the threshold are reported and the exit status is 1.
+#
+# usage: benchsuite.py [-o results.json] [-b benchbaseline.json] [-t 1.25] [-k filter]
+
+class BenchService(object):
+    _jsonrpcName = 'bench'
+
+    @jsonrpc.serviceProcedure(params=[jsonrpc.String('data')], ret=jsonrpc.Number())
+    def upload(self, data):
+        return len(data)
+
+    @jsonrpc.serviceProcedure(params=[jsonrpc.Number('count')], ret=jsonrpc.Array())
+    def listing(self, count):
+        return LISTINGS[count]
+
+    @jsonrpc.serviceProcedure(ret=jsonrpc.Number())
+    def noop(self):
+        return 0
+
+    @jsonrpc.serviceProcedure(params=[jsonrpc.String('message')])
+    def log(self, message):
+        # stands in for the write of a log record
+        time.sleep(0.001)
+
+    @jsonrpc.serviceProcedure(params=[jsonrpc.String('name')], ret=jsonrpc.Array(), idempotent=True)
+    def version(self, name):
+        return [1, 0]
+
+def ping():
+    return 'pong'
+
+def makeHandler():
+    handler = jsonrpc.ServiceHandler('BenchSuite', summary='benchmark service')
+    handler.registerFunction(ping)
+    handler.registerService(BenchService())
+    for i in range(50):
+        # other services for the lookups to pass over
+        handler.registerService(BenchService(), 'bench%d.service' % i)
+    return handler
+
+def listing(count):
+    return [{'name': 'file%d.nds' % i, 'size': i * 1024, 'isDir': False, 'readonly': True}
+            for i in range(count)]
+
+LISTINGS = {10: listing(10), 1000: listing(1000), 40000: listing(40000)}
+
+SIZES = [('small', 64), ('medium', 64 * 1024), ('large', 4 * 1024 * 1024)]
+RESULTS = [('small', 10), ('medium', 1000), ('large', 40000)]
+
+def request(method, params, id=1):
+    return {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id}
+
+def rejected(fn, *args):
+    try:
+        fn(*args)
+    except jsonrpc.InvalidParametersError:
+        pass
+
+def benchmarks():
+    """Return a list of (name, function) for the benchmarks, each function makes one call."""
+
+    handler = makeHandler()
+    codec = handler.json
+    holder = handler.services['bench']
+    nice = jsonrpc.niceJSON(True)
+    cases = []
+
+    for size, n in SIZES:
+        data = codec.encode(request('bench.upload', [base64.b64encode(os.urandom(n))[:n]]))
+        cases.append(('translateRequest.%s' % size,
+                      lambda data=data: handler.translateRequest(data)))
+
+    cases.append(('findServiceEndpoint.function', lambda: handler.findServiceEndpoint('ping')))
+    cases.append(('findServiceEndpoint.service', lambda: handler.findServiceEndpoint('bench.noop')))
+    cases.append(('findServiceEndpoint.nested', lambda: handler.findServiceEndpoint('bench49.service.noop')))
+
+    ping_ = handler.findServiceEndpoint('ping')
+    cases.append(('invokeServiceEndpoint.function',
+                  lambda: handler.invokeServiceEndpoint('ping', ping_, [])))
+    cases.append(('invokeServiceEndpoint.service',
+                  lambda: handler.invokeServiceEndpoint('bench.noop', holder, [])))
+    cases.append(('invokeServiceEndpoint.named',
+                  lambda: handler.invokeServiceEndpoint('bench.listing', holder, {'count': 10})))
+    cases.append(('invokeServiceEndpoint.invalid',
+                  lambda: rejected(handler.invokeServiceEndpoint, 'bench.listing', holder, ['10'])))
+    cached = makeHandler()
+    cached.resultCache = jsonrpc.ResultCache()
+    cases.append(('invokeServiceEndpoint.cached',
+                  lambda: cached.invokeServiceEndpoint('bench.version', holder, ['bench'])))
+
+    for size, n in RESULTS:
+        result = LISTINGS[n]
+        cases.append(('translateResult.%s' % size,
+                      lambda result=result: handler.translateResult(result, None, 1)))
+    cases.append(('translateResult.tiny', lambda: handler.translateResult(0, None, 1)))
+    err = jsonrpc.MethodNotFoundError('bench.missing')
+    cases.append(('translateResult.error', lambda: handler.translateResult(None, err, 1)))
+
+    cases.append(('ServiceHolder.dispatch', lambda: holder.dispatch('noop')))
+
+    cases.append(('niceJSON.encode_number.float', lambda: nice.encode_number(2.2)))
+    cases.append(('niceJSON.encode_number.int', lambda: nice.encode_number(1234567)))
+    cases.append(('describe', handler.describe))
+    cases.append(('describe.build', handler.buildDescription))
+    data = codec.encode(request('ping', []))
+    cases.append(('handleRequest.tiny', lambda data=data: handler.handleRequest(data)))
+    data = codec.encode(request('bench.missing', []))
+    cases.append(('handleRequest.error', lambda data=data: handler.handleRequest(data)))
+    data = codec.encode(request('bench.log', ['message'], None))
+    cases.append(('handleRequest.notification', lambda data=data: handler.handleRequest(data)))
+    # most of these are dropped, as the worker can't keep up, so this is the
+    # cost of queueing one
+    notifying = makeHandler()
+    notifying.notificationExecutor = jsonrpc.ThreadPool(1, 10, 'Notify', jsonrpc.OVERFLOW_DROP_NEWEST)
+    cases.append(('handleRequest.notification.async', lambda data=data: notifying.handleRequest(data)))
+    data = codec.encode(request('service.describe', []))
+    cases.append(('handleRequest.describe', lambda data=data: handler.handleRequest(data)))
+
+    for size, n in SIZES:
+        data = codec.encode(request('bench.upload', [base64.b64encode(os.urandom(n))[:n]]))
+        cases.append(('handleRequest.%s' % size, lambda data=data: handler.handleRequest(data)))
+
+    return cases
+
+def measure(fn, repeat, minTime):
+    """Return the best time in seconds of one call of fn over repeat runs."""
+
+    # find a loop count that takes at least minTime
+    loops = 1
+    while 1:
+        start = time.time()
+        for i in xrange(loops):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= minTime:
+            break
+        loops *= 10 if elapsed < minTime / 10 else 2
+
+    best = elapsed / loops
+    for r in range(repeat - 1):
+        start = time.time()
+        for i in xrange(loops):
+            fn()
+        best = min(best, (time.time() - start) / loops)
+    return best
+
+def compare(results, baseline, threshold):
+    """Print the change from baseline, return the names of the benchmarks that regressed."""
+
+    regressions = []
+    print
+    print '%-34s %12s %12s %8s' % ('benchmark', 'baseline', 'now', 'ratio')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old = baseline[name]['usec']
+        new = results[name]['usec']
+        ratio = new / old
+        flag = ''
+        if ratio > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print '%-34s %10.2fus %10.2fus %7.2fx %s' % (name, old, new, ratio, flag)
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', help='write the results as JSON to this file')
+    parser.add_option('-b', '--baseline', help='compare with the results in this file')
+    parser.add_option('-t', '--threshold', type='float', default=1.25,
+                      help='ratio of time to the baseline that is a regression (default 1.25)')
+    parser.add_option('-k', '--filter', default='',
+                      help='only run the benchmarks whose names contain this')
+    parser.add_option('-r', '--repeat', type='int', default=7,
+                      help='runs of each benchmark, the best is kept (default 7)')
+    parser.add_option('-m', '--min-time', type='float', default=0.1,
+                      help='minimum seconds for each run (default 0.1)')
+    options, args = parser.parse_args()
+
+    codec = jsonrpc.defaultCodec()
+    results = {}
+    for name, fn in benchmarks():
+        if options.filter not in name:
+            continue
+        best = measure(fn, options.repeat, options.min_time)
+        results[name] = {'usec': round(best * 1e6, 3)}
+        print '%-34s %12.2f usec' % (name, best * 1e6)
+        sys.stdout.flush()
+
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(jsonrpc.niceJSON(True, False).encode({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'codec': codec.__class__.__name__,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results}))
+        f.write('\n')
+        f.close()
+
+    if options.baseline:
+        f = open(options.baseline)
+        baseline = codec.decode(f.read())['results']
+        f.close()
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print
+            print '%d regressions beyond %.2fx: %s' % (len(regressions), options.threshold,
+                                                     ', '.join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -44,3 +44,4 @@ print service.handleRequest('{"jsonrpc": "2.0", "method": "funcTest", "params":
 print service.handleRequest('{"jsonrpc": "2.0"')
 print service.handleRequest('{"jsonrpc": "2.0", "method": "badTest", "params": [1], "id": 236}')
 print service.handleRequest('"test"')
+print service.handleRequest('[{"jsonrpc": "2.0", "method": "system.echo", "params": ["batch"], "id": 237}, {"jsonrpc": "2.0", "method": "funcTest", "params": [1, 2]}, {"jsonrpc": "2.0", "method": "Test.func3", "params": [2, "Two"], "id": 238}]')